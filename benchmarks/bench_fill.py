@@ -0,0 +1,94 @@
+# Compares the ASOF-join implementation of DataKubeRelation.fill_missing_data against the original
+# generate-join-window implementation on synthetic scrape data.  Run with `python -m benchmarks.bench_fill`.
+import time
+import typing as T
+
+import duckdb
+
+from datakube.data_utils import DataKubeRelation
+from datakube.data_utils import FillStrategy
+
+SCRAPE_SECS = 15
+DURATION_SECS = 4 * 3600
+DROP_FRACTION = 0.05
+
+
+def make_relation(conn: duckdb.DuckDBPyConnection, npods: int) -> DataKubeRelation:
+    # Scrapes happen every SCRAPE_SECS with a little jitter, and some fraction of them are missing entirely
+    conn.query(
+        f"""
+        CREATE OR REPLACE TABLE bench AS
+        SELECT
+            to_timestamp(t * {SCRAPE_SECS} + p % {SCRAPE_SECS} + random()) AS timestamp,
+            'pod-' || p AS pod,
+            random() AS value,
+            'pod=pod-' || p AS labels,
+        FROM range({DURATION_SECS // SCRAPE_SECS}) r(t), range({npods}) q(p)
+        WHERE random() > {DROP_FRACTION}
+        """
+    )
+    return DataKubeRelation(conn.table("bench"), conn, "pod")
+
+
+def window_fill(rel: DataKubeRelation, window_size: int = 3) -> DataKubeRelation:
+    rel._rel = rel._rel.select("time_bucket(INTERVAL '1s', timestamp) AS timestamp, * EXCLUDE (timestamp)")
+    rounded_times = rel._as_view("rounded_times")
+    rel._rel = rel._conn.sql(
+        f"""
+        WITH time_ranges AS (
+            SELECT min(timestamp) as mints, max(timestamp) as maxts, pod,
+            FROM {rounded_times} GROUP BY pod
+        ), all_timestamps AS (
+            SELECT unnest(generate_series(mints::timestamptz, maxts::timestamptz, INTERVAL '1s')) AS timestamp, pod,
+            FROM time_ranges
+        ), joined_timestamps AS (
+            SELECT a.timestamp, a.pod, r.value, r.labels,
+            FROM all_timestamps a LEFT JOIN {rounded_times} r
+            USING (timestamp, pod)
+        )
+
+        SELECT timestamp, pod,
+            last_value(value IGNORE NULLS) OVER group_window AS value,
+            last_value(labels IGNORE NULLS) OVER group_window AS labels,
+        FROM joined_timestamps
+        WINDOW group_window AS (
+            PARTITION BY pod ORDER BY timestamp ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW
+        )
+        """
+    )
+    return rel
+
+
+def run(fn: T.Callable[[], DataKubeRelation]) -> T.Tuple[float, T.Any]:
+    start = time.perf_counter()
+    res = fn()._rel.aggregate("count(*), count(value), round(sum(value), 3)").fetchone()
+    return (time.perf_counter() - start, res)
+
+
+def main():
+    conn = duckdb.connect(":memory:")
+    print(f"{'pods':>6} {'samples':>9} {'variant':>28} {'out rows':>10} {'secs':>8}")
+    for npods in [100, 500, 2000]:
+        rel = make_relation(conn, npods)
+        nsamples = conn.table("bench").count("*").fetchone()[0]
+
+        variants: T.List[T.Tuple[str, T.Callable[[], DataKubeRelation]]] = [
+            ("window, 1s", lambda: window_fill(rel.copy())),
+            ("asof locf, 1s", lambda: rel.copy().fill_missing_data()),
+            ("asof locf, 15s", lambda: rel.copy().fill_missing_data(resolution=15)),
+            (
+                "asof linear, 15s",
+                lambda: rel.copy().fill_missing_data(resolution=15, strategy=FillStrategy.LINEAR, max_staleness=60),
+            ),
+        ]
+        results = {}
+        for name, fn in variants:
+            secs, res = run(fn)
+            results[name] = res
+            print(f"{npods:>6} {nsamples:>9} {name:>28} {res[0]:>10} {secs:>8.3f}")
+
+        assert results["window, 1s"][:2] == results["asof locf, 1s"][:2]
+
+
+if __name__ == "__main__":
+    main()
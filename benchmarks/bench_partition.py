@@ -0,0 +1,72 @@
+# Compares the ASOF-join implementation of DataKubeRelation.partition_and_normalize against the original
+# one-CASE-branch-per-split implementation.  Run with `python -m benchmarks.bench_partition`.
+import time
+import typing as T
+
+import arrow
+import duckdb
+
+from datakube.constants import NORM_TS_KEY
+from datakube.data_utils import DataKubeRelation
+
+SPLIT_SECS = 300
+GAP_SECS = 30
+NUM_SERIES = 10
+
+
+def make_relation(conn: duckdb.DuckDBPyConnection, nsplits: int) -> DataKubeRelation:
+    total_secs = nsplits * (SPLIT_SECS + GAP_SECS)
+    conn.query(
+        f"""
+        CREATE OR REPLACE TABLE bench AS
+        SELECT to_timestamp(t) AS timestamp, 'pod-' || s AS pod, random() AS value,
+        FROM range({total_secs}) r(t), range({NUM_SERIES}) q(s)
+        """
+    )
+    return DataKubeRelation(conn.table("bench"), conn, "pod")
+
+
+def make_splits(nsplits: int) -> T.List[T.Tuple[arrow.Arrow, arrow.Arrow]]:
+    return [
+        (arrow.get(i * (SPLIT_SECS + GAP_SECS)), arrow.get(i * (SPLIT_SECS + GAP_SECS) + SPLIT_SECS))
+        for i in range(nsplits)
+    ]
+
+
+def case_partition(rel: DataKubeRelation, splits: T.List[T.Tuple[arrow.Arrow, arrow.Arrow]], prefix: str = "sim"):
+    cases = "".join([
+        f"""
+        WHEN timestamp BETWEEN '{start}' AND '{end}'
+        THEN {{'{prefix}': '{prefix}.{i}', 'start': CAST('{start}' AS TIMESTAMP WITH TIME ZONE)}}
+        """
+        for i, (start, end) in enumerate(splits)
+    ])
+    rel._rel = rel._rel.select(f"*, CASE {cases} END AS s").select(
+        f"*, s.{prefix} AS {prefix}, s.start AS start, timestamp - start AS {NORM_TS_KEY}"
+    )
+    return rel
+
+
+def run(fn: T.Callable[[], DataKubeRelation]) -> T.Tuple[float, T.Any]:
+    start = time.perf_counter()
+    res = fn()._rel.aggregate(f"count({NORM_TS_KEY}), sum(epoch({NORM_TS_KEY}))").fetchone()
+    return (time.perf_counter() - start, res)
+
+
+def main():
+    conn = duckdb.connect(":memory:")
+    print(f"{'splits':>8} {'rows':>10} {'case (s)':>10} {'asof (s)':>10} {'speedup':>8}")
+    for nsplits in [10, 100, 500, 2000]:
+        rel = make_relation(conn, nsplits)
+        splits = make_splits(nsplits)
+        nrows = conn.table("bench").count("*").fetchone()[0]
+
+        case_secs, case_res = run(lambda: case_partition(rel.copy(), splits))
+        asof_secs, asof_res = run(lambda: rel.copy().partition_and_normalize(splits))
+        assert case_res == asof_res
+
+        print(f"{nsplits:>8} {nrows:>10} {case_secs:>10.3f} {asof_secs:>10.3f} {case_secs / asof_secs:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
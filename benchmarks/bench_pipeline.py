@@ -0,0 +1,188 @@
+# End-to-end benchmark of a typical analysis pipeline on synthetic data (see datakube.synth_utils), at a few different
+# scales.  Each stage is materialized before moving on to the next, so that the time and memory for a stage only
+# include the work for that stage.  Memory is reported two ways: the peak Python-side allocation (tracemalloc, which
+# covers pandas and numpy but not DuckDB), and how much the process's peak RSS grew during the stage (which covers
+# everything, but only shows up for a stage that pushes the high-water mark higher).  Run with
+# `python -m benchmarks.bench_pipeline [--scales small medium large]`.
+#
+# The time for each stage is compared against the baseline in baseline.json, and any stage that got slower than the
+# baseline by more than the tolerance is reported; with --check, the benchmark also fails (exits non-zero) if there
+# are any.  Timings depend a lot on the machine, so the baseline only means anything on the machine that recorded it;
+# run with --update-baseline to record a new one (for the scales that were run) before using --check on a different
+# machine, or after a deliberate change.
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing as T
+from datetime import timedelta
+
+import arrow
+from bokeh.embed import json_item
+
+from datakube import plot_utils
+from datakube.data_utils import DataKubeRelation
+from datakube.prom_utils import PromReader
+from datakube.synth_utils import DEFAULT_START_TS
+from datakube.synth_utils import generate_dataset
+
+SCALES = {
+    "small": dict(pods_per_namespace=25, duration=3600),
+    "medium": dict(pods_per_namespace=100, duration=6 * 3600),
+    "large": dict(pods_per_namespace=500, duration=24 * 3600),
+}
+NUM_SPLITS = 4
+METRIC = "container_cpu_usage_seconds_total"
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# A stage counts as a regression if it's slower than the baseline by more than this fraction, and by more than
+# MIN_REGRESSION_SECS (so that noise in the stages that only take a few milliseconds doesn't fail the run)
+DEFAULT_TOLERANCE = 0.5
+MIN_REGRESSION_SECS = 0.1
+
+Timings = T.Dict[str, T.Dict[str, float]]
+
+
+def materialize(rel: DataKubeRelation, name: str) -> DataKubeRelation:
+    view = rel._as_view(name)
+    rel._conn.execute(f"CREATE OR REPLACE TEMP TABLE {name} AS SELECT * FROM {view}")
+    return DataKubeRelation(rel._conn.table(name), rel._conn, rel._grouper)
+
+
+def nrows(obj: T.Any) -> int:
+    if isinstance(obj, DataKubeRelation):
+        return obj._rel.count("*").fetchone()[0]  # type: ignore
+    if isinstance(obj, tuple):
+        return len(obj[0])
+    return len(obj)
+
+
+def measure(timings: T.Dict[str, float], scale: str, stage: str, rows_in: int, fn: T.Callable[[], T.Any]) -> T.Any:
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    res = fn()
+
+    secs = time.perf_counter() - start
+    (_, py_peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024  # ru_maxrss is in KiB
+
+    rows_out = nrows(res)
+    timings[stage] = secs
+    print(
+        f"{scale:>7} {stage:>10} {rows_in:>10} {rows_out:>10} {secs:>8.3f} {rows_in / secs:>12.0f} "
+        f"{py_peak / 2**20:>10.1f} {rss_growth:>10.1f}"
+    )
+    return res
+
+
+def run_pipeline(scale: str, data_path: str, duration: int, generated_rows: int) -> T.Dict[str, float]:
+    split_secs = duration // NUM_SPLITS
+    splits = [
+        (arrow.get(DEFAULT_START_TS + i * split_secs), arrow.get(DEFAULT_START_TS + (i + 1) * split_secs - 1))
+        for i in range(NUM_SPLITS)
+    ]
+
+    timings: T.Dict[str, float] = {}
+    reader = PromReader(data_path)
+    raw = measure(
+        timings, scale, "load", generated_rows, lambda: materialize(reader.query_metric(METRIC, "pod"), "raw")
+    )
+    filled = measure(
+        timings, scale, "fill", nrows(raw), lambda: materialize(raw.copy().fill_missing_data(resolution=15), "filled")
+    )
+    parted = measure(
+        timings,
+        scale,
+        "partition",
+        nrows(filled),
+        lambda: materialize(filled.copy().partition_and_normalize(splits), "parted"),
+    )
+    rated = measure(timings, scale, "rate", nrows(parted), lambda: materialize(parted.copy().rate(60), "rated"))
+    pivot = measure(
+        timings,
+        scale,
+        "pivot",
+        nrows(rated),
+        lambda: rated.to_pivot_table(value_column="rate", max_time=timedelta(seconds=split_secs)),
+    )
+    measure(timings, scale, "histogram", nrows(filled), lambda: filled.delta_histogram(nbins=20))
+
+    # Don't actually try to display the plot; serializing it does all the same work (and tells us how big it is)
+    payload: T.List[int] = []
+    plot_utils._show = lambda obj: payload.append(len(json.dumps(json_item(obj))))  # type: ignore
+    measure(timings, scale, "plot", len(pivot), lambda: plot(pivot))
+    print(f"{scale:>7} {'':>10} plot payload: {payload[0] / 2**20:.1f} MiB")
+    return timings
+
+
+def plot(pivot: T.Any) -> T.Any:
+    plot_utils.plot_multiseries({"cpu": pivot})
+    return pivot
+
+
+def compare(timings: Timings, baseline: Timings, tolerance: float) -> T.List[str]:
+    # Returns a description of each stage that's slower than the baseline by more than the tolerance
+    regressions = []
+    for scale, stages in timings.items():
+        for stage, secs in stages.items():
+            base = baseline.get(scale, {}).get(stage)
+            if base is not None and secs > base * (1 + tolerance) and secs - base > MIN_REGRESSION_SECS:
+                regressions.append(f"{scale} {stage}: {secs:.3f}s vs {base:.3f}s baseline (+{secs / base - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small", "medium"])
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit non-zero if any stage regressed")
+    args = parser.parse_args()
+
+    print(
+        f"{'scale':>7} {'stage':>10} {'rows in':>10} {'rows out':>10} {'secs':>8} {'rows/s':>12} "
+        f"{'py MiB':>10} {'rss+ MiB':>10}"
+    )
+    timings: Timings = {}
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as data_path:
+            rows = generate_dataset(data_path, containers_per_pod=1, **SCALES[scale])  # type: ignore
+            print(f"{scale:>7} {'generate':>10} {rows[METRIC]:>10} rows of {METRIC}")
+            timings[scale] = run_pipeline(scale, data_path, SCALES[scale]["duration"], rows[METRIC])
+
+    baseline: Timings = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update({
+            scale: {stage: round(secs, 3) for (stage, secs) in t.items()} for (scale, t) in timings.items()
+        })
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return
+
+    regressions = compare(timings, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions and args.check:
+        sys.exit(1)
+    if not regressions:
+        print(f"no stages more than {args.tolerance:.0%} slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,78 @@
+import importlib
+import typing as T
+
 import pandas as pd
-from bokeh.io import output_notebook
 
 pd.options.mode.copy_on_write = True
-output_notebook()
-
-from .data_utils import DataKubeRelation
-from .data_utils import counter_diff
-from .data_utils import delta_histogram
-from .k8s_utils import fetch_pod_intervals
-from .k8s_utils import read_obj_from_json
-from .plot_utils import new_figure
-from .plot_utils import plot_histogram
-from .plot_utils import plot_multiseries
-from .prom_utils import PromReader
+
+# Submodules (and their dependencies, some of which are pretty heavy, like bokeh and the kubernetes client) are only
+# imported the first time something from them is used, so that e.g. batch jobs that only need PromReader don't have to
+# pay for the plotting code.
+_EXPORTS = {
+    "concurrency_timeline": "k8s_utils",
+    "counter_diff": "data_utils",
+    "delta_histogram": "data_utils",
+    "delta_quantiles": "data_utils",
+    "fetch_pod_intervals": "k8s_utils",
+    "generate_dataset": "synth_utils",
+    "new_figure": "plot_utils",
+    "read_obj_from_json": "k8s_utils",
+    "read_pod_intervals": "k8s_utils",
+    "plot_histogram": "plot_utils",
+    "plot_multiseries": "plot_utils",
+    "setup_notebook": "plot_utils",
+    "window_overlaps": "k8s_utils",
+    "DataKubeRelation": "data_utils",
+    "PromAPIClient": "prom_api_utils",
+    "PromReader": "prom_utils",
+}
+
+if T.TYPE_CHECKING:
+    from .data_utils import DataKubeRelation
+    from .data_utils import counter_diff
+    from .data_utils import delta_histogram
+    from .data_utils import delta_quantiles
+    from .k8s_utils import concurrency_timeline
+    from .k8s_utils import fetch_pod_intervals
+    from .k8s_utils import read_obj_from_json
+    from .k8s_utils import read_pod_intervals
+    from .k8s_utils import window_overlaps
+    from .plot_utils import new_figure
+    from .plot_utils import plot_histogram
+    from .plot_utils import plot_multiseries
+    from .plot_utils import setup_notebook
+    from .prom_api_utils import PromAPIClient
+    from .prom_utils import PromReader
+    from .synth_utils import generate_dataset
 
 __all__ = [
+    "concurrency_timeline",
     "counter_diff",
     "delta_histogram",
+    "delta_quantiles",
     "fetch_pod_intervals",
+    "generate_dataset",
     "new_figure",
     "read_obj_from_json",
+    "read_pod_intervals",
     "plot_histogram",
     "plot_multiseries",
+    "setup_notebook",
+    "window_overlaps",
     "DataKubeRelation",
+    "PromAPIClient",
     "PromReader",
 ]
+
+
+def __getattr__(name: str) -> T.Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    obj = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = obj
+    return obj
+
+
+def __dir__() -> T.List[str]:
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,156 @@
+import hashlib
+import re
+import threading
+import typing as T
+
+from duckdb.duckdb import DuckDBPyConnection
+from duckdb.duckdb import DuckDBPyRelation
+
+RESULTS_TABLE = "_datakube_results"
+RESULT_TABLE_PREFIX = "_datakube_result_"
+
+# Relations that read straight from a DataFrame, an Arrow table, or a parquet file can change out from under us without
+# the data version noticing (and the DataFrame scans have a memory address in their SQL), so they never get cached
+_UNCACHEABLE_SCANS = ("pandas_scan(", "arrow_scan(", "parquet_scan(")
+
+# DuckDB makes up a random alias for each SQL relation that gets something else chained onto it
+_UNNAMED_RELATION_RE = re.compile(r"\bunnamed_relation_[0-9a-f]+\b")
+
+# In-memory segments don't have any blocks we can count, so we guess at their size instead
+_EST_BYTES_PER_VALUE = 8
+
+
+class ResultCache:
+    # Memoizes the output of DataKubeRelation pipelines as tables in the cache database, so that re-running the same
+    # analysis (e.g., after restarting a notebook) just reads back the result.  Results are keyed on the (whitespace-
+    # normalized) SQL for the pipeline plus the version of the ingested data, which changes whenever any metric is
+    # (re-)loaded, so stale results are never returned; the least-recently-used results are dropped once they take up
+    # more than max_bytes.  The data_version callback is supplied by whoever owns the ingested tables (PromReader).
+    def __init__(self, conn: DuckDBPyConnection, max_bytes: int, data_version: T.Callable[[], str]) -> None:
+        self.max_bytes = max_bytes
+        self._conn = conn
+        self._data_version = data_version
+        self._lock = threading.Lock()
+
+        self._conn.query(
+            f"""
+            CREATE TABLE IF NOT EXISTS {RESULTS_TABLE} (
+                key VARCHAR,
+                data_version VARCHAR,
+                bytes BIGINT,
+                hits BIGINT,
+                last_used TIMESTAMP WITH TIME ZONE,
+            )
+            """
+        )
+
+    def fetch(self, rel: DuckDBPyRelation) -> DuckDBPyRelation:
+        # Returns a relation over the stored result for rel, computing and storing it first if necessary; relations
+        # that can't be cached are returned unchanged
+        version = self._data_version()
+        key = _result_key(rel, version)
+        if key is None:
+            return rel
+
+        table = RESULT_TABLE_PREFIX + key
+        with self._lock:
+            hit = self._conn.execute(
+                f"UPDATE {RESULTS_TABLE} SET hits = hits + 1, last_used = now() WHERE key = ? RETURNING key", [key]
+            ).fetchall()
+            if hit:
+                return self._conn.table(table)
+
+            # Results computed from an older version of the data can never be used again, so don't wait for them to
+            # age out
+            self._drop(f"data_version != '{version}'")
+
+            view = f"_{table}_input"
+            self._conn.register(view, rel)
+            try:
+                self._conn.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM {view}")
+            finally:
+                self._conn.unregister(view)
+
+            size = self._table_bytes(table)
+            if size > self.max_bytes:
+                self._conn.execute(f"DROP TABLE {table}")
+                return rel
+
+            self._conn.execute(f"INSERT INTO {RESULTS_TABLE} VALUES (?, ?, ?, 0, now())", [key, version, size])
+            self._evict()
+            return self._conn.table(table)
+
+    def invalidate(self, rel: T.Optional[DuckDBPyRelation] = None) -> int:
+        # Drop the stored result for rel (or everything, if no relation is given); returns the number of results dropped
+        with self._lock:
+            if rel is None:
+                return self._drop("true")
+            key = _result_key(rel, self._data_version())
+            return self._drop(f"key = '{key}'") if key is not None else 0
+
+    def stats(self) -> T.Tuple[int, int]:
+        # (number of results, total bytes)
+        query = f"SELECT count(*), coalesce(sum(bytes), 0) FROM {RESULTS_TABLE}"
+        (count, size) = self._conn.query(query).fetchone()  # type: ignore
+        return count, size
+
+    def _evict(self) -> None:
+        # Keep the most recently used results that fit in the budget
+        self._conn.execute(
+            f"""
+            DELETE FROM {RESULTS_TABLE} WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, sum(bytes) OVER (ORDER BY last_used DESC, key) AS running
+                    FROM {RESULTS_TABLE}
+                ) WHERE running > ?
+            )
+            """,
+            [self.max_bytes],
+        )
+        self._drop_orphans()
+
+    def _drop(self, cond: str) -> int:
+        dropped = self._conn.execute(f"DELETE FROM {RESULTS_TABLE} WHERE {cond} RETURNING key").fetchall()
+        self._drop_orphans()
+        return len(dropped)
+
+    def _drop_orphans(self) -> None:
+        # Result tables without a bookkeeping row (just evicted, or left behind by a crash) get dropped
+        orphans = self._conn.execute(
+            f"""
+            SELECT table_name FROM duckdb_tables
+            WHERE NOT temporary AND starts_with(table_name, '{RESULT_TABLE_PREFIX}')
+                AND table_name[{len(RESULT_TABLE_PREFIX) + 1}:] NOT IN (SELECT key FROM {RESULTS_TABLE})
+            """
+        ).fetchall()
+        for (table,) in orphans:
+            self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def _table_bytes(self, table: str) -> int:
+        # Blocks that have been written out are counted at full size (they're shared between columns, so this is an
+        # overestimate for small tables); anything still only in memory is estimated from the number of values
+        (size,) = self._conn.execute(
+            f"""
+            SELECT
+                count(DISTINCT block_id) FILTER (persistent AND block_id >= 0)
+                    * (SELECT block_size FROM pragma_database_size() WHERE database_name = current_database())
+                + coalesce(sum(count) FILTER (NOT persistent OR block_id < 0), 0) * {_EST_BYTES_PER_VALUE}
+            FROM pragma_storage_info('{table}')
+            """
+        ).fetchone()  # type: ignore
+        return int(size)
+
+
+def normalize_sql(sql: str) -> str:
+    # Collapse the whitespace, and number the made-up relation aliases in the order they appear, so that the same
+    # pipeline always produces the same SQL
+    aliases: T.Dict[str, str] = {}
+    sql = _UNNAMED_RELATION_RE.sub(lambda m: aliases.setdefault(m.group(0), f"unnamed_relation_{len(aliases)}"), sql)
+    return " ".join(sql.split())
+
+
+def _result_key(rel: DuckDBPyRelation, version: str) -> T.Optional[str]:
+    sql = normalize_sql(rel.sql_query())
+    if any(scan in sql for scan in _UNCACHEABLE_SCANS):
+        return None
+    return hashlib.sha1(f"{version}\n{sql}".encode()).hexdigest()[:16]
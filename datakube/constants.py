@@ -1,2 +1,4 @@
+LABELS_KEY = "labels"
+LABEL_MAP_KEY = "label_map"
 NORM_TS_KEY = "normalized_ts"
 VALUE_KEY = "value"
@@ -1,14 +1,45 @@
+import functools
+import hashlib
+import time
 import typing as T
+import weakref
+from datetime import datetime
 from datetime import timedelta
 from enum import Enum
 
+import duckdb
 import numpy as np
 import pandas as pd
-from arrow import Arrow
 from duckdb.duckdb import DuckDBPyConnection
 from duckdb.duckdb import DuckDBPyRelation
 
+from datakube.cache_utils import ResultCache
+from datakube.cache_utils import normalize_sql
+from datakube.constants import LABEL_MAP_KEY
+from datakube.constants import LABELS_KEY
 from datakube.constants import NORM_TS_KEY
+from datakube.profile_utils import PipelineProfile
+from datakube.profile_utils import StageProfile
+from datakube.profile_utils import StageRecorder
+from datakube.profile_utils import describe_op
+
+if T.TYPE_CHECKING:
+    import pyarrow as pa
+    from arrow import Arrow
+
+# Prometheus labels come to us as a single "k1=v1,k2=v2,..." string; this parses that into a MAP column so that we
+# can look up individual labels without having to re-scan the string every time.  Label values can contain "=" (but
+# not ","), so we split on the first "=" only.
+LABEL_MAP_EXPR = f"""
+    map_from_entries(list_transform(
+        list_filter(string_split({LABELS_KEY}, ','), kv -> strpos(kv, '=') > 0),
+        kv -> {{'key': split_part(kv, '=', 1), 'value': kv[strpos(kv, '=') + 1:]}}
+    ))
+"""
+
+
+# Matches DuckDB's row group size, which is also how much it produces at a time when streaming results out
+DEFAULT_BATCH_SIZE = 122880
 
 
 class Comparison(Enum):
@@ -20,118 +51,454 @@ class Comparison(Enum):
     GT = ">"
 
 
+TimeBound = T.Union["Arrow", datetime]
+# (start, end, resolution): the resolution, in seconds, says that only the last sample per series in each bucket of that
+# size is needed, which lets the source read from a rollup of the metric instead of the raw samples (see PromReader)
+MetricSource = T.Callable[[T.Optional[TimeBound], T.Optional[TimeBound], T.Optional[int]], DuckDBPyRelation]
+
+
+class FillStrategy(Enum):
+    LOCF = "locf"
+    LINEAR = "linear"
+
+
+class Binning(Enum):
+    LINEAR = "linear"
+    LOG = "log"
+
+
+F = T.TypeVar("F", bound=T.Callable[..., T.Any])
+
+
+def _stage(method: F) -> F:
+    # Chained operations get recorded while profiling is turned on (see DataKubeRelation.profile); operations called
+    # from inside other operations are part of the outer one, so they don't get recorded separately
+    @functools.wraps(method)
+    def wrapper(self: "DataKubeRelation", *args: T.Any, **kwargs: T.Any) -> T.Any:
+        if self._profiler is None or self._profiler.depth > 0:
+            return method(self, *args, **kwargs)
+
+        self._profiler.depth += 1
+        try:
+            res = method(self, *args, **kwargs)
+        finally:
+            self._profiler.depth -= 1
+        self._profiler.record((method.__name__, args, kwargs), self._rel, fused=self._source is not None)
+        return res
+
+    return T.cast(F, wrapper)
+
+
+def _terminal(method: F) -> F:
+    # Operations that actually run the pipeline; when profiling is on, this is where the recorded stages get run
+    @functools.wraps(method)
+    def wrapper(self: "DataKubeRelation", *args: T.Any, **kwargs: T.Any) -> T.Any:
+        if self._profiler is None or self._profiler.depth > 0:
+            return method(self, *args, **kwargs)
+
+        (final, profile, tables) = self._run_profile()
+        try:
+            rows_in = final._rel.count("*").fetchone()[0]  # type: ignore
+            start = time.perf_counter()
+            res = method(final, *args, **kwargs)
+            secs = time.perf_counter() - start
+            # (Exports don't return anything, they write out every row they get)
+            if res is None:
+                rows_out = rows_in
+            else:
+                rows_out = len(res[0]) if isinstance(res, tuple) else len(res)
+            profile.stages.append(StageProfile(method.__name__, rows_in, rows_out, secs, None))
+        finally:
+            for table in tables:
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+        self.last_profile = profile
+        return res
+
+    return T.cast(F, wrapper)
+
+
 class DataKubeRelation:
-    def __init__(self, rel: DuckDBPyRelation, conn: DuckDBPyConnection, grouper: T.Optional[str]):
+    def __init__(
+        self,
+        rel: DuckDBPyRelation,
+        conn: DuckDBPyConnection,
+        grouper: T.Optional[str],
+        source: T.Optional[MetricSource] = None,
+        cache: T.Optional[ResultCache] = None,
+    ):
         self._rel = rel
         self._conn = conn
         self._grouper = grouper
 
+        # Where the results get memoized, if anywhere (see PromReader); terminal operations read from the cached result
+        self._cache = cache
+
+        # If this relation came straight from a metric (see PromReader.query_metric), the source lets us re-scan the
+        # metric with time bounds applied to the raw (millisecond) timestamp column, which is the only place DuckDB
+        # can use them to skip files and row groups.  This is only valid as long as everything we've done to the
+        # relation since is row-by-row (filters and computed columns), so we keep track of those operations and
+        # replay them on top of the re-scanned source; anything else (windows, joins, etc) drops the source.  Filters
+        # on the sample values rule out re-scanning from a rollup, since a rolled-up sample could pass a filter that
+        # the raw samples it stands for wouldn't.
+        self._source = source
+        self._row_ops: T.List[T.Callable[[DuckDBPyRelation], DuckDBPyRelation]] = []
+        self._time_bounds: T.Tuple[T.Optional[TimeBound], T.Optional[TimeBound]] = (None, None)
+        self._value_filtered = False
+
+        # If this relation reads from a materialized split (see split), this keeps the table around
+        self._temp_table: T.Optional[_TempTable] = None
+
+        # See profile()
+        self._profiler: T.Optional[StageRecorder] = None
+        self.last_profile: T.Optional[PipelineProfile] = None
+
     def copy(self) -> "DataKubeRelation":
-        return DataKubeRelation(self._rel, self._conn, self._grouper)
+        other = DataKubeRelation(self._rel, self._conn, self._grouper, self._source, self._cache)
+        other._row_ops = list(self._row_ops)
+        other._time_bounds = self._time_bounds
+        other._value_filtered = self._value_filtered
+        other._temp_table = self._temp_table
+        other._profiler = self._profiler.copy() if self._profiler is not None else None
+        return other
 
+    @_terminal
     def df(self) -> pd.DataFrame:
-        return self._rel.df()
+        return self._result_rel().df()
+
+    @_terminal
+    def delta_histogram(
+        self,
+        *,
+        nbins: int = 10,
+        lower: float = 0,
+        baseline: float = 0,
+        binning: Binning = Binning.LINEAR,
+        partition_by: T.Optional[T.List[str]] = None,
+    ) -> T.Tuple[np.ndarray, np.ndarray]:
+        # Same as the module-level delta_histogram, except the deltas are computed per-series inside DuckDB and only the
+        # bin counts come back out.  The bin edges are computed in SQL as well, so that they're guaranteed to be the
+        # same edges that were used for counting; bins are half-open except for the last one, same as np.histogram.
+        if binning == Binning.LOG:
+            lo = f"{lower}::DOUBLE" if lower > 0 else "min(delta)"
+            edge = f"exp(ln(lo) + (ln(hi) - ln(lo)) * i / {nbins})"
+        else:
+            lo = f"{lower}::DOUBLE"
+            edge = f"lo + (hi - lo) * i / {nbins}"
 
+        counts = self._conn.sql(
+            f"""
+            WITH kept AS MATERIALIZED ({self._deltas_query(baseline, partition_by)}),
+            stats AS (SELECT {lo} AS lo, max(delta) AS hi FROM kept),
+            edges AS (
+                SELECT i, IF(i = {nbins}, hi, {edge}) AS edge
+                FROM stats, range({nbins} + 1) t(i)
+            ),
+            bins AS (
+                SELECT l.i, l.edge AS lo, r.edge AS hi
+                FROM edges l JOIN edges r ON r.i = l.i + 1
+            )
+
+            SELECT b.i, any_value(b.lo), any_value(b.hi), count(k.delta)
+            FROM bins b LEFT JOIN kept k
+                ON k.delta >= b.lo AND (k.delta < b.hi OR (b.i = {nbins - 1} AND k.delta = b.hi))
+            GROUP BY b.i
+            ORDER BY b.i
+            """
+        ).fetchall()
+        if not counts or counts[-1][2] is None:
+            raise ValueError(f"no deltas greater than {baseline}")
+
+        return np.array([c for (_, _, _, c) in counts]), np.array([lo for (_, lo, _, _) in counts] + [counts[-1][2]])
+
+    @_terminal
+    def delta_quantiles(
+        self,
+        quantiles: T.Sequence[float] = (0.5, 0.9, 0.99),
+        *,
+        baseline: float = 0,
+        partition_by: T.Optional[T.List[str]] = None,
+    ) -> pd.Series:
+        res = self._conn.sql(
+            f"""
+            SELECT quantile_cont(delta, {list(quantiles)}) FROM ({self._deltas_query(baseline, partition_by)})
+            """
+        ).fetchone()
+        return pd.Series(res[0] if res else None, index=list(quantiles), dtype=float)
+
+    @_stage
     def extract_label(self, key: str, col_name: T.Optional[str] = None) -> T.Self:
         if col_name is None:
             col_name = key
-        self._rel = self._rel.select(f"*, regexp_extract(labels, '{key}=(.*?)(?:,|$)', 1) AS {col_name}")
-        return self
 
-    def fill_missing_data(self, window_size: int = 3) -> T.Self:
+        # Missing labels come back as '' rather than NULL, for consistency with the regexp version
+        if LABEL_MAP_KEY in self._rel.columns:
+            expr = f"coalesce({LABEL_MAP_KEY}['{key}'], '')"
+        else:
+            expr = f"regexp_extract({LABELS_KEY}, '(?:^|,){key}=(.*?)(?:,|$)', 1)"
+        return self._apply_row_op(lambda rel: rel.select(f"*, {expr} AS {col_name}"))
+
+    @_stage
+    def fill_missing_data(
+        self,
+        window_size: int = 3,
+        *,
+        resolution: int = 1,
+        strategy: FillStrategy = FillStrategy.LOCF,
+        max_staleness: T.Optional[int] = None,
+    ) -> T.Self:
         if not self._grouper:
             raise ValueError("Group-by field required")
 
-        self._rel = self._rel.select(
-            "time_bucket(INTERVAL '1s', timestamp) AS timestamp, * EXCLUDE (timestamp)",
-        ).query(
-            "rounded_times",
-            # We're using native SQL here instead of the relation API because it's (I think) a little
-            # clearer, and the windowing query at the end I don't *think* is possible with the relational
-            # API anyways, so I decided to just do the whole thing in SQL.  Anyways, this bit is filling
-            # in any "missing" data from the raw timeseries data:
+        # By default we'll fill gaps of up to window_size points at the given resolution; gaps longer than that are
+        # left as NULLs.  (For LOCF, this is how long a value gets carried forward; for linear interpolation, it's the
+        # longest gap between real samples that we'll interpolate across.)
+        if max_staleness is None:
+            max_staleness = window_size * resolution
+        max_staleness_us = max_staleness * 1_000_000
+
+        # The label columns are carried along with the values (if we've got the parsed version, that comes too)
+        label_cols = [LABELS_KEY] + ([LABEL_MAP_KEY] if LABEL_MAP_KEY in self._rel.columns else [])
+
+        # Only the last sample for each series in each bucket matters here, so if we can still get at the source, it
+        # can read from a rollup instead of the raw samples
+        if self._source is not None:
+            self._rel = self._rescan(resolution)
+
+        self._drop_source()
+        raw = self._as_view("raw")
+
+        if strategy == FillStrategy.LOCF:
+            fresh = f"epoch_us(g.timestamp) - epoch_us(p.timestamp) <= {max_staleness_us}"
+            value_expr = f"IF({fresh}, p.value, NULL)"
+            next_join = ""
+        else:
+            next_join = (
+                f"ASOF LEFT JOIN prev_samples n ON g.{self._grouper} = n.{self._grouper} AND g.timestamp <= n.timestamp"
+            )
+            fresh = f"epoch_us(n.timestamp) - epoch_us(p.timestamp) <= {max_staleness_us} OR g.timestamp = p.timestamp"
+            value_expr = f"""
+                CASE
+                    WHEN g.timestamp = p.timestamp THEN p.value
+                    WHEN {fresh} THEN p.value + (n.value - p.value)
+                        * (epoch_us(g.timestamp) - epoch_us(p.timestamp))
+                        / (epoch_us(n.timestamp) - epoch_us(p.timestamp))
+                END
+            """
+
+        self._rel = self._conn.sql(
+            # This bit is filling in any "missing" data from the raw timeseries data:
             #
-            # 1. First we find the minimum and maximum time values for each unique element (say, each pod)
-            # 2. Then we generate the "complete" list of timestamps between those min and max time values per element
-            # 3. We join the "complete" list of timestamps with the existing (normalized) data; we LEFT JOIN
-            #    so that any missing data points will appear with NULL values in the result
-            # 4. Lastly, we window the data and take the last not null value that we find (essentially, as long as
-            #    there's a datapoint in the window we use it).  The PARTITION BY clause ensures that the window doesn't
-            #    go outside the bounds of the partition, i.e., it doesn't use data from a different element (pod, for
-            #    example).
+            # 1. First we round the timestamps down to the requested resolution; if there's more than one sample for
+            #    an element (say, a pod) in a bucket, we keep the last one
+            # 2. Then we generate the "complete" list of timestamps between the min and max time values per element
+            # 3. Lastly, we ASOF join the complete list of timestamps against the samples, which matches up each
+            #    timestamp with the most recent sample at or before it (and, for linear interpolation, the first
+            #    sample at or after it) for the same element.  This is a lot cheaper than joining the samples onto the
+            #    complete list of timestamps and then windowing over the result to find the most recent non-NULL value,
+            #    which is what we used to do.
             f"""
-            WITH time_ranges AS (
-                SELECT min(timestamp) as mints, max(timestamp) as maxts, {self._grouper},
-                FROM rounded_times GROUP BY {self._grouper}
+            WITH samples AS (
+                SELECT
+                    time_bucket(INTERVAL '{resolution}s', timestamp) AS bucket,
+                    {self._grouper},
+                    arg_max(value, timestamp) AS value,
+                    {"".join(f"arg_max({col}, timestamp) AS {col}, " for col in label_cols)}
+                FROM {raw} GROUP BY bucket, {self._grouper}
+            ), time_ranges AS (
+                SELECT min(bucket) AS mints, max(bucket) AS maxts, {self._grouper},
+                FROM samples GROUP BY {self._grouper}
             ), all_timestamps AS (
-                SELECT unnest(generate_series(mints::timestamptz, maxts::timestamptz, INTERVAL '1s')) AS timestamp,
+                SELECT
+                    unnest(generate_series(mints::timestamptz, maxts::timestamptz, INTERVAL '{resolution}s'))
+                        AS timestamp,
                     {self._grouper},
                 FROM time_ranges
-            ), joined_timestamps AS (
-                SELECT a.timestamp, a.{self._grouper}, r.value, r.labels,
-                FROM all_timestamps a LEFT JOIN rounded_times r
-                USING (timestamp, {self._grouper})
+            ), prev_samples AS (
+                SELECT bucket AS timestamp, * EXCLUDE (bucket) FROM samples
             )
 
-            SELECT timestamp, {self._grouper},
-                last_value(value IGNORE NULLS) OVER group_window AS value,
-                last_value(labels IGNORE NULLS) OVER group_window AS labels,
-            FROM joined_timestamps
-            WINDOW group_window AS (
-                PARTITION BY {self._grouper}
-                ORDER BY timestamp
-                ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW
-            )
+            SELECT g.timestamp, g.{self._grouper},
+                {value_expr} AS value,
+                {"".join(f"IF({fresh}, p.{col}, NULL) AS {col}, " for col in label_cols)}
+            FROM all_timestamps g
+            ASOF LEFT JOIN prev_samples p ON g.{self._grouper} = p.{self._grouper} AND g.timestamp >= p.timestamp
+            {next_join}
             """,
         )
         return self
 
+    @_stage
+    def join_owners(self, owners: "DataKubeRelation") -> T.Self:
+        # Add the root owner of each pod (from PromReader.pod_owners), so that the data can be grouped by root_owner
+        keys = ["pod"] + (["namespace"] if "namespace" in self._rel.columns else [])
+        cond = " AND ".join(f"r.{key} = o.{key}" for key in keys)
+
+        # The result is only as cacheable as the owners are
+        if owners._cache is None:
+            self._cache = None
+
+        self._drop_source()
+        rel = self._as_view("owned")
+        owners_view = owners._as_view("owners")
+        self._rel = self._conn.sql(
+            f"SELECT r.*, o.root_owner_kind, o.root_owner FROM {rel} r LEFT JOIN {owners_view} o ON {cond}"
+        )
+        return self
+
+    def profile(self) -> T.Self:
+        # Turn on profiling: from here on, each chained operation is recorded, and when the relation is executed (by
+        # df(), to_pivot_table(), etc.), the recorded operations are run one at a time, materializing the output of
+        # each one before running the next so that the time and rows in/out for each stage can be measured separately.
+        # (The DuckDB EXPLAIN ANALYZE output for each stage is kept too.)  The results end up in last_profile.  Since
+        # the stages don't get fused together the way they normally would, the total is usually a bit higher than
+        # running the pipeline without profiling.
+        self._profiler = StageRecorder(self._rel)
+        return self
+
+    @_stage
     def partition_and_normalize(
         self,
-        splits: T.List[T.Tuple[Arrow, Arrow]],
+        splits: T.Union[T.List[T.Tuple["Arrow", "Arrow"]], pd.DataFrame],
         prefix: str = "sim",
     ) -> T.Self:
-        cases = "".join([
-            f"""
-            WHEN timestamp BETWEEN '{start}' AND '{end}'
-            THEN {{'{prefix}': '{prefix}.{i}', 'start': CAST('{start}' AS TIMESTAMP WITH TIME ZONE)}}
-            """
-            for i, (start, end) in enumerate(splits)
-        ])
-        self._rel = self._rel.select(f"*, CASE {cases} END AS s").select(
+        # The splits can either be a list of (start, end) tuples, or a DataFrame with start and end columns (e.g., from
+        # k8s_utils.read_pod_intervals)
+        if isinstance(splits, pd.DataFrame):
+            starts = pd.DatetimeIndex(pd.to_datetime(splits["start"], utc=True))
+            ends = pd.DatetimeIndex(pd.to_datetime(splits["end"], utc=True))
+        else:
+            starts = pd.to_datetime([start.isoformat() for (start, _) in splits], utc=True)
+            ends = pd.to_datetime([end.isoformat() for (_, end) in splits], utc=True)
+
+        # Rows outside of the overall time range covered by the splits are dropped (if we can still get at the source,
+        # this prunes the scan too); rows in the gaps between splits are kept, but don't get assigned to a partition
+        # (split, to_pivot_table, etc. ignore them)
+        if len(splits):
+            self.with_time_range(starts.min(), ends.max())
+
+        # The splits go into their own (small) table, and each row gets matched up with the latest split that started
+        # at or before it using an ASOF join; rows that fall after the end of that split don't belong to any partition.
+        # This assumes the splits don't overlap (if they do, rows in the overlap get assigned to the later split).
+        # The table name is derived from its contents so that the same splits always produce the same query.  (Also,
+        # subtracting the timestamps directly is _very_ slow, because DuckDB does calendar arithmetic on them, so we
+        # compute the normalized timestamp from the raw microseconds instead.)
+        splits_df = pd.DataFrame({
+            prefix: [f"{prefix}.{i}" for i in range(len(starts))],
+            "start": starts,
+            "split_end": ends,
+        })
+        splits_table = f"_splits_{_query_hash(splits_df.to_json())}"
+        self._conn.register(splits_table, splits_df)
+
+        self._drop_source()
+        unpartitioned = self._as_view("unpartitioned")
+        self._rel = self._conn.sql(
             f"""
-            *,
-            s.{prefix} AS {prefix},
-            s.start AS start,
-            timestamp - start AS {NORM_TS_KEY},
-            """
+            SELECT u.*,
+                IF(u.timestamp <= s.split_end, s.{prefix}, NULL) AS {prefix},
+                IF(u.timestamp <= s.split_end, s.start, NULL) AS start,
+                IF(
+                    u.timestamp <= s.split_end,
+                    to_microseconds(epoch_us(u.timestamp) - epoch_us(s.start)),
+                    NULL
+                ) AS {NORM_TS_KEY},
+            FROM {unpartitioned} u ASOF LEFT JOIN {splits_table} s ON u.timestamp >= s.start
+            """,
         )
         return self
 
-    def rate(self, rate_secs: int) -> T.Self:
-        self._rel = self._rel.query(
-            "total",
+    @_stage
+    def increase(self, range_secs: int, partition_by: T.Optional[T.List[str]] = None) -> T.Self:
+        return self._extrapolated_delta("increase", range_secs, partition_by)
+
+    @_stage
+    def irate(self, range_secs: int, partition_by: T.Optional[T.List[str]] = None) -> T.Self:
+        # Like Prometheus' irate, this only looks at the last two samples, as long as they're both within the range
+        part = ", ".join(self._series_cols(partition_by))
+        self._drop_source()
+        src = self._as_view("irate")
+        self._rel = self._conn.sql(
             f"""
-            SELECT *,
-                last_value(value) OVER rate_window AS last,
-                first_value(value) OVER rate_window AS first,
-                IF(last >= first, last - first, last) / {rate_secs} AS rate
-            FROM total
-            WINDOW rate_window AS (
-                PARTITION BY sim
-                ORDER BY timestamp
-                ROWS BETWEEN {rate_secs} PRECEDING AND CURRENT ROW
+            WITH pairs AS (
+                SELECT *,
+                    lag(value) OVER series AS _prev_value,
+                    (epoch_us(timestamp) - epoch_us(lag(timestamp) OVER series)) / 1e6 AS _gap,
+                FROM {src} WHERE value IS NOT NULL
+                WINDOW series AS (PARTITION BY {part} ORDER BY timestamp)
             )
-        """,
+
+            SELECT * EXCLUDE (_prev_value, _gap),
+                IF(_gap <= {range_secs}, IF(value < _prev_value, value, value - _prev_value) / _gap, NULL) AS irate,
+            FROM pairs
+            """
         )
         return self
 
-    def split(self, on: str = "sim") -> T.Mapping[str, "DataKubeRelation"]:
-        return {
-            value[0]: DataKubeRelation(self._rel.filter(f"{on}='{value[0]}'"), self._conn, self._grouper)
-            for value in self._rel.filter(f"{on} IS NOT NULL").unique(on).sort(on).fetchall()
-        }
+    def iter_batches(self, batch_size: int = DEFAULT_BATCH_SIZE) -> T.Iterator["pa.RecordBatch"]:
+        # Stream the results out as Arrow record batches of (at most) batch_size rows, so that the whole result never
+        # has to fit in memory at once.  This doesn't go through the result cache, since that would mean storing the
+        # entire result first.  The batches come from a separate query over the pipeline, so the relation can still be
+        # used afterwards, but DuckDB can only stream one result per connection at a time: running anything else on
+        # the same connection before the iteration is finished makes it fail.
+        export = self._as_view("export")
+        yield from self._conn.sql(f"SELECT * FROM {export}").record_batch(batch_size)
+
+    def iter_dfs(self, chunk_size: int = DEFAULT_BATCH_SIZE) -> T.Iterator[pd.DataFrame]:
+        # Same as iter_batches, except each batch is converted to a DataFrame
+        for batch in self.iter_batches(chunk_size):
+            yield batch.to_pandas()
+
+    @_stage
+    def rate(self, rate_secs: int, partition_by: T.Optional[T.List[str]] = None) -> T.Self:
+        return self._extrapolated_delta("rate", rate_secs, partition_by)
+
+    def split(self, on: str = "sim", materialize: bool = False) -> T.Mapping[str, "DataKubeRelation"]:
+        rel = self._rel
+        temp_table = None
+        if materialize:
+            # Each of the split relations is lazy, so without this, using all of them re-runs the entire upstream
+            # pipeline once per partition.  Instead we run it once into a temp table, sorted by the partition column
+            # so that the per-partition filters can skip straight to their rows using the zone maps.  The table name
+            # comes from the query, so re-splitting the same pipeline replaces the old table instead of piling up, and
+            # the table gets dropped once none of the relations that read from it are left.
+            upstream = self._as_view("upstream")
+            table = f"_split_{_query_hash(f'{on}:{upstream}')}"
+            self._conn.execute(
+                f"CREATE OR REPLACE TEMP TABLE {table} AS SELECT * FROM {upstream} WHERE {on} IS NOT NULL ORDER BY {on}"
+            )
+            self._conn.unregister(upstream)
+            temp_table = _TempTable.get(self._conn, table)
+            rel = self._conn.table(table)
+
+        splits = {}
+        for (value,) in rel.filter(f"{on} IS NOT NULL").unique(on).sort(on).fetchall():
+            splits[value] = DataKubeRelation(
+                rel.filter(f"{on}='{value}'"), self._conn, self._grouper, cache=self._cache
+            )
+            splits[value]._temp_table = temp_table
+        return splits
+
+    @_terminal
+    def to_arrow(self) -> "pa.Table":
+        return self._result_rel().arrow()
+
+    @_terminal
+    def to_parquet(
+        self,
+        path: str,
+        *,
+        compression: str = "zstd",
+        row_group_size: T.Optional[int] = None,
+        partition_by: T.Optional[T.List[str]] = None,
+    ) -> None:
+        # DuckDB streams the results straight into the file(s) (out of the memoized result, if there is one); with
+        # partition_by, path is a directory that gets one (hive-style) subdirectory per partition
+        self._result_rel().write_parquet(
+            path, compression=compression, row_group_size=row_group_size, partition_by=partition_by
+        )
 
+    @_terminal
     def to_pivot_table(
         self,
         pivot_column: str = "sim",
@@ -139,57 +506,356 @@ class DataKubeRelation:
         aggfunc: str = "sum",
         max_time: T.Optional[timedelta] = None,
         fill_value: T.Optional[float] = 0.0,
+        resolution: int = 1,
     ) -> pd.DataFrame:
-        if max_time is None:
-            max_time = self._rel.max(NORM_TS_KEY).fetchone()[0]
-        self._rel.create_view("to_pivot")
+        # Everything happens in DuckDB: the pivot, the dense grid of (integer) seconds that we join it onto, and
+        # filling in the gaps; the normalized timestamps are converted to float seconds before they leave the engine,
+        # so the only thing pandas has to do is set the index.  The pivot values need to be listed explicitly to use
+        # the PIVOT as a subquery, so we look them up first.  Rows that didn't land in a partition are dropped.  With a
+        # coarser resolution, the grid has one row every resolution seconds, and each series contributes its last
+        # value in each bucket (this goes well with fill_missing_data at the same resolution, and makes for a much
+        # smaller table to plot).
+        rel = self._result_rel()
+        pivot_rel = rel.filter(f"{pivot_column} IS NOT NULL")
+        pivot_values = [v for (v,) in pivot_rel.unique(pivot_column).sort(pivot_column).fetchall()]
+        if not pivot_values:
+            raise ValueError(f"no rows with a {pivot_column} to pivot on")
+        max_secs = _max_secs(rel, pivot_column, max_time)
+        to_pivot_rows = self._normalized_rows(rel, pivot_column, value_column, resolution)
 
-        all_normalized_times = pd.DataFrame(
-            index=[timedelta(seconds=i) for i in range(0, int(max_time.total_seconds()))],
+        pivot_in = ", ".join(f"'{v}'" for v in pivot_values)
+        fill = f"COLUMNS(p.* EXCLUDE ({NORM_TS_KEY}))"
+        if fill_value is not None:
+            fill = f"COALESCE({fill}, {fill_value})"
+        df = (
+            self._conn.sql(
+                f"""
+                WITH pivoted AS (
+                    PIVOT ({to_pivot_rows})
+                    ON {pivot_column} IN ({pivot_in}) USING {aggfunc}({value_column})
+                    GROUP BY {NORM_TS_KEY}
+                )
+
+                SELECT g.{NORM_TS_KEY}, {fill}
+                FROM (SELECT range::DOUBLE AS {NORM_TS_KEY} FROM range(0, {int(max_secs)}, {resolution})) g
+                LEFT JOIN pivoted p USING ({NORM_TS_KEY})
+                ORDER BY {NORM_TS_KEY}
+                """
+            )
+            .arrow()
+            .to_pandas()
+            .set_index(NORM_TS_KEY)
         )
-        all_normalized_times.index.name = NORM_TS_KEY
 
+        return df
+
+    @_terminal
+    def to_summary_table(
+        self,
+        quantiles: T.Sequence[float] = (0.5, 0.9, 0.99),
+        pivot_column: str = "sim",
+        value_column: str = "value",
+        aggfunc: str = "sum",
+        max_time: T.Optional[timedelta] = None,
+        fill_value: T.Optional[float] = 0.0,
+        resolution: int = 1,
+    ) -> pd.DataFrame:
+        # The distribution of the pivot table (see to_pivot_table) across its columns, instead of the columns
+        # themselves: for each normalized timestamp, the mean and (sample) standard deviation across the pivot values,
+        # plus the given quantiles (as p50, p90, etc).  This is the same as calling mean(axis=1), std(axis=1), etc, on
+        # the pivot table, except that it's all computed in DuckDB, so only a handful of columns come back no matter
+        # how many simulations there are.  Plot it with plot_utils.plot_multiseries(band=True).
+        rel = self._result_rel()
+        max_secs = _max_secs(rel, pivot_column, max_time)
+        to_summarize = self._normalized_rows(rel, pivot_column, value_column, resolution)
+
+        cell = f"p.{value_column}" if fill_value is None else f"COALESCE(p.{value_column}, {fill_value})"
+        quantile_cols = "".join(f'_q[{i + 1}] AS "p{100 * q:g}", ' for (i, q) in enumerate(quantiles))
         df = (
-            self._conn.query(
+            self._conn.sql(
                 f"""
-                PIVOT to_pivot ON {pivot_column} USING {aggfunc}({value_column})
-                GROUP BY {NORM_TS_KEY} ORDER BY {NORM_TS_KEY}
+                WITH normalized AS ({to_summarize}),
+                per_pivot AS (
+                    SELECT {NORM_TS_KEY}, {pivot_column}, {aggfunc}({value_column}) AS {value_column}
+                    FROM normalized GROUP BY ALL
+                ), cells AS (
+                    SELECT g.{NORM_TS_KEY}, ({cell})::DOUBLE AS value
+                    FROM (SELECT range::DOUBLE AS {NORM_TS_KEY} FROM range(0, {int(max_secs)}, {resolution})) g
+                    CROSS JOIN (SELECT DISTINCT {pivot_column} FROM normalized) s
+                    LEFT JOIN per_pivot p ON p.{NORM_TS_KEY} = g.{NORM_TS_KEY} AND p.{pivot_column} = s.{pivot_column}
+                ), summary AS (
+                    SELECT {NORM_TS_KEY}, avg(value) AS mean, stddev_samp(value) AS stddev,
+                        quantile_cont(value, {[float(q) for q in quantiles]}) AS _q,
+                    FROM cells GROUP BY {NORM_TS_KEY}
+                )
+
+                SELECT {NORM_TS_KEY}, mean, stddev, {quantile_cols}
+                FROM summary
+                ORDER BY {NORM_TS_KEY}
                 """
             )
-            .df()
+            .arrow()
+            .to_pandas()
             .set_index(NORM_TS_KEY)
-            .join(all_normalized_times, how="right")
         )
-        df.index = df.index.map(lambda td: td.total_seconds())
-        if fill_value is not None:
-            df = df.fillna(fill_value)
 
         return df
 
+    @_stage
     def unique(self, extra_cols: T.List[str] = list()) -> T.Self:
+        self._drop_source()
         self._rel = self._rel.select(f"DISTINCT {self._grouper}, {','.join(extra_cols)}")
         return self
 
+    @_stage
     def with_any_container(self) -> T.Self:
-        self._rel = self._rel.filter("container != ''")
-        return self
+        return self._apply_row_op(lambda rel: rel.filter("container != ''"))
 
+    @_stage
     def with_label(self, key: str, value: str) -> T.Self:
-        self._rel = self._rel.filter(f"labels LIKE '%{key}={value}%'")
-        return self
+        if LABEL_MAP_KEY in self._rel.columns:
+            pred = f"{LABEL_MAP_KEY}['{key}'] = '{value}'"
+        else:
+            pred = f"regexp_matches({LABELS_KEY}, '(?:^|,){key}={value}(?:,|$)')"
+        return self._apply_row_op(lambda rel: rel.filter(pred))
 
+    @_stage
     def with_pod_prefix(self, prefix: str) -> T.Self:
-        self._rel = self._rel.filter(f"pod LIKE '{prefix}%'")
-        return self
+        return self._apply_row_op(lambda rel: rel.filter(f"pod LIKE '{prefix}%'"))
 
+    @_stage
     def with_namespace(self, ns: str) -> T.Self:
-        self._rel = self._rel.filter(f"namespace='{ns}'")
+        return self._apply_row_op(lambda rel: rel.filter(f"namespace='{ns}'"))
+
+    @_stage
+    def with_time_range(self, start: T.Optional[TimeBound] = None, end: T.Optional[TimeBound] = None) -> T.Self:
+        (cur_start, cur_end) = self._time_bounds
+        if start is None or (cur_start is not None and cur_start > start):
+            start = cur_start
+        if end is None or (cur_end is not None and cur_end < end):
+            end = cur_end
+        self._time_bounds = (start, end)
+
+        if self._source is not None:
+            self._rel = self._rescan()
+        else:
+            if start is not None:
+                self._rel = self._rel.filter(f"timestamp >= '{start}'")
+            if end is not None:
+                self._rel = self._rel.filter(f"timestamp <= '{end}'")
         return self
 
+    @_stage
     def with_value(self, val: float, cmp: Comparison = Comparison.EQ) -> T.Self:
-        self._rel = self._rel.filter(f"value {cmp.value} {val}")
+        self._value_filtered = True
+        return self._apply_row_op(lambda rel: rel.filter(f"value {cmp.value} {val}"))
+
+    def _apply_row_op(self, op: T.Callable[[DuckDBPyRelation], DuckDBPyRelation]) -> T.Self:
+        self._rel = op(self._rel)
+        if self._source is not None:
+            self._row_ops.append(op)
         return self
 
+    def _rescan(self, resolution: T.Optional[int] = None) -> DuckDBPyRelation:
+        # Re-scan the source with the current time bounds (at the given resolution, if that's allowed) and replay the
+        # row-by-row operations on top; only valid while we still have the source
+        assert self._source is not None
+        if self._value_filtered:
+            resolution = None
+        rel = self._source(*self._time_bounds, resolution)
+        for op in self._row_ops:
+            rel = op(rel)
+        return rel
+
+    def _extrapolated_delta(self, col: str, range_secs: int, partition_by: T.Optional[T.List[str]]) -> T.Self:
+        # This computes Prometheus-style increase() and rate() over a sliding time window ending at each sample, which
+        # works directly on the raw (sparse, irregular) samples.  The steps are:
+        #
+        # 1. Counter resets can happen anywhere, so we first build a "corrected" counter for each series: every time
+        #    the value goes down, we add the value from just before the reset to everything after it.  The increase
+        #    over any window is then just the difference between the corrected counter at its endpoints.
+        # 2. Then we compute the window aggregates using a RANGE (time-based) window, instead of a fixed number of rows.
+        # 3. Lastly, just like Prometheus, we extrapolate the increase out to the start of the window (the window
+        #    always ends at a sample, so there's nothing to do on that side).  We extrapolate all the way to the start
+        #    if the first sample is close enough to it (within 1.1x the average gap between samples), and otherwise
+        #    only half an average gap; we also never extrapolate back past the point where the counter would be zero.
+        part = ", ".join(self._series_cols(partition_by))
+        factor = f"/ {range_secs}" if col == "rate" else ""
+
+        self._drop_source()
+        src = self._as_view(col)
+        self._rel = self._conn.sql(
+            f"""
+            WITH resets AS (
+                SELECT *, lag(value) OVER series AS _prev_value,
+                FROM {src} WHERE value IS NOT NULL
+                WINDOW series AS (PARTITION BY {part} ORDER BY timestamp)
+            ), corrected AS (
+                SELECT * EXCLUDE (_prev_value),
+                    value + sum(IF(value < _prev_value, _prev_value, 0)) OVER series AS _counter,
+                FROM resets
+                WINDOW series AS (PARTITION BY {part} ORDER BY timestamp ROWS UNBOUNDED PRECEDING)
+            ), windowed AS (
+                SELECT *,
+                    _counter - first_value(_counter) OVER range_window AS _delta,
+                    first_value(value) OVER range_window AS _first_value,
+                    (epoch_us(timestamp) - first_value(epoch_us(timestamp)) OVER range_window) / 1e6 AS _sampled,
+                    count(*) OVER range_window AS _count,
+                FROM corrected
+                WINDOW range_window AS (
+                    PARTITION BY {part}
+                    ORDER BY timestamp
+                    RANGE BETWEEN INTERVAL '{range_secs}s' PRECEDING AND CURRENT ROW
+                )
+            ), extrapolated AS (
+                SELECT *,
+                    _sampled / (_count - 1) AS _avg_gap,
+                    least(
+                        {range_secs} - _sampled,
+                        IF(_delta > 0 AND _first_value >= 0, _sampled * _first_value / _delta, 'infinity'::DOUBLE)
+                    ) AS _to_start,
+                FROM windowed
+            )
+
+            SELECT * EXCLUDE (_counter, _delta, _first_value, _sampled, _count, _avg_gap, _to_start),
+                IF(
+                    _count < 2 OR _sampled = 0,
+                    NULL,
+                    _delta * (_sampled + IF(_to_start < _avg_gap * 1.1, _to_start, _avg_gap / 2)) / _sampled {factor}
+                ) AS {col},
+            FROM extrapolated
+            """
+        )
+        return self
+
+    def _deltas_query(self, baseline: float, partition_by: T.Optional[T.List[str]]) -> str:
+        # Per-series sample-to-sample deltas, with counter resets treated as zero (like counter_diff)
+        part = ", ".join(self._series_cols(partition_by))
+        return f"""
+            SELECT delta FROM (
+                SELECT greatest(value - lag(value) OVER (PARTITION BY {part} ORDER BY timestamp), 0) AS delta
+                FROM {self._as_view("deltas", self._result_rel())}
+            ) WHERE delta > {baseline}
+        """
+
+    def _normalized_rows(self, rel: DuckDBPyRelation, pivot_column: str, value_column: str, resolution: int) -> str:
+        # The (normalized timestamp in seconds, pivot value, value) rows that go into a pivot or summary table; rows
+        # that didn't land in a partition are dropped.  With a coarser resolution, each series only contributes its last
+        # value in each bucket.
+        to_pivot = self._as_view("to_pivot", rel)
+        if resolution <= 1:
+            return f"""
+                SELECT epoch({NORM_TS_KEY}) AS {NORM_TS_KEY}, {pivot_column}, {value_column}
+                FROM {to_pivot} WHERE {pivot_column} IS NOT NULL
+            """
+
+        series = ", ".join([col for col in (self._grouper,) if col and col in rel.columns] + [pivot_column])
+        return f"""
+            SELECT {NORM_TS_KEY}, {pivot_column}, {value_column} FROM (
+                SELECT floor(epoch({NORM_TS_KEY}) / {resolution}) * {resolution} AS {NORM_TS_KEY}, {series},
+                    arg_max({value_column}, {NORM_TS_KEY}) AS {value_column},
+                FROM {to_pivot} WHERE {pivot_column} IS NOT NULL
+                GROUP BY ALL
+            )
+        """
+
+    def _series_cols(self, partition_by: T.Optional[T.List[str]]) -> T.List[str]:
+        # By default, each series is identified by the group-by field plus the partition (if there is one)
+        if partition_by is not None:
+            return partition_by
+        cols = [col for col in (self._grouper, "sim") if col and col in self._rel.columns]
+        if not cols:
+            raise ValueError("Group-by field required")
+        return cols
+
+    def _run_profile(self) -> T.Tuple["DataKubeRelation", PipelineProfile, T.List[str]]:
+        assert self._profiler is not None
+        profile = PipelineProfile()
+        tables: T.List[str] = []
+
+        def run_stage(name: str, rel: DuckDBPyRelation, rows_in: T.Optional[int]) -> int:
+            table = f"_profile_{len(tables)}_{_query_hash(rel.sql_query())}"
+            view = f"{table}_input"
+            self._conn.register(view, rel)
+            start = time.perf_counter()
+            explain = self._conn.sql(
+                f"EXPLAIN ANALYZE CREATE OR REPLACE TEMP TABLE {table} AS SELECT * FROM {view}"
+            ).fetchall()[0][1]
+            secs = time.perf_counter() - start
+            self._conn.unregister(view)
+
+            tables.append(table)
+            rows_out = self._conn.table(table).count("*").fetchone()[0]  # type: ignore
+            profile.stages.append(StageProfile(name, rows_in, rows_out, secs, explain))
+            return rows_out
+
+        rows = run_stage(self._profiler.scan_name, self._profiler.scan, None)
+        for op in self._profiler.ops:
+            (name, args, kwargs) = op
+            stage = DataKubeRelation(self._conn.table(tables[-1]), self._conn, self._grouper)
+            getattr(stage, name)(*args, **kwargs)
+            rows = run_stage(describe_op(op), stage._rel, rows)
+
+        return DataKubeRelation(self._conn.table(tables[-1]), self._conn, self._grouper), profile, tables
+
+    def _as_view(self, name: str, rel: T.Optional[DuckDBPyRelation] = None) -> str:
+        # Register the current relation as a (temporary) view so that we can use it in raw SQL.  DuckDB looks views up
+        # by name when a query runs, not when it's built, so two relations on the same connection can't share a view
+        # name without stepping on each other; naming the view after the query that defines it keeps the names unique
+        # (and stable, so the same pipeline always generates the same SQL).
+        if rel is None:
+            rel = self._rel
+        view = f"_{name}_{_query_hash(normalize_sql(rel.sql_query()))}"
+        self._conn.register(view, rel)
+        return view
+
+    def _result_rel(self) -> DuckDBPyRelation:
+        return self._cache.fetch(self._rel) if self._cache is not None else self._rel
+
+    def _drop_source(self) -> None:
+        if self._source is not None and self._profiler is not None:
+            self._profiler.rescan(self._rel)
+        self._source = None
+        self._row_ops = []
+
+
+class _TempTable:
+    # A handle on a temp table that drops the table once the last reference to the handle goes away; there's only
+    # ever one handle per table, so re-creating a table that's still in use just shares the existing handle
+    _live: "weakref.WeakValueDictionary[T.Tuple[int, str], _TempTable]" = weakref.WeakValueDictionary()
+
+    def __init__(self, conn: DuckDBPyConnection, name: str) -> None:
+        self.name = name
+        finalizer = weakref.finalize(self, _drop_temp_table, conn, name)
+        finalizer.atexit = False
+
+    @classmethod
+    def get(cls, conn: DuckDBPyConnection, name: str) -> "_TempTable":
+        key = (id(conn), name)
+        handle = cls._live.get(key)
+        if handle is None:
+            handle = cls._live[key] = cls(conn, name)
+        return handle
+
+
+def _drop_temp_table(conn: DuckDBPyConnection, name: str) -> None:
+    # (The connection might have been closed already, in which case the table is gone anyway)
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {name}")
+    except duckdb.Error:
+        pass
+
+
+def _max_secs(rel: DuckDBPyRelation, pivot_column: str, max_time: T.Optional[timedelta]) -> float:
+    # How far the grid of normalized timestamps goes, if we weren't told
+    if max_time is not None:
+        return max_time.total_seconds()
+    return rel.filter(f"{pivot_column} IS NOT NULL").aggregate(f"max(epoch({NORM_TS_KEY}))").fetchone()[0]  # type: ignore
+
+
+def _query_hash(query: str) -> str:
+    return hashlib.sha1(query.encode()).hexdigest()[:16]
+
 
 def counter_diff(df: pd.DataFrame) -> pd.DataFrame:
     # If the counter resets, we get a negative value, and then the diffs from then on are the same.
@@ -207,19 +873,34 @@ def delta_histogram(
     nbins: int = 10,
     lower: float = 0,
     baseline: float = 0,
+    binning: Binning = Binning.LINEAR,
 ) -> T.Tuple[np.ndarray, np.ndarray]:
-    deltas = counter_diff(df)
-    all_non_zero_deltas = T.cast(
-        pd.Series,
-        pd.concat(
-            [deltas.loc[deltas[col] > baseline, col] for col in deltas],  # type: ignore
-            ignore_index=True,
-        ),
-    )
-    sorted_non_zero_deltas = all_non_zero_deltas.sort_values()
-
-    # We sorted them so the biggest value is at the end
-    dmax = sorted_non_zero_deltas.iloc[-1]
-    bins = [rg[0] for rg in pd.interval_range(0, dmax, nbins).to_tuples()] + [dmax]
-
-    return np.histogram(sorted_non_zero_deltas, bins=bins)
+    deltas = _counter_deltas(df, baseline)
+    if not len(deltas):
+        raise ValueError(f"no deltas greater than {baseline}")
+
+    dmax = deltas.max()
+    if binning == Binning.LOG:
+        bins = np.geomspace(lower if lower > 0 else deltas.min(), dmax, nbins + 1)
+    else:
+        bins = np.linspace(lower, dmax, nbins + 1)
+
+    return np.histogram(deltas, bins=bins)
+
+
+def delta_quantiles(
+    df: pd.DataFrame,
+    quantiles: T.Sequence[float] = (0.5, 0.9, 0.99),
+    *,
+    baseline: float = 0,
+) -> pd.Series:
+    deltas = _counter_deltas(df, baseline)
+    return pd.Series(np.quantile(deltas, quantiles) if len(deltas) else np.nan, index=list(quantiles), dtype=float)
+
+
+def _counter_deltas(df: pd.DataFrame, baseline: float) -> np.ndarray:
+    # This is counter_diff, but on the underlying 2D array so we don't have to copy each column out separately; NaNs
+    # (including the first row) compare false, so they get dropped along with everything else at or below baseline.
+    deltas = np.diff(df.to_numpy(dtype=float), axis=0)
+    deltas[deltas < 0] = 0
+    return deltas[deltas > baseline]
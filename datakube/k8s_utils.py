@@ -1,10 +1,17 @@
 import typing as T
 
 import arrow
+import numpy as np
+import pandas as pd
 import simplejson as json
 from kubernetes.client import V1PodList
 from kubernetes.client.api_client import ApiClient
 
+from datakube.constants import NORM_TS_KEY
+
+# Either the output of fetch_pod_intervals or of read_pod_intervals (anything with start and end columns, really)
+Intervals = T.Union[T.Sequence[T.Tuple[arrow.Arrow, arrow.Arrow]], pd.DataFrame]
+
 
 def read_obj_from_json(filename: str, klass: str) -> T.Any:
     with open(filename, encoding="utf-8") as f:
@@ -24,10 +31,12 @@ def fetch_pod_intervals(pods: V1PodList) -> T.List[T.Tuple[arrow.Arrow, arrow.Ar
         for cstat in pod.status.container_statuses:
             assert cstat.state
             assert cstat.state.terminated
+            assert cstat.state.terminated.started_at
+            assert cstat.state.terminated.finished_at
 
             if start is None or cstat.state.terminated.started_at < start:
                 start = cstat.state.terminated.started_at
-            if end is None or cstat.state.finished_at > end:
+            if end is None or cstat.state.terminated.finished_at > end:
                 end = cstat.state.terminated.finished_at
 
         assert start
@@ -36,3 +45,208 @@ def fetch_pod_intervals(pods: V1PodList) -> T.List[T.Tuple[arrow.Arrow, arrow.Ar
         intervals.append((arrow.get(start), arrow.get(end)))
 
     return sorted(intervals)
+
+
+def read_pod_intervals(filename: str, per_container: bool = False, chunk_size: int = 1 << 20) -> pd.DataFrame:
+    # This is a streaming version of read_obj_from_json + fetch_pod_intervals for (large) pod list dumps: instead of
+    # loading the whole file and building V1Pod objects for everything, we read the file a chunk at a time, decode one
+    # pod at a time, and only hang on to the names and container start/end times.  The result is a DataFrame with
+    # (pod, start, end) columns (plus container, if per_container is set), sorted by start time, which can be passed
+    # directly to DataKubeRelation.partition_and_normalize.  Unlike fetch_pod_intervals, containers that haven't
+    # terminated are skipped instead of blowing up, as are pods with no terminated containers.
+    pods: T.List[str] = []
+    containers: T.List[str] = []
+    starts: T.List[str] = []
+    ends: T.List[str] = []
+
+    for pod in _stream_items(filename, chunk_size):
+        name = pod.get("metadata", {}).get("name", "")
+        times = [
+            (cstat.get("name", ""), term["startedAt"], term["finishedAt"])
+            for cstat in pod.get("status", {}).get("containerStatuses") or []
+            if (term := cstat.get("state", {}).get("terminated"))
+        ]
+        if not times:
+            continue
+
+        if per_container:
+            for container, start, end in times:
+                pods.append(name)
+                containers.append(container)
+                starts.append(start)
+                ends.append(end)
+        else:
+            pods.append(name)
+            # RFC 3339 timestamps in UTC sort lexicographically, so we don't have to parse them here
+            starts.append(min(start for (_, start, _) in times))
+            ends.append(max(end for (_, _, end) in times))
+
+    df = pd.DataFrame({"pod": pods})
+    if per_container:
+        df["container"] = containers
+    df["start"] = pd.to_datetime(starts, utc=True)
+    df["end"] = pd.to_datetime(ends, utc=True)
+    return df.sort_values("start", ignore_index=True)
+
+
+def concurrency_timeline(intervals: Intervals, resolution: float = 1) -> pd.DataFrame:
+    # How many of the intervals (pods, or containers if they came from read_pod_intervals with per_container set) are
+    # running at each point on a grid with the given resolution (in seconds), starting from the first start time:
+    # "running" is the number running at the grid point itself, and "peak" is the most that were running at any
+    # moment before the next grid point, so that pods that come and go in between still show up.  Intervals are
+    # half-open, so a pod that finishes at the same moment that another one starts doesn't overlap with it.  This is a
+    # sweep over the sorted start and end times, so it's O(n log n) in the number of intervals.  The result is indexed
+    # by seconds since the first start, like the output of DataKubeRelation.to_pivot_table, so it can go straight into
+    # plot_utils.plot_multiseries.
+    (starts, ends) = _interval_ns(intervals)
+    if not len(starts):
+        return pd.DataFrame({"running": [], "peak": []}, index=pd.Index([], name=NORM_TS_KEY), dtype=int)
+
+    step = round(resolution * 1e9)
+    grid = np.arange(starts[0], ends.max() + 1, step)
+    running = np.searchsorted(starts, grid, "right") - np.searchsorted(ends, grid, "right")
+
+    (times, levels) = _sweep(starts, ends)
+    buckets = (times - starts[0]) // step
+    firsts = np.flatnonzero(np.diff(buckets, prepend=-1))
+    peak = running.copy()
+    peak[buckets[firsts]] = np.maximum(peak[buckets[firsts]], np.maximum.reduceat(levels, firsts))
+
+    return pd.DataFrame(
+        {"running": running, "peak": peak},
+        index=pd.Index((grid - starts[0]) / 1e9, name=NORM_TS_KEY),
+    )
+
+
+def window_overlaps(intervals: Intervals, windows: Intervals, prefix: str = "sim") -> pd.DataFrame:
+    # For each window (e.g., the splits passed to DataKubeRelation.partition_and_normalize, which is where the names
+    # come from), the number of intervals that overlap it, the total time they spent running inside it (in seconds),
+    # and the average and peak number running over the course of the window.  The running time is the integral of
+    # the concurrency over the window, which we get from prefix sums over the sorted start and end times, so this is
+    # O((n + m) log n) for n intervals and m windows, no matter how much the windows and intervals overlap.
+    (starts, ends) = _interval_ns(intervals)
+    (win_starts, win_ends) = _interval_ns(windows, sort=False)
+
+    # Everything is in seconds from here on (relative to the first window, so that the sums don't lose precision)
+    origin = win_starts.min() if len(win_starts) else 0
+    (starts_s, ends_s, lo, hi) = ((x - origin) / 1e9 for x in (starts, ends, win_starts, win_ends))
+    running_secs = _time_started(starts_s, lo, hi) - _time_started(ends_s, lo, hi)
+    length = hi - lo
+
+    return pd.DataFrame(
+        {
+            "start": pd.to_datetime(win_starts, utc=True),
+            "end": pd.to_datetime(win_ends, utc=True),
+            "overlapping": np.searchsorted(starts_s, hi, "left") - np.searchsorted(ends_s, lo, "right"),
+            "running_secs": running_secs,
+            "mean_running": np.divide(running_secs, length, out=np.zeros_like(length), where=length > 0),
+            "peak_running": _peak_running(starts_s, ends_s, lo, hi),
+        },
+        index=pd.Index([f"{prefix}.{i}" for i in range(len(lo))], name=prefix),
+    )
+
+
+def _interval_ns(intervals: Intervals, sort: bool = True) -> T.Tuple[np.ndarray, np.ndarray]:
+    # The start and end times as epoch nanoseconds, each sorted separately (unless sort is False)
+    bounds: T.Tuple[T.Any, T.Any]
+    if isinstance(intervals, pd.DataFrame):
+        bounds = (intervals["start"], intervals["end"])
+    else:
+        bounds = ([start.isoformat() for (start, _) in intervals], [end.isoformat() for (_, end) in intervals])
+    (start_ns, end_ns) = (
+        pd.DatetimeIndex(pd.to_datetime(x, utc=True)).tz_convert(None).to_numpy("datetime64[ns]").astype(np.int64)
+        for x in bounds
+    )
+    return (np.sort(start_ns), np.sort(end_ns)) if sort else (start_ns, end_ns)
+
+
+def _peak_running(starts: np.ndarray, ends: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    # The peak is either what's running at the start of the window, or the level after some start or end inside it;
+    # reduceat over the interleaved (first, last) event indices gives the max over each window's events
+    if not len(starts):
+        return np.zeros(len(lo), dtype=int)
+    (times, levels) = _sweep(starts, ends)
+    at_start = np.searchsorted(starts, lo, "right") - np.searchsorted(ends, lo, "right")
+    (first, last) = (np.searchsorted(times, lo, "right"), np.searchsorted(times, hi, "left"))
+    inside = np.maximum.reduceat(np.append(levels, 0), np.ravel(np.column_stack([first, last])))[::2]
+    return np.maximum(at_start, np.where(first < last, inside, 0))
+
+
+def _sweep(starts: np.ndarray, ends: np.ndarray) -> T.Tuple[np.ndarray, np.ndarray]:
+    # Every distinct time that something starts or ends, in order, along with the number of intervals running right
+    # after it (the levels in between starts and ends that happen at the same time aren't real, so they're dropped)
+    times = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones(len(starts), dtype=int), -np.ones(len(ends), dtype=int)])
+    order = np.argsort(times, kind="stable")
+    (times, levels) = (times[order], np.cumsum(deltas[order]))
+    last = np.append(times[1:] != times[:-1], True)
+    return times[last], levels[last]
+
+
+def _time_started(xs: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    # The integral over each window of the number of (sorted) xs at or before t
+    sums = np.concatenate([[0], np.cumsum(xs)])
+    (before, inside) = (np.searchsorted(xs, lo, "right"), np.searchsorted(xs, hi, "right"))
+    return before * (hi - lo) + (inside - before) * hi - (sums[inside] - sums[before])
+
+
+def _stream_items(filename: str, chunk_size: int) -> T.Iterator[T.Dict[str, T.Any]]:
+    # Walk the top-level object key by key; everything except the "items" list gets decoded (and thrown away) whole,
+    # while the items are decoded and yielded one at a time.  Whenever a value runs past the end of what we've read so
+    # far, we read another chunk and try again.
+    decoder = json.JSONDecoder()
+    with open(filename, encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def skip(chars: str) -> None:
+            nonlocal buf, pos, eof
+            while True:
+                while pos < len(buf) and buf[pos] in chars:
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+
+        def decode() -> T.Any:
+            nonlocal buf, pos, eof
+            while True:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                    # A number at the very end of the buffer might be cut off, so make sure something comes after it
+                    if end < len(buf) or eof:
+                        pos = end
+                        return obj
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+
+        def expect(char: str) -> None:
+            nonlocal pos
+            skip(" \t\r\n")
+            if buf[pos : pos + 1] != char:
+                raise json.JSONDecodeError(f"expected '{char}'", buf, pos)
+            pos += 1
+
+        expect("{")
+        skip(" \t\r\n")
+        while buf[pos : pos + 1] != "}":
+            key = decode()
+            expect(":")
+            skip(" \t\r\n")
+            if key != "items":
+                decode()
+            else:
+                expect("[")
+                skip(" \t\r\n")
+                while buf[pos : pos + 1] != "]":
+                    yield decode()
+                    skip(" \t\r\n,")
+                pos += 1
+            skip(" \t\r\n,")
@@ -4,6 +4,8 @@ from datetime import timedelta
 import colorcet as cc
 import numpy as np
 import pandas as pd
+from bokeh.io import output_notebook
+from bokeh.io.state import curstate
 from bokeh.layouts import gridplot
 from bokeh.models import BoxZoomTool
 from bokeh.models import ColumnDataSource
@@ -17,10 +19,23 @@ from bokeh.plotting import figure
 from bokeh.plotting import show
 
 _MARGIN_FACTOR = 1.1
+_BAND_ALPHA = 0.2
 
 _HOVER_JS = """
 export default (args, obj, data, context) => {
-    const x = Math.floor(data.geometry.x);
+    // The x values aren't necessarily evenly spaced (e.g., if the data has been downsampled), so find the last point
+    // at or before the cursor with a binary search
+    const xs = args.source.data['PLACEHOLDER'];
+    let x = 0;
+    let hi = xs.length - 1;
+    while (x < hi) {
+        const mid = (x + hi + 1) >> 1;
+        if (xs[mid] <= data.geometry.x) {
+            x = mid;
+        } else {
+            hi = mid - 1;
+        }
+    }
     const tooltips = [`${args.source.data['normalized_ts_str'][x]}`];
 
     const seriesNames = Object.keys(args.source.data).filter(key => key !== 'PLACEHOLDER');
@@ -39,6 +54,44 @@ export default (args, obj, data, context) => {
 Extents = T.Tuple[timedelta, timedelta, float, float]
 
 
+def downsample(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    # Min/max bucketing: split the rows into max_points / 2 buckets, and keep each series' min and max in each bucket,
+    # in the order they occurred.  Since all the series share the same x values, the two output rows for a bucket are
+    # placed at the bucket's first and last x value.  At plotting resolution the buckets are about a pixel wide, so
+    # this looks the same as the full data (in particular, it keeps all the peaks), for a fraction of the points.
+    nrows, ncols = df.shape
+    if nrows <= max_points or max_points < 2:
+        return df
+
+    size = -(-nrows // (max_points // 2))
+    nbuckets = -(-nrows // size)
+
+    padded = np.full((nbuckets * size, ncols), np.nan)
+    padded[:nrows] = df.to_numpy(dtype=float)
+    buckets = padded.reshape(nbuckets, size, ncols)
+    missing = np.isnan(buckets)
+    lo = np.where(missing, np.inf, buckets).argmin(axis=1)
+    hi = np.where(missing, -np.inf, buckets).argmax(axis=1)
+
+    first = np.take_along_axis(buckets, np.minimum(lo, hi)[:, None, :], axis=1)[:, 0, :]
+    last = np.take_along_axis(buckets, np.maximum(lo, hi)[:, None, :], axis=1)[:, 0, :]
+    starts = np.arange(nbuckets) * size
+    ends = np.minimum(starts + size, nrows) - 1
+
+    index = np.stack([df.index.to_numpy()[starts], df.index.to_numpy()[ends]], axis=1).ravel()
+    return pd.DataFrame(
+        np.stack([first, last], axis=1).reshape(-1, ncols),
+        index=pd.Index(index, name=df.index.name),
+        columns=df.columns,
+    )
+
+
+def setup_notebook(hide_banner: bool = False) -> None:
+    # Plots get sent to the notebook by default, but this only needs to be called explicitly if you want to set it up
+    # before the first plot (e.g., to get the BokehJS loading out of the way) or to hide the banner
+    output_notebook(hide_banner=hide_banner)
+
+
 def new_figure(h: int = 600) -> figure:
     p = figure(height=h, tools=[])
     p.xgrid.visible = False
@@ -54,23 +107,32 @@ def plot_histogram(counts: np.ndarray, bins: np.ndarray) -> None:
     p.x_range.start = 0  # type: ignore
     p.xaxis.ticker = bins
     p.quad(top=counts, left=bins[:-1], right=bins[1:], bottom=0)
-    show(p)
+    _show(p)
 
 
 def plot_multiseries(
     dfs: T.Mapping[str, pd.DataFrame],
     *,
     stack: bool = False,
+    band: bool = False,
     ncols: int = 3,
     color_palette: T.Optional[str] = None,
+    max_points: T.Optional[int] = None,
 ) -> None:
+    # With band set, each DataFrame is a summary table (see DataKubeRelation.to_summary_table): the mean and each of
+    # the quantiles are drawn as lines, and the mean plus or minus one standard deviation as a shaded band.  Passing
+    # max_points downsamples long series (see downsample) so that they're cheaper to draw, at the cost of the hover
+    # showing the bucket extremes instead of the sample under the cursor; stacked plots are never downsampled, since
+    # each series' extremes come from different rows, so they wouldn't add up to the real stack.
     plots = []
-    for title, df in dfs.items():
+    for title, full_df in dfs.items():
+        df = full_df if max_points is None or stack else downsample(full_df, max_points)
+
         p = new_figure()
         p.title.text = title  # type: ignore
         p.xaxis.formatter = NumeralTickFormatter(format="00:00:00")
 
-        (xmin, xmax, ymin, ymax) = _compute_extents(df, stack=stack)
+        (xmin, xmax, ymin, ymax) = _compute_extents(df, stack=stack, band=band)
         p.x_range = Range1d(xmin, xmax * 1.05)  # type: ignore
         p.y_range = Range1d(ymin, ymax * 1.05)  # type: ignore
 
@@ -86,10 +148,12 @@ def plot_multiseries(
         else:
             colors = getattr(cc, color_palette)[:ncolors]
 
-        if not stack:
-            _add_ts_lines(src, df.index.name, keys, p, colors)
-        else:
+        if stack:
             p.vline_stack(keys, x=df.index.name, color=colors, source=src)
+        elif band:
+            _add_band(src, str(df.index.name), keys, p, colors)
+        else:
+            _add_ts_lines(src, df.index.name, keys, p, colors)
 
         _setup_ts_tools(src, df.index.name, p, colors, xmin, xmax, ymin, ymax)
         plots.append(p)
@@ -97,7 +161,7 @@ def plot_multiseries(
     ncols = min(ncols, len(dfs))
     grid = gridplot(plots, ncols=ncols, sizing_mode="stretch_width")  # type: ignore
 
-    show(grid)
+    _show(grid)
 
 
 def _add_ts_lines(src: ColumnDataSource, index: str, keys: T.List[str], p: figure, colors: T.Tuple[str, ...]) -> None:
@@ -106,9 +170,32 @@ def _add_ts_lines(src: ColumnDataSource, index: str, keys: T.List[str], p: figur
         p.line(x=index, y=key, source=src, color=next(color_iter))
 
 
-def _compute_extents(df: pd.DataFrame, stack: bool = False) -> Extents:
+def _add_band(src: ColumnDataSource, index: str, keys: T.List[str], p: figure, colors: T.Sequence[str]) -> None:
+    # The band gets the standard deviation's color, so that it matches the tooltip
+    data = src.data
+    lower = np.asarray(data["mean"]) - np.asarray(data["stddev"])
+    upper = np.asarray(data["mean"]) + np.asarray(data["stddev"])
+    p.varea(
+        x=np.asarray(data[index], dtype=float),
+        y1=lower,
+        y2=upper,
+        color=colors[keys.index("stddev")],
+        alpha=_BAND_ALPHA,
+    )
+    lines = [(key, color) for (key, color) in zip(keys, colors) if key != "stddev"]
+    _add_ts_lines(src, index, [key for (key, _) in lines], p, tuple(color for (_, color) in lines))
+
+
+def _compute_extents(df: pd.DataFrame, stack: bool = False, band: bool = False) -> Extents:
     xmin, xmax = df.index.min(), df.index.max()
 
+    # The band goes out to a standard deviation either side of the mean, which isn't a line of its own
+    if band:
+        df = pd.concat(
+            [df.drop(columns="stddev"), df["mean"] - df["stddev"], df["mean"] + df["stddev"]],
+            axis=1,
+        )
+
     # first min (max) gets the min (max) of each column, second reduces to min (max) of all columns
     ymin = min(0, df.min().min())
     if stack:
@@ -119,6 +206,12 @@ def _compute_extents(df: pd.DataFrame, stack: bool = False) -> Extents:
     return (xmin, xmax, ymin, ymax)
 
 
+def _show(obj: T.Any) -> None:
+    if not curstate().notebook:
+        setup_notebook()
+    show(obj)
+
+
 def _setup_ts_tools(
     src: ColumnDataSource,
     index: str,
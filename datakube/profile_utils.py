@@ -0,0 +1,93 @@
+import typing as T
+
+import pandas as pd
+from duckdb.duckdb import DuckDBPyRelation
+
+_MAX_ARGS_LEN = 40
+
+# A chained DataKubeRelation operation, as (method name, args, kwargs)
+Op = T.Tuple[str, T.Tuple[T.Any, ...], T.Dict[str, T.Any]]
+
+
+class StageProfile(T.NamedTuple):
+    name: str
+    rows_in: T.Optional[int]
+    rows_out: int
+    seconds: float
+    explain: T.Optional[str]
+
+
+class PipelineProfile:
+    def __init__(self) -> None:
+        self.stages: T.List[StageProfile] = []
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(s.seconds for s in self.stages)
+
+    def to_df(self) -> pd.DataFrame:
+        return pd.DataFrame([s._asdict() for s in self.stages]).drop(columns="explain")
+
+    def __repr__(self) -> str:
+        width = max([len("stage")] + [len(s.name) for s in self.stages])
+        lines = [f"{'stage':<{width}} {'rows in':>12} {'rows out':>12} {'secs':>9} {'%':>6}"]
+        total = self.total_seconds or 1
+        for s in self.stages:
+            rows_in = "-" if s.rows_in is None else s.rows_in
+            lines.append(
+                f"{s.name:<{width}} {rows_in:>12} {s.rows_out:>12} {s.seconds:>9.3f} {100 * s.seconds / total:>6.1f}"
+            )
+        lines.append(f"{'total':<{width}} {'':>12} {'':>12} {self.total_seconds:>9.3f}")
+        return "\n".join(lines)
+
+
+class StageRecorder:
+    # Keeps track of the operations applied to a relation while profiling is turned on.  Row-by-row operations that
+    # happen before anything else stay fused into the scan (since that's where DuckDB runs them, as part of the scan),
+    # so they're folded into the first stage instead of being recorded separately.
+    def __init__(self, scan: DuckDBPyRelation) -> None:
+        self.scan = scan
+        self.scan_ops: T.List[str] = []
+        self.ops: T.List[Op] = []
+        self.depth = 0
+
+    def copy(self) -> "StageRecorder":
+        other = StageRecorder(self.scan)
+        other.scan_ops = list(self.scan_ops)
+        other.ops = list(self.ops)
+        return other
+
+    def record(self, op: Op, rel: DuckDBPyRelation, fused: bool) -> None:
+        if fused and not self.ops:
+            self.scan = rel
+            self.scan_ops.append(op[0])
+        else:
+            self.ops.append(op)
+
+    def rescan(self, rel: DuckDBPyRelation) -> None:
+        # An operation that reads from the source one last time before dropping it (narrowed to a time range, or from a
+        # rollup) does that as part of the scan, so the scan stage is whatever it read
+        if not self.ops:
+            self.scan = rel
+
+    @property
+    def scan_name(self) -> str:
+        return "+".join(["scan"] + self.scan_ops)
+
+
+def describe_op(op: Op) -> str:
+    (name, args, kwargs) = op
+    desc = ", ".join([_short_repr(a) for a in args] + [f"{k}={_short_repr(v)}" for (k, v) in kwargs.items()])
+    if len(desc) > _MAX_ARGS_LEN:
+        desc = desc[: _MAX_ARGS_LEN - 3] + "..."
+    return f"{name}({desc})"
+
+
+def _short_repr(val: T.Any) -> str:
+    if isinstance(val, pd.DataFrame):
+        return f"<{len(val)} rows>"
+    if isinstance(val, list):
+        return f"<{len(val)} items>"
+    if hasattr(val, "_rel"):
+        return "<relation>"
+    return repr(val)
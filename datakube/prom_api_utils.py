@@ -0,0 +1,154 @@
+import threading
+import typing as T
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from urllib.parse import urlencode
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+import urllib3
+
+from datakube.data_utils import TimeBound
+
+QUERY_RANGE_PATH = "/api/v1/query_range"
+
+# Labels that prom2parquet pulls out into their own columns; everything else (except the metric name) goes into the
+# "k1=v1,k2=v2,..." labels column, sorted by key
+LABEL_COLS = ["pod", "container", "namespace", "node"]
+
+# Prometheus refuses to return more than this many points per series from a single query_range request
+MAX_POINTS_PER_SERIES = 11000
+
+# Failed requests (connection errors, or the server telling us to back off) get retried this many times
+DEFAULT_RETRIES = 3
+RETRY_STATUSES = [429, 502, 503, 504]
+
+
+class Shard(T.NamedTuple):
+    # One query_range request's worth of samples, in the same layout as the parquet files that prom2parquet writes;
+    # the name is the request URL, which is what gets recorded as the source of the rows in the cache
+    name: str
+    start_ms: int
+    end_ms: int
+    df: pd.DataFrame
+
+
+class PromAPIClient:
+    # Fetches samples from a Prometheus-compatible HTTP API (Prometheus itself, Thanos, Mimir, VictoriaMetrics, etc)
+    # using query_range.  A time range gets split into shards of shard_secs each, which are fetched concurrently over a
+    # pool of keep-alive connections to the server; shards are aligned to multiples of shard_secs since the epoch, so
+    # that fetching an overlapping range again produces the same shards (see PromReader.load_from_prometheus).
+    def __init__(
+        self,
+        url: str,
+        *,
+        step: int = 15,
+        shard_secs: int = 3600,
+        parallelism: int = 4,
+        headers: T.Optional[T.Dict[str, str]] = None,
+        timeout: float = 60,
+        retries: int = DEFAULT_RETRIES,
+    ) -> None:
+        if shard_secs % step != 0:
+            raise ValueError(f"shard size ({shard_secs}s) must be a multiple of the step ({step}s)")
+        if shard_secs // step > MAX_POINTS_PER_SERIES:
+            raise ValueError(f"shards of {shard_secs}s would have more than {MAX_POINTS_PER_SERIES} points per series")
+
+        self.url = url.rstrip("/")
+        self.step = step
+        self.shard_secs = shard_secs
+        self.parallelism = parallelism
+
+        # One connection per worker thread is all we'll ever need; once the retries run out, the last response comes
+        # back to _fetch so that the error says what the server said
+        self._pool = urllib3.PoolManager(
+            maxsize=parallelism,
+            block=True,
+            headers=headers,
+            timeout=urllib3.Timeout(total=timeout),
+            retries=urllib3.Retry(
+                total=retries, backoff_factor=0.5, status_forcelist=RETRY_STATUSES, raise_on_status=False
+            ),
+        )
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def query_range(self, query: str, start: TimeBound, end: TimeBound) -> T.Iterator[Shard]:
+        # Yields the shards covering [start, end] as they arrive (which isn't necessarily in order); only parallelism
+        # requests are in flight at a time, and a shard isn't fetched until there's room for it, so no matter how long
+        # the range is, only a few shards are ever held in memory at once
+        shards = iter(self._shard_bounds(start, end))
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+
+            def submit() -> T.Optional[Future]:
+                bounds = next(shards, None)
+                return executor.submit(self._fetch, query, *bounds) if bounds is not None else None
+
+            pending = {f for f in (submit() for _ in range(self.parallelism)) if f is not None}
+            while pending:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                    nxt = submit()
+                    if nxt is not None:
+                        pending.add(nxt)
+
+    def _shard_bounds(self, start: TimeBound, end: TimeBound) -> T.List[T.Tuple[int, int]]:
+        # (first, last) evaluation times for each shard, in seconds; query_range includes both ends, so each shard
+        # stops one step short of the next one
+        first = int(start.timestamp()) // self.shard_secs * self.shard_secs
+        return [
+            (shard_start, shard_start + self.shard_secs - self.step)
+            for shard_start in range(first, int(end.timestamp()) + 1, self.shard_secs)
+        ]
+
+    def _fetch(self, query: str, start: int, end: int) -> Shard:
+        params = urlencode({"query": query, "start": start, "end": end, "step": self.step})
+        url = f"{self.url}{QUERY_RANGE_PATH}?{params}"
+        with self._lock:
+            self.requests += 1
+
+        # Errors from Prometheus itself come back as JSON (with a 4xx/5xx status), but anything in between (proxies,
+        # load balancers) can answer with whatever it likes, so only decode the body if it's going to be JSON
+        resp = self._pool.request("GET", url)
+        if resp.status != 200 and not resp.headers.get("Content-Type", "").startswith("application/json"):
+            raise RuntimeError(f"query_range failed ({resp.status}): {resp.data[:200]!r}")
+        body = json.loads(resp.data)
+        if resp.status != 200 or body.get("status") != "success":
+            raise RuntimeError(f"query_range failed ({resp.status}): {body.get('error', resp.data[:200])}")
+        if body["data"]["resultType"] != "matrix":
+            raise RuntimeError(f"query_range returned a {body['data']['resultType']}, not a matrix")
+
+        return Shard(url, start * 1000, end * 1000, _matrix_to_df(body["data"]["result"], url))
+
+
+def _matrix_to_df(result: T.List[T.Dict[str, T.Any]], filename: str) -> pd.DataFrame:
+    # Prometheus gives us each series' labels once, followed by its (timestamp in float seconds, value as a string)
+    # pairs; the per-series columns get repeated out to one row per sample at the end
+    timestamps: T.List[int] = []
+    values: T.List[float] = []
+    counts: T.List[int] = []
+    series_cols: T.Dict[str, T.List[str]] = {col: [] for col in [*LABEL_COLS, "labels"]}
+    for series in result:
+        points = series["values"]
+        timestamps.extend(round(ts * 1000) for (ts, _) in points)
+        values.extend(float(val) for (_, val) in points)
+        counts.append(len(points))
+
+        metric = series["metric"]
+        for col in LABEL_COLS:
+            series_cols[col].append(metric.get(col, ""))
+        series_cols["labels"].append(
+            ",".join(f"{k}={v}" for (k, v) in sorted(metric.items()) if k not in LABEL_COLS and k != "__name__")
+        )
+
+    df = pd.DataFrame({
+        "timestamp": np.array(timestamps, dtype=np.int64),
+        "value": np.array(values, dtype=np.float64),
+        **{col: np.repeat(np.array(vals, dtype=object), counts) for (col, vals) in series_cols.items()},
+    })
+    df["filename"] = filename
+    return df
@@ -1,104 +1,934 @@
 import os
 import re
+import threading
+import time
 import typing as T
+from bisect import bisect_left
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from datetime import datetime
+from datetime import timezone
 
 import duckdb
+import pandas as pd
+from duckdb.duckdb import DuckDBPyConnection
 from duckdb.duckdb import DuckDBPyRelation
 
+from datakube.cache_utils import ResultCache
+from datakube.constants import LABEL_MAP_KEY
+from datakube.data_utils import LABEL_MAP_EXPR
 from datakube.data_utils import DataKubeRelation
+from datakube.data_utils import MetricSource
+from datakube.data_utils import TimeBound
+from datakube.data_utils import _query_hash
+from datakube.prom_api_utils import PromAPIClient
 
 CACHED_DB_FILE = "cache.duckdb"
+SHARED_DB = "shared"
+MANIFEST_TABLE = "_datakube_manifest"
+WINDOWS_TABLE = "_datakube_windows"
+OWNERS_TABLE = "_datakube_owners"
+OWNER_SCOPES_TABLE = "_datakube_owner_scopes"
+ROLLUP_TABLE_PREFIX = "_datakube_rollup_"
+SOURCE_FILE_COL = "source_file"
+
+# Each batch of rows that gets ingested is sorted by hour first, then by these (whichever of them the metric has), and
+# then by time.  Time filters are the most common by far, and since batches of files mostly show up in time order, the
+# hourly buckets keep the whole table (not just each batch) roughly in time order, so a time filter only has to read
+# the row groups for the hours it covers.  Within each hour, all the samples for a series end up next to each other,
+# so each row group only has a handful of distinct values in each of these columns, which DuckDB's dictionary
+# compression stores very compactly, and filters on them can skip some of the data too.  (Sorting by series first
+# makes filters on them faster still, but then every row group covers the entire time range, and time filters have to
+# read everything.  ENUM columns would be smaller still, but new pods show up all the time, and an ENUM can't take on
+# values it didn't start out with.)
+SERIES_SORT_COLS = ["namespace", "pod", "container", "labels"]
+SORT_BUCKET_SECS = 3600
+
+# The kube-state-metrics metrics that describe who owns what, along with the kind of object each one is about and the
+# expression for the object's name; the scrape job clobbers the "job" label, so the job name ends up in "job_name"
+OWNER_METRICS = [
+    ("kube_pod_owner", "Pod", "pod"),
+    ("kube_replicaset_owner", "ReplicaSet", f"coalesce({LABEL_MAP_KEY}['replicaset'], '')"),
+    ("kube_job_owner", "Job", f"coalesce({LABEL_MAP_KEY}['job_name'], '')"),
+]
+
+# Ownership chains are never actually this long, this just keeps us from looping forever if there's a cycle
+MAX_OWNER_DEPTH = 16
+
+# How often to retry opening the cache while some other process has it locked
+LOCK_RETRY_SECS = 0.1
+
+# What each rollup table keeps for each series in each bucket (see PromReader); the last sample and its timestamp are
+# what lets the rollups stand in for the raw samples in fill_missing_data
+ROLLUP_AGGS = {
+    "min": "min(value)",
+    "max": "max(value)",
+    "avg": "avg(value)",
+    "last": "arg_max(value, timestamp)",
+    "last_ts": "max(timestamp)",
+    "count": "count(*)",
+}
+
+# Upper bound on the number of separate parquet scans we'll issue to load a set of time windows; see
+# _plan_window_scans for details
+MAX_WINDOW_SCANS = 32
+
+Window = T.Tuple[TimeBound, TimeBound]
+MsWindows = T.List[T.Tuple[int, int]]
+R = T.TypeVar("R")
 
 
 class PromReader:
-    def __init__(self, data_path: str, cache_enabled: bool = True, cache_root: str = "~/.cache/datakube") -> None:
+    def __init__(
+        self,
+        data_path: str,
+        cache_enabled: bool = True,
+        cache_root: str = "~/.cache/datakube",
+        auto_refresh: bool = False,
+        lazy: bool = False,
+        windows: T.Optional[T.Sequence[Window]] = None,
+        result_cache_bytes: T.Optional[int] = None,
+        read_only: bool = False,
+        lock_timeout: float = 0,
+        rollups: T.Optional[T.Sequence[int]] = None,
+    ) -> None:
+        if rollups is not None and any(secs <= 0 for secs in rollups):
+            raise ValueError("rollup tiers must be a positive number of seconds")
+
         self.data_path = data_path
+        self.auto_refresh = auto_refresh
+        self.lazy = lazy
+        self.windows = windows
+        self.read_only = read_only
+        self.lock_timeout = lock_timeout
+
+        # Rollup tiers (in seconds) to build for every metric that gets loaded: each tier is a table with one row per
+        # series per bucket, holding the min/max/avg/last/count of the samples in the bucket.  Pipelines that only need
+        # data at a coarser resolution than the raw samples (fill_missing_data, mostly) can read the coarsest tier that
+        # evenly divides the resolution instead of the raw table, which gives the same answer from a fraction of the
+        # rows.  Every tier that a metric has is kept up to date as files are appended, whether or not it was asked
+        # for this time around.
+        self.rollups = sorted(set(rollups or []))
+
+        # The tiers we've already made sure each (local) metric has, so that we only have to look again when the
+        # requested tiers change
+        self._rollups_built: T.Dict[str, T.List[int]] = {}
 
-        cache_root = os.path.expanduser(cache_root)
         path_parts = re.match(r"s3://([a-zA-Z_-]+)/(.*)", self.data_path)
-        db_location = ":memory:"
-        if path_parts and cache_enabled:
-            bucket = path_parts.group(1)
-            prefix = path_parts.group(2)
-            cache_location = f"{cache_root}/{bucket}/{prefix}/"
-            os.makedirs(cache_location, exist_ok=True)
-            db_location = f"{cache_location}/{CACHED_DB_FILE}"
-
-        self._conn = duckdb.connect(db_location)
-        self._conn.query("CREATE SECRET(TYPE S3, PROVIDER CREDENTIAL_CHAIN)")
-
-        # Flatten the (single-element) tuples returned from the query
-        self._tables: T.Set[str] = set([
-            t[0] for t in self._conn.query("SELECT table_name FROM duckdb_tables").fetchall()
-        ])
-
-    def query_metric(self, metric_name: str, grouper: T.Optional[str] = None) -> DuckDBPyRelation:
-        if metric_name not in self._tables:
-            self._load_metric_from_parquet(metric_name)
-
-        rel = self._conn.table(metric_name).select("* EXCLUDE(timestamp), to_timestamp(timestamp / 1000) AS timestamp")
-        return DataKubeRelation(rel, self._conn, grouper)
-
-    def _load_metric_from_parquet(self, metric_name: str):
+        db_location = _cache_db_location(data_path, cache_root) if cache_enabled else ":memory:"
+
+        # DuckDB lets any number of processes open a database file read-only, or one process open it read-write, but
+        # not both.  In read-only mode, we work in an in-memory database and attach the on-disk cache (read-only) to it;
+        # metrics that aren't in the shared cache get loaded into the in-memory one, just for this process.  Whoever
+        # is filling up the shared cache has to do that while nobody's reading it (readers can detach() to let a writer
+        # in, and reattach() to see what it added).  If the file is locked, we keep trying for up to lock_timeout
+        # seconds.
+        self._shared_location = db_location if read_only and db_location != ":memory:" else None
+        self._shared_tables: T.Set[str] = set()
+        self._db: DuckDBPyConnection = _with_lock_retries(
+            lambda: duckdb.connect(":memory:" if read_only else db_location), lock_timeout
+        )
+
+        # Metrics can be loaded from multiple threads at once (see prefetch), each of which gets its own cursor on the
+        # database; the per-metric locks make sure that only one thread is loading any given metric at a time
+        self._local = threading.local()
+        self._load_locks: T.Dict[str, threading.Lock] = {}
+        self._load_locks_lock = threading.Lock()
+
+        if path_parts:
+            self._conn.query("CREATE SECRET(TYPE S3, PROVIDER CREDENTIAL_CHAIN)")
+
+        # The manifest records every parquet file that's been copied into the cache (along with its size and
+        # modification time), so that we can tell which files are new or have changed since the last time we
+        # looked at the metric; S3 doesn't give us etags through DuckDB, but size + mtime is good enough here.
+        self._conn.query(
+            f"""
+            CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+                metric VARCHAR,
+                filename VARCHAR,
+                size BIGINT,
+                last_modified TIMESTAMP WITH TIME ZONE,
+            )
+            """
+        )
+
+        # If a metric was only loaded for some set of time windows, they're recorded here; metrics with no entries
+        # in this table were loaded in their entirety
+        self._conn.query(f"CREATE TABLE IF NOT EXISTS {WINDOWS_TABLE} (metric VARCHAR, start_ms BIGINT, end_ms BIGINT)")
+
+        # Resolved pod ownership (see pod_owners), along with the scope (windows and version of the owner metrics) that
+        # each namespace was resolved for; namespaces that were resolved but don't have any pods only show up in the
+        # latter.  Everything gets thrown away whenever any of the owner metrics change.
+        self._conn.query(
+            f"""
+            CREATE TABLE IF NOT EXISTS {OWNERS_TABLE} (
+                namespace VARCHAR,
+                pod VARCHAR,
+                root_owner_kind VARCHAR,
+                root_owner VARCHAR,
+            )
+            """
+        )
+        self._conn.query(f"CREATE TABLE IF NOT EXISTS {OWNER_SCOPES_TABLE} (namespace VARCHAR, scope VARCHAR)")
+
+        # Pipeline results can be memoized in the cache database too, up to result_cache_bytes (this is off unless asked
+        # for).  Every result gets written out in full before we know how big it is, and any ingest makes all of them
+        # stale, so this is meant for repeatedly running analyses on data that's done changing (e.g., re-running a
+        # notebook against a finished experiment), with the cache on disk so that the results outlive the process.
+        self._results = ResultCache(self._db, result_cache_bytes, self._data_version) if result_cache_bytes else None
+
+        self._tables = self._metric_tables()
+        self._attach_shared()
+
+    def query_metric(
+        self,
+        metric_name: str,
+        grouper: T.Optional[str] = None,
+        lazy: T.Optional[bool] = None,
+        windows: T.Optional[T.Sequence[Window]] = None,
+    ) -> DuckDBPyRelation:
+        if lazy is None:
+            lazy = self.lazy
+        if windows is None:
+            windows = self.windows
+        ms_windows = _merge_windows(windows) if windows is not None else None
+
+        # In lazy mode we scan the parquet files directly (unless we happen to have the metric cached already), so
+        # that filters get pushed all the way down into the parquet reader instead of copying the whole thing first
+        if not lazy:
+            self._ensure_loaded(metric_name, ms_windows)
+
+        # (Results computed straight from the parquet files can't be memoized, since the data version doesn't know
+        # about them)
+        source = self._metric_source(metric_name, ms_windows)
+        cache = self._results if self._cached_table(metric_name) is not None else None
+        return DataKubeRelation(source(None, None, None), self._conn, grouper, source, cache)
+
+    def prefetch(
+        self,
+        metric_names: T.Iterable[str],
+        parallelism: int = 4,
+        progress: T.Optional[T.Callable[[str, int, int], None]] = None,
+        windows: T.Optional[T.Sequence[Window]] = None,
+    ) -> T.Dict[str, int]:
+        # Load a bunch of metrics into the cache concurrently (most of the time spent loading a metric is waiting on
+        # S3, so this is a lot faster than letting query_metric load them one at a time).  The progress callback is
+        # called with (metric_name, completed, total) as each metric finishes; returns the number of files that were
+        # ingested for each metric.
+        if windows is None:
+            windows = self.windows
+        ms_windows = _merge_windows(windows) if windows is not None else None
+        metrics = list(dict.fromkeys(metric_names))
+
+        loaded = {}
+        with ThreadPoolExecutor(max_workers=parallelism, initializer=self._open_cursor) as executor:
+            futures = {executor.submit(self._ensure_loaded, m, ms_windows): m for m in metrics}
+            for i, future in enumerate(as_completed(futures)):
+                metric_name = futures[future]
+                loaded[metric_name] = future.result()
+                if progress is not None:
+                    progress(metric_name, i + 1, len(metrics))
+
+        return {m: loaded[m] for m in metrics}
+
+    def load_from_prometheus(
+        self,
+        client: PromAPIClient,
+        metric_name: str,
+        start: TimeBound,
+        end: TimeBound,
+        query: T.Optional[str] = None,
+    ) -> int:
+        # Pull samples for [start, end] straight from a Prometheus-compatible API into the cached metric table,
+        # instead of waiting for them to be exported to parquet.  The query defaults to the metric name, but it can be
+        # any PromQL expression (e.g., to select a subset of the series).  Each shard is ingested as soon as it arrives,
+        # the same way a parquet file would be, with the request URL standing in for the filename; shards that were
+        # loaded before get replaced, so loading an overlapping range again picks up samples that have come in since,
+        # without doubling up the rest.  (Loading the same metric from both parquet files and the API does double up,
+        # though.)  Returns the number of shards that were ingested.
+        with self._load_lock(metric_name):
+            loaded = 0
+            for shard in client.query_range(query or metric_name, start, end):
+                # (An empty DataFrame doesn't have enough type information to create the table from)
+                if shard.df.empty and metric_name not in self._tables:
+                    continue
+                sources = [(shard.name, len(shard.df), datetime.now(timezone.utc))]
+                self._ingest(metric_name, self._conn.from_df(shard.df), sources)
+                loaded += 1
+            return loaded
+
+    def materialize(self, metric_name: str) -> int:
+        with self._load_lock(metric_name):
+            return self._load_metric_from_parquet(metric_name, self._cached_windows(metric_name))
+
+    # Append any new or changed parquet files to the cached metric tables (or all of them, if no metric is given);
+    # returns the number of files that were (re-)ingested for each metric
+    def refresh(self, metric_name: T.Optional[str] = None) -> T.Dict[str, int]:
+        metrics = [metric_name] if metric_name is not None else sorted(self._tables)
+        loaded = {m: self.materialize(m) for m in metrics}
+
+        # In lazy mode, the owner metrics are read straight from the parquet files, which have probably changed too
+        if self.lazy:
+            self._clear_pod_owners()
+        return loaded
+
+    def detach(self) -> None:
+        # Let go of the shared cache so that some other process can write to it (read-only mode only); relations that
+        # read from the shared cache won't work again until it's reattached
+        self._conn.execute(f"DETACH DATABASE IF EXISTS {SHARED_DB}")
+        self._shared_tables = set()
+        self._clear_pod_owners()
+
+    def reattach(self) -> None:
+        # Pick up whatever's been added to the shared cache since it was attached (read-only mode only)
+        self.detach()
+        self._attach_shared()
+
+    def close(self) -> None:
+        # Release the cache (so that some other process can open it read-write)
+        self._db.close()
+
+    def invalidate_results(self, rel: T.Optional[DataKubeRelation] = None) -> int:
+        # Throw away the memoized result for a pipeline (or all of them); returns the number of results dropped.  This
+        # is never necessary for correctness, since results are tied to the version of the data they were computed
+        # from, but it's a way to free up space.
+        if self._results is None:
+            return 0
+        return self._results.invalidate(rel._rel if rel is not None else None)
+
+    @property
+    def _conn(self) -> DuckDBPyConnection:
+        # Worker threads use their own cursor, everything else uses the main connection
+        return getattr(self._local, "cursor", None) or self._db
+
+    def _attach_shared(self) -> None:
+        # (There's nothing to attach until something has created the cache)
+        if self._shared_location is None or not os.path.exists(self._shared_location):
+            return
+        _with_lock_retries(
+            lambda: self._conn.execute(f"ATTACH '{self._shared_location}' AS {SHARED_DB} (READ_ONLY)"),
+            self.lock_timeout,
+        )
+        self._shared_tables = self._metric_tables(SHARED_DB)
+
+    def _cached_table(self, metric_name: str) -> T.Optional[T.Tuple[str, T.Optional[str]]]:
+        # The (table name, database) holding the cached copy of the metric, if there is one; anything loaded by this
+        # process takes precedence over the shared cache
+        if metric_name in self._tables:
+            return metric_name, None
+        if metric_name in self._shared_tables:
+            return f"{SHARED_DB}.{metric_name}", SHARED_DB
+        return None
+
+    def _data_version(self) -> str:
+        # Changes whenever anything gets (re-)ingested: every metric table is exactly the files in the manifest,
+        # restricted to the windows in the windows table (and the owners table is derived from the owner metrics)
+        prefixes = [""] + ([f"{SHARED_DB}."] if self._shared_tables else [])
+        parts = [
+            f"""
+            (
+                SELECT count(*) || ':' || coalesce(bit_xor(hash(metric, filename, size, last_modified)), 0)
+                FROM {prefix}{MANIFEST_TABLE}
+            ) || '/' || (
+                SELECT count(*) || ':' || coalesce(bit_xor(hash(metric, start_ms, end_ms)), 0)
+                FROM {prefix}{WINDOWS_TABLE}
+            )
+            """
+            for prefix in prefixes
+        ]
+        (version,) = self._conn.query("SELECT " + " || '/' || ".join(parts)).fetchone()  # type: ignore
+        return version
+
+    def _ensure_loaded(self, metric_name: str, windows: T.Optional[MsWindows]) -> int:
+        with self._load_lock(metric_name):
+            # The shared cache can't be refreshed from here, but as long as it has everything we need, we use it as is
+            if (
+                metric_name not in self._tables
+                and metric_name in self._shared_tables
+                and _windows_cover(self._cached_windows(metric_name, SHARED_DB), windows)
+            ):
+                return 0
+
+            cached_windows = self._cached_windows(metric_name)
+            scope = windows
+            if metric_name in self._tables:
+                # If what we've got cached doesn't cover the requested windows, we need to (re-)load the metric
+                # for everything we've been asked for so far
+                if _windows_cover(cached_windows, windows):
+                    scope = cached_windows
+                elif cached_windows is not None and windows is not None:
+                    scope = _merge_windows_ms(cached_windows + windows)
+
+            if metric_name not in self._tables or self.auto_refresh or scope != cached_windows:
+                return self._load_metric_from_parquet(metric_name, scope)
+            self._ensure_rollups(metric_name)
+            return 0
+
+    def _load_metric_from_parquet(self, metric_name: str, windows: T.Optional[MsWindows] = None) -> int:
         # Hmmmmm.... we can't use parameter binding for these things so I guess this is vulnerable
         # to SQL injection?  I can't figure out a threat model where that's a problem, unless this
         # somehow got hooked up to the internet and accepts arbitrary user input, so, maybe don't do that?
+        path = self._metric_glob(metric_name)
 
-        path = f"{self.data_path}/{metric_name}/*.parquet"
-        self._conn.query(f"CREATE TABLE {metric_name} AS SELECT * FROM read_parquet('{path}')")
-        self._tables.add(metric_name)
+        # Tables cached by older versions of datakube don't know which file each row came from, and tables that were
+        # loaded for a different set of time windows are missing data; the only safe thing to do is start over
+        if metric_name in self._tables and (
+            SOURCE_FILE_COL not in self._table_columns(metric_name) or self._cached_windows(metric_name) != windows
+        ):
+            self._conn.query(f"DROP TABLE {metric_name}")
+            for secs in self._rollup_tiers(metric_name):
+                self._conn.query(f"DROP TABLE {_rollup_table(metric_name, secs)}")
+            self._conn.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE metric = ?", [metric_name])
+            self._conn.execute(f"DELETE FROM {WINDOWS_TABLE} WHERE metric = ?", [metric_name])
+            self._tables.discard(metric_name)
+            self._rollups_built.pop(metric_name, None)
 
-    def compute_pod_owners_map(self, namespace: str) -> DuckDBPyRelation:
-        pod_owners = (
-            self.query_metric("kube_pod_owner", "pod")
-            .extract_label("owner_name")
-            .extract_label("owner_kind")
-            .with_namespace(namespace)
-            .unique(["owner_name", "owner_kind"])
-            .df()
-            .drop_duplicates(subset="pod", ignore_index=True)
-        )
-        rs_owners = (
-            self.query_metric("kube_replicaset_owner", "replicaset")
-            .extract_label("replicaset")
-            .extract_label("owner_name")
-            .with_namespace(namespace)
-            .unique(["owner_name"])
-            .df()
-            .drop_duplicates(subset="replicaset", ignore_index=True)
-        )
-        job_owners = (
-            self.query_metric("kube_job_owner", "job")
-            .extract_label("job_name", "job")
-            .extract_label("owner_name")
-            .with_namespace(namespace)
-            .unique(["owner_name"])
-            .df()
-            .drop_duplicates(subset="job", ignore_index=True)
+        # read_blob only fetches the file contents if we ask for them, so this is just a (remote) directory listing;
+        # anything whose size or mtime doesn't match what's in the manifest needs to be (re-)ingested.  Files that
+        # have disappeared from the listing are left alone, since the cache might be the only copy we have left.
+        # (This is a plain query rather than a named view over the listing, since views are shared between the
+        # connection's cursors, and other threads may be loading other metrics at the same time)
+        changed = self._conn.execute(
+            f"""
+            SELECT l.filename, l.size, l.last_modified FROM read_blob('{path}') l ANTI JOIN {MANIFEST_TABLE} m
+            ON m.metric = ?
+                AND l.filename = m.filename
+                AND l.size = m.size
+                AND l.last_modified = m.last_modified
+            ORDER BY l.filename
+            """,
+            [metric_name],
+        ).fetchall()
+        if not changed:
+            self._ensure_rollups(metric_name)
+            return 0
+
+        files = [f for (f, _, _) in changed]
+        self._ingest(metric_name, self._scan_parquet(files, windows), changed, windows)
+        return len(files)
+
+    def _ingest(
+        self,
+        metric_name: str,
+        rel: DuckDBPyRelation,
+        sources: T.List[T.Tuple[str, int, T.Any]],
+        windows: T.Optional[MsWindows] = None,
+    ) -> None:
+        # Replace everything that came from the given sources (parquet files, or shards of a Prometheus query; see
+        # load_from_prometheus) with the rows in rel, which are in the parquet layout plus a filename column saying
+        # which source each row came from, and record the sources as (filename, size, last modified) in the manifest
+        files = [f for (f, _, _) in sources]
+        rel = rel.select(
+            f"""
+            * EXCLUDE(filename) REPLACE ({_ms_to_timestamp("timestamp")} AS timestamp),
+            filename AS {SOURCE_FILE_COL},
+            {LABEL_MAP_EXPR} AS {LABEL_MAP_KEY},
+            """
         )
+        rel = rel.order(_sort_cols(rel))
+        self._conn.begin()
+        try:
+            if metric_name in self._tables:
+                # Finding the rows to replace means scanning the whole table, so we only do it if there are any (which
+                # there usually aren't, when the table is being built up a file or a shard at a time).  The rollup
+                # buckets that overlap either the old or the new contents of the files are recomputed.
+                (known,) = self._conn.execute(
+                    f"SELECT count(*) FROM {MANIFEST_TABLE} WHERE metric = ? AND list_contains(?, filename)",
+                    [metric_name, files],
+                ).fetchone() or (0,)
+                has_rollups = bool(self._rollup_tiers(metric_name))
+                replaced = self._file_span(metric_name, files) if known and has_rollups else []
+                if known:
+                    self._conn.execute(f"DELETE FROM {metric_name} WHERE list_contains(?, {SOURCE_FILE_COL})", [files])
+                    self._conn.execute(
+                        f"DELETE FROM {MANIFEST_TABLE} WHERE metric = ? AND list_contains(?, filename)",
+                        [metric_name, files],
+                    )
+                rel.insert_into(metric_name)
+                if has_rollups:
+                    self._refresh_rollups(metric_name, replaced + self._file_span(metric_name, files))
+                self._build_rollups(metric_name)
+            else:
+                # (Any rollups left over from an earlier copy of the metric are out of date)
+                for secs in self._rollup_tiers(metric_name):
+                    self._conn.query(f"DROP TABLE {_rollup_table(metric_name, secs)}")
+                rel.create(metric_name)
+                self._build_rollups(metric_name)
+                if windows is not None:
+                    self._conn.executemany(
+                        f"INSERT INTO {WINDOWS_TABLE} VALUES (?, ?, ?)",
+                        [(metric_name, start, end) for (start, end) in windows],
+                    )
+            self._conn.executemany(
+                f"INSERT INTO {MANIFEST_TABLE} VALUES (?, ?, ?, ?)",
+                [(metric_name, *row) for row in sources],
+            )
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+        self._tables.add(metric_name)
+        self._rollups_built[metric_name] = list(self.rollups)
+
+    def _ensure_rollups(self, metric_name: str) -> None:
+        # Build any requested tiers that a metric that's already cached doesn't have yet, if the requested tiers have
+        # changed since we last checked (only the local copy of the metric can get new tiers; the shared cache is
+        # read-only)
+        if metric_name not in self._tables or self._rollups_built.get(metric_name) == list(self.rollups):
+            return
+        self._conn.begin()
+        try:
+            self._build_rollups(metric_name)
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        self._rollups_built[metric_name] = list(self.rollups)
+
+    def _build_rollups(self, metric_name: str) -> None:
+        # Build whichever of the requested tiers the metric doesn't have yet, from everything in the metric's table
+        if not self.rollups:
+            return
+        cols = self._table_columns(metric_name)
+        sort_cols = _sort_cols(self._conn.table(metric_name))
+        for secs in sorted(set(self.rollups) - set(self._rollup_tiers(metric_name))):
+            query = _rollup_query(metric_name, cols, secs)
+            self._conn.query(f"CREATE TABLE {_rollup_table(metric_name, secs)} AS FROM ({query}) ORDER BY {sort_cols}")
+
+    def _file_span(self, metric_name: str, files: T.List[str]) -> T.List[T.Any]:
+        # The (min, max) timestamps of the rows that came from the given files, if there are any
+        span = self._conn.execute(
+            f"SELECT min(timestamp), max(timestamp) FROM {metric_name} WHERE list_contains(?, {SOURCE_FILE_COL})",
+            [files],
+        ).fetchone()
+        return [ts for ts in span or [] if ts is not None]
 
-        pod_owners = pod_owners.merge(
-            rs_owners,
-            how="left",
-            left_on=["owner_name"],
-            right_on=["replicaset"],
-            suffixes=(None, "_rs"),
+    def _refresh_rollups(self, metric_name: str, span: T.List[T.Any]) -> None:
+        # Recompute every rollup bucket between the earliest and latest of the given timestamps
+        if not span:
+            return
+        cols = self._table_columns(metric_name)
+        params = {"lo": min(span), "hi": max(span)}
+        for secs in self._rollup_tiers(metric_name):
+            table = _rollup_table(metric_name, secs)
+            start = f"time_bucket(INTERVAL '{secs}s', $lo)"
+            self._conn.execute(f"DELETE FROM {table} WHERE timestamp BETWEEN {start} AND $hi", params)
+            where = f"timestamp >= {start} AND timestamp < time_bucket(INTERVAL '{secs}s', $hi) + INTERVAL '{secs}s'"
+            self._conn.execute(f"INSERT INTO {table} {_rollup_query(metric_name, cols, secs, where)}", params)
+
+    def _rollup_tiers(self, metric_name: str, database: T.Optional[str] = None) -> T.List[int]:
+        tables = self._conn.execute(
+            """
+            SELECT table_name FROM duckdb_tables
+            WHERE database_name = coalesce(?, current_database()) AND starts_with(table_name, ?)
+            """,
+            [database, ROLLUP_TABLE_PREFIX],
+        ).fetchall()
+        tiers = [table[len(ROLLUP_TABLE_PREFIX) :].split("_", 1) for (table,) in tables]
+        return sorted(int(secs) for (secs, metric) in tiers if metric == metric_name)
+
+    def _cached_windows(self, metric_name: str, database: T.Optional[str] = None) -> T.Optional[MsWindows]:
+        prefix = f"{database}." if database is not None else ""
+        windows = self._conn.execute(
+            f"SELECT start_ms, end_ms FROM {prefix}{WINDOWS_TABLE} WHERE metric = ? ORDER BY start_ms",
+            [metric_name],
+        ).fetchall()
+        return windows or None
+
+    def _metric_glob(self, metric_name: str) -> str:
+        # ** also matches zero directories, so this works for both flat and hive-partitioned layouts
+        return f"{self.data_path}/{metric_name}/**/*.parquet"
+
+    def _metric_source(self, metric_name: str, windows: T.Optional[MsWindows] = None) -> MetricSource:
+        def source(
+            start: T.Optional[TimeBound],
+            end: T.Optional[TimeBound],
+            resolution: T.Optional[int],
+        ) -> DuckDBPyRelation:
+            # Cached tables already have real timestamps (and parsed labels), so the bounds get converted instead
+            cached = self._cached_table(metric_name)
+            if cached is not None:
+                (table, database) = cached
+                cols = self._table_columns(metric_name, database)
+
+                # The rollups cover exactly what's in the table, so they can only stand in for it if we want all of it
+                tier = self._rollup_tier(metric_name, database, resolution)
+                if tier is not None and windows == self._cached_windows(metric_name, database):
+                    return self._rollup_source(metric_name, database, cols, tier, start, end)
+
+                rel = self._conn.sql(f"SELECT * EXCLUDE({SOURCE_FILE_COL}) FROM {table}")
+                if windows is not None:
+                    rel = _filter_windows(self._conn, rel, windows, _ms_to_timestamp)
+            elif windows is not None:
+                glob = self._metric_glob(metric_name)
+                files = [f for (f,) in self._conn.query(f"SELECT file FROM glob('{glob}')").fetchall()]
+                rel = self._scan_parquet(files, windows).select("* EXCLUDE(filename)")
+            else:
+                rel = self._conn.read_parquet(self._metric_glob(metric_name), hive_partitioning=True)
+
+            # In the parquet files, the timestamps are stored as epoch milliseconds, and DuckDB can't push a filter on
+            # the converted value down into the scan, so we filter on the raw column before converting it
+            bound = _ms_to_timestamp if cached is not None else str
+            if start is not None:
+                rel = rel.filter(f"timestamp >= {bound(_to_epoch_ms(start))}")
+            if end is not None:
+                rel = rel.filter(f"timestamp <= {bound(_to_epoch_ms(end))}")
+            if cached is not None:
+                return rel.select("* EXCLUDE(timestamp), timestamp")
+            timestamp = _ms_to_timestamp("timestamp")
+            return rel.select(f"* EXCLUDE(timestamp), {LABEL_MAP_EXPR} AS {LABEL_MAP_KEY}, {timestamp} AS timestamp")
+
+        return source
+
+    def _rollup_tier(self, metric_name: str, database: T.Optional[str], resolution: T.Optional[int]) -> T.Optional[int]:
+        # The coarsest tier whose buckets line up with buckets of the given resolution
+        if not resolution:
+            return None
+        tiers = [secs for secs in self._rollup_tiers(metric_name, database) if resolution % secs == 0]
+        return tiers[-1] if tiers else None
+
+    def _rollup_source(
+        self,
+        metric_name: str,
+        database: T.Optional[str],
+        cols: T.Dict[str, str],
+        secs: int,
+        start: T.Optional[TimeBound],
+        end: T.Optional[TimeBound],
+    ) -> DuckDBPyRelation:
+        # Each rollup row stands in for the last sample of its series in its bucket, with the same columns (in the same
+        # order) as the raw samples would have.  Filtering on the timestamp of that last sample gives the same answer
+        # as filtering the raw samples and then taking the last one, except in the bucket that the end bound falls in,
+        # where the last sample might be past the end; that bucket comes from the raw samples instead.
+        out_cols = [col for col in cols if col not in {"timestamp", SOURCE_FILE_COL}] + ["timestamp"]
+        rollup_cols = {"value": "last AS value", "timestamp": "last_ts AS timestamp"}
+        prefix = f"{database}." if database is not None else ""
+
+        rel = self._conn.sql(
+            f"SELECT {', '.join(rollup_cols.get(col, col) for col in out_cols)} "
+            f"FROM {prefix}{_rollup_table(metric_name, secs)}"
         )
+        if start is not None:
+            rel = rel.filter(f"timestamp >= {_ms_to_timestamp(_to_epoch_ms(start))}")
+        if end is None:
+            return rel
 
-        pod_owners = pod_owners.merge(
-            job_owners,
-            how="left",
-            left_on=["owner_name"],
-            right_on=["job"],
-            suffixes=(None, "_job"),
+        end_ts = _ms_to_timestamp(_to_epoch_ms(end))
+        end_bucket = f"time_bucket(INTERVAL '{secs}s', {end_ts})"
+        edge = self._conn.sql(f"SELECT {', '.join(out_cols)} FROM {prefix}{metric_name}").filter(
+            f"timestamp >= {end_bucket} AND timestamp <= {end_ts}"
         )
+        if start is not None:
+            edge = edge.filter(f"timestamp >= {_ms_to_timestamp(_to_epoch_ms(start))}")
+        return rel.filter(f"timestamp < {end_bucket}").union(edge)
+
+    def _load_lock(self, metric_name: str) -> threading.Lock:
+        # If another thread is loading this metric, we wait for it to finish and then check again (by which point
+        # there's usually nothing left to do)
+        with self._load_locks_lock:
+            return self._load_locks.setdefault(metric_name, threading.Lock())
+
+    def _open_cursor(self) -> None:
+        self._local.cursor = self._db.cursor()
+
+    def _plan_window_scans(self, files: T.List[str], windows: MsWindows) -> T.List[T.Tuple[T.List[str], int, int]]:
+        # DuckDB will only use the parquet row group statistics to skip data for simple range filters; it won't do
+        # anything useful with an OR over a bunch of windows.  So instead we look at the row group statistics for the
+        # timestamp column ourselves, figure out which row groups overlap with any of the windows, and merge those
+        # into contiguous time ranges.  Each range becomes its own scan (over only the files that have data in that
+        # range), with a BETWEEN filter that DuckDB _can_ push down.  If the data is very fragmented we merge the
+        # closest ranges together so that we don't end up with thousands of separate scans.
+        starts = [start for (start, _) in windows]
+        ends = [end for (_, end) in windows]
+        # (Row groups without statistics are assumed to overlap everything)
+        stats = self._conn.execute(
+            """
+            SELECT
+                file_name,
+                coalesce(stats_min_value::BIGINT, $min_ts),
+                coalesce(stats_max_value::BIGINT, $max_ts),
+            FROM parquet_metadata($files) WHERE path_in_schema = 'timestamp'
+            """,
+            {"files": files, "min_ts": starts[0], "max_ts": ends[-1]},
+        ).fetchall()
 
-        # The only owner metrics exposed by kube-state-metrics are pod, job, and rs:
-        # it's possible other things also have nested ownership, but we're not worried
-        # about those right now -- the standard k8s things (StatefulSets, DaemonSets,
-        # static pods) have fixed owners so we just copy those values over
-        pod_owners["root_owner"] = (
-            pod_owners["owner_name_rs"].fillna(pod_owners["owner_name_job"]).fillna(pod_owners["owner_name"])
+        row_groups = []
+        for filename, lo, hi in stats:
+            i = bisect_right(starts, hi) - 1
+            if i >= 0 and ends[i] >= lo:
+                row_groups.append((lo, hi, filename))
+
+        ranges: T.List[T.Tuple[int, int, T.Set[str]]] = []
+        for lo, hi, filename in sorted(row_groups):
+            if ranges and lo <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(hi, ranges[-1][1]), ranges[-1][2] | {filename})
+            else:
+                ranges.append((lo, hi, {filename}))
+
+        if len(ranges) > MAX_WINDOW_SCANS:
+            gaps = sorted(range(1, len(ranges)), key=lambda i: ranges[i][0] - ranges[i - 1][1])
+            splits = sorted(gaps[-(MAX_WINDOW_SCANS - 1) :])
+            ranges = [
+                (ranges[i][0], ranges[j - 1][1], set().union(*(r[2] for r in ranges[i:j])))
+                for (i, j) in zip([0] + splits, splits + [len(ranges)])
+            ]
+
+        # Clamp each range to the windows that overlap it so we read as little as possible at the edges
+        return [
+            (
+                sorted(range_files),
+                max(lo, starts[bisect_left(ends, lo)]),
+                min(hi, ends[bisect_right(starts, hi) - 1]),
+            )
+            for (lo, hi, range_files) in ranges
+        ]
+
+    def _scan_parquet(self, files: T.List[str], windows: T.Optional[MsWindows] = None) -> DuckDBPyRelation:
+        if windows is None:
+            return self._conn.read_parquet(files, filename=True, hive_partitioning=True)
+
+        rel = None
+        for scan_files, lo, hi in self._plan_window_scans(files, windows):
+            scan = self._conn.read_parquet(scan_files, filename=True, hive_partitioning=True).filter(
+                f"timestamp BETWEEN {lo} AND {hi}"
+            )
+            rel = scan if rel is None else rel.union(scan)
+
+        if rel is None:
+            return self._conn.read_parquet(files, filename=True, hive_partitioning=True).limit(0)
+        return _filter_windows(self._conn, rel, windows)
+
+    def _metric_tables(self, database: T.Optional[str] = None) -> T.Set[str]:
+        tables = self._conn.execute(
+            "SELECT table_name FROM duckdb_tables WHERE database_name = coalesce(?, current_database())",
+            [database],
+        ).fetchall()
+        return {table for (table,) in tables if not table.startswith("_datakube")}
+
+    def _table_columns(self, metric_name: str, database: T.Optional[str] = None) -> T.Dict[str, str]:
+        cols = self._conn.execute(
+            """
+            SELECT column_name, data_type FROM duckdb_columns
+            WHERE database_name = coalesce(?, current_database()) AND table_name = ?
+            ORDER BY column_index
+            """,
+            [database, metric_name],
+        ).fetchall()
+        return dict(cols)
+
+    def compute_pod_owners_map(self, namespace: str) -> pd.DataFrame:
+        return self.pod_owners(namespace).df()[["pod", "root_owner"]]
+
+    def pod_owners(self, namespace: str) -> DataKubeRelation:
+        # Every pod in the namespace, along with the object at the top of its ownership chain (e.g., the Deployment
+        # that owns the ReplicaSet that owns the pod).  Join this to a metric with DataKubeRelation.join_owners.  The
+        # result is cached for each namespace, and re-resolved when the windows or the owner metrics change.
+        ms_windows = _merge_windows(self.windows) if self.windows is not None else None
+        with self._load_lock(OWNERS_TABLE):
+            if not self.lazy:
+                for metric_name, _, _ in OWNER_METRICS:
+                    self._ensure_loaded(metric_name, ms_windows)
+
+            scope = self._owners_scope(ms_windows)
+            (cached,) = self._conn.execute(
+                f"SELECT count(*) FROM {OWNER_SCOPES_TABLE} WHERE namespace = ? AND scope = ?", [namespace, scope]
+            ).fetchone() or (0,)
+            if not cached:
+                self._resolve_pod_owners(namespace, ms_windows, scope)
+
+        # (The scope is part of the query so that memoized results computed from these owners are tied to it)
+        rel = self._conn.sql(
+            f"""
+            SELECT o.* FROM {OWNERS_TABLE} o
+            SEMI JOIN {OWNER_SCOPES_TABLE} s ON s.namespace = o.namespace AND s.scope = '{scope}'
+            WHERE o.namespace = '{namespace}'
+            """
         )
+        return DataKubeRelation(rel, self._conn, "pod", cache=self._results)
+
+    def _clear_pod_owners(self) -> None:
+        with self._load_lock(OWNERS_TABLE):
+            self._conn.query(f"DELETE FROM {OWNERS_TABLE}")
+            self._conn.query(f"DELETE FROM {OWNER_SCOPES_TABLE}")
+
+    def _owners_scope(self, windows: T.Optional[MsWindows]) -> str:
+        # Identifies the data that pod ownership gets resolved from: the windows, plus whatever each owner metric is
+        # being read from (the files and windows recorded for the cached copy, or the parquet files themselves)
+        parts = [repr(windows)]
+        for metric_name, _, _ in OWNER_METRICS:
+            cached = self._cached_table(metric_name)
+            if cached is None:
+                query = f"SELECT filename, size, last_modified FROM read_blob('{self._metric_glob(metric_name)}')"
+                parts.append(repr(self._conn.query(f"{query} ORDER BY filename").fetchall()))
+                continue
+
+            database = cached[1]
+            prefix = f"{database}." if database is not None else ""
+            files = self._conn.execute(
+                f"""
+                SELECT filename, size, last_modified FROM {prefix}{MANIFEST_TABLE}
+                WHERE metric = ? ORDER BY filename
+                """,
+                [metric_name],
+            ).fetchall()
+            parts.append(repr((files, self._cached_windows(metric_name, database))))
+        return _query_hash("\n".join(parts))
+
+    def _resolve_pod_owners(self, namespace: str, ms_windows: T.Optional[MsWindows], scope: str) -> None:
+        # Each of the owner metrics gives us a set of (object -> owner) edges; we take the first owner we saw for each
+        # object, and then follow the edges from each pod up to the root with a recursive CTE.  Objects whose owners
+        # don't show up in any of the metrics (StatefulSets, DaemonSets, Nodes for static pods, etc.) are roots.
+        # Whatever was resolved for the namespace before gets replaced.
+        edges = []
+        for metric_name, kind, name_expr in OWNER_METRICS:
+            edges.append(
+                self._metric_source(metric_name, ms_windows)(None, None, None)
+                .filter(f"namespace = '{namespace}'")
+                .select(
+                    f"""
+                    namespace, '{kind}' AS kind, {name_expr} AS name, timestamp,
+                    coalesce({LABEL_MAP_KEY}['owner_kind'], '') AS owner_kind,
+                    coalesce({LABEL_MAP_KEY}['owner_name'], '') AS owner_name,
+                    """
+                )
+            )
+
+        edges_view = f"_owner_edges_{threading.get_ident()}"
+        self._conn.register(edges_view, edges[0].union(edges[1]).union(edges[2]))
+        self._conn.begin()
+        try:
+            self._conn.execute(f"DELETE FROM {OWNERS_TABLE} WHERE namespace = ?", [namespace])
+            self._conn.execute(f"DELETE FROM {OWNER_SCOPES_TABLE} WHERE namespace = ?", [namespace])
+            self._conn.execute(f"INSERT INTO {OWNER_SCOPES_TABLE} VALUES (?, ?)", [namespace, scope])
+            self._conn.query(
+                f"""
+                INSERT INTO {OWNERS_TABLE}
+                WITH RECURSIVE owners AS (
+                    SELECT namespace, kind, name,
+                        arg_min({{'kind': owner_kind, 'name': owner_name}}, timestamp) AS owner,
+                    FROM {edges_view}
+                    GROUP BY ALL
+                ), chain AS (
+                    SELECT namespace, name AS pod, 1 AS depth, owner.kind AS owner_kind, owner.name AS owner_name
+                    FROM owners WHERE kind = 'Pod'
+                    UNION ALL
+                    SELECT c.namespace, c.pod, c.depth + 1, o.owner.kind, o.owner.name
+                    FROM chain c JOIN owners o
+                        ON o.namespace = c.namespace AND o.kind = c.owner_kind AND o.name = c.owner_name
+                    WHERE c.depth < {MAX_OWNER_DEPTH}
+                )
+                SELECT namespace, pod, arg_max(owner_kind, depth), arg_max(owner_name, depth)
+                FROM chain
+                GROUP BY ALL
+                """
+            )
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        finally:
+            self._conn.unregister(edges_view)
+
+
+def _cache_db_location(data_path: str, cache_root: str) -> str:
+    # Only data in S3 gets cached on disk (local data is read straight into memory)
+    path_parts = re.match(r"s3://([a-zA-Z_-]+)/(.*)", data_path)
+    if path_parts is None:
+        return ":memory:"
+    cache_location = f"{os.path.expanduser(cache_root)}/{path_parts.group(1)}/{path_parts.group(2)}/"
+    os.makedirs(cache_location, exist_ok=True)
+    return f"{cache_location}/{CACHED_DB_FILE}"
+
+
+def _filter_windows(
+    conn: DuckDBPyConnection,
+    rel: DuckDBPyRelation,
+    windows: MsWindows,
+    bound: T.Callable[[T.Union[str, int]], str] = str,
+) -> DuckDBPyRelation:
+    # The overall bounds can be pushed down into the scan; the (range) semi-join against the windows themselves
+    # takes care of everything in between.  The windows are registered under a name derived from their contents, so
+    # that the same windows always produce the same query (see ResultCache).  bound turns epoch milliseconds into
+    # something that compares with rel's timestamps (_ms_to_timestamp for cached tables; the raw parquet files are
+    # already in milliseconds).
+    windows_view = f"_windows_{_query_hash(repr(windows))}"
+    conn.register(windows_view, pd.DataFrame(windows, columns=["start_ms", "end_ms"]))
+    win_rel = conn.view(windows_view).select(f"{bound('start_ms')} AS start_ms, {bound('end_ms')} AS end_ms")
+    return rel.filter(f"timestamp BETWEEN {bound(windows[0][0])} AND {bound(windows[-1][1])}").join(
+        win_rel,
+        "timestamp BETWEEN start_ms AND end_ms",
+        how="semi",
+    )
+
+
+def _merge_windows(windows: T.Iterable[Window]) -> MsWindows:
+    return _merge_windows_ms([(_to_epoch_ms(start), _to_epoch_ms(end)) for (start, end) in windows])
+
+
+def _merge_windows_ms(windows: MsWindows) -> MsWindows:
+    merged: MsWindows = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _ms_to_timestamp(ms: T.Union[str, int]) -> str:
+    return f"to_timestamp({ms} / 1000)"
+
+
+def _rollup_query(metric_name: str, cols: T.Dict[str, str], secs: int, where: str = "true") -> str:
+    # One row per series per bucket; the parsed labels come along for the ride (they're the same for the whole series)
+    series = [col for col in cols if col not in {"timestamp", "value", SOURCE_FILE_COL, LABEL_MAP_KEY}]
+    aggs = [f"{expr} AS {name}" for (name, expr) in ROLLUP_AGGS.items()]
+    if LABEL_MAP_KEY in cols:
+        aggs.append(f"any_value({LABEL_MAP_KEY}) AS {LABEL_MAP_KEY}")
+    return f"""
+        SELECT time_bucket(INTERVAL '{secs}s', timestamp) AS timestamp, {", ".join(series + aggs)}
+        FROM {metric_name} WHERE {where}
+        GROUP BY ALL
+    """
+
+
+def _rollup_table(metric_name: str, secs: int) -> str:
+    return f"{ROLLUP_TABLE_PREFIX}{secs}_{metric_name}"
+
+
+def _sort_cols(rel: DuckDBPyRelation) -> str:
+    series = [col for col in SERIES_SORT_COLS if col in rel.columns]
+    return ", ".join([f"time_bucket(INTERVAL '{SORT_BUCKET_SECS}s', timestamp)", *series, "timestamp"])
+
+
+def _to_epoch_ms(t: TimeBound) -> int:
+    return round(t.timestamp() * 1000)
+
+
+def _with_lock_retries(fn: T.Callable[[], R], timeout: float) -> R:
+    # DuckDB doesn't wait for a lock on the database file, it just fails
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return fn()
+        except duckdb.IOException as e:
+            if "lock" not in str(e) or time.monotonic() >= deadline:
+                raise
+        time.sleep(LOCK_RETRY_SECS)
+
+
+def _windows_cover(outer: T.Optional[MsWindows], inner: T.Optional[MsWindows]) -> bool:
+    # None means "everything"; both lists of windows are assumed to be sorted and merged
+    if outer is None:
+        return True
+    if inner is None:
+        return False
 
-        return pod_owners[["pod", "root_owner"]]
+    outer_starts = [start for (start, _) in outer]
+    for start, end in inner:
+        i = bisect_right(outer_starts, start) - 1
+        if i < 0 or outer[i][1] < end:
+            return False
+    return True
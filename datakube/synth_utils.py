@@ -0,0 +1,143 @@
+import os
+import typing as T
+from datetime import datetime
+from datetime import timezone
+
+import duckdb
+
+# Roughly what you'd get from scraping kube-state-metrics and cAdvisor for a bunch of Deployments; the data is written
+# out the same way prom2parquet does it (one directory per metric, one file per hour), so PromReader can read it.
+GAUGE_METRICS = ["container_memory_working_set_bytes"]
+COUNTER_METRICS = ["container_cpu_usage_seconds_total"]
+OWNER_METRICS = ["kube_pod_owner", "kube_replicaset_owner", "kube_job_owner"]
+
+DEFAULT_START_TS = 1713394966
+FILE_SECS = 3600
+
+
+def generate_dataset(
+    path: str,
+    *,
+    namespaces: int = 2,
+    pods_per_namespace: int = 10,
+    containers_per_pod: int = 2,
+    jobs_per_namespace: int = 2,
+    extra_labels: int = 3,
+    label_cardinality: int = 10,
+    scrape_interval: int = 15,
+    duration: int = 3600,
+    reset_probability: float = 0.001,
+    start_ts: int = DEFAULT_START_TS,
+    seed: float = 0.5,
+) -> T.Dict[str, int]:
+    # Each pod belongs to a ReplicaSet (five pods per ReplicaSet), which belongs to a Deployment.  Every container gets
+    # a CPU counter (which resets to zero with probability reset_probability on every scrape, to simulate restarts)
+    # and a memory gauge; every series also gets extra_labels labels with label_cardinality distinct values each.
+    # There are also some pods owned by Jobs owned by CronJobs, which only show up in the owner metrics.  Scrapes have
+    # up to a second of jitter.  Returns the number of rows written for each metric.
+    conn = duckdb.connect(":memory:")
+    conn.execute("SELECT setseed(?)", [seed])
+
+    extra = " || ".join(f"',extra_{i}=v' || (hash(pod, {i}) % {label_cardinality})" for i in range(extra_labels))
+    conn.query(
+        f"""
+        CREATE TABLE series AS
+        SELECT
+            'ns-' || n AS namespace,
+            'app-' || (p // 5) || '-rs-' || n AS replicaset,
+            'app-' || (p // 5) AS deployment,
+            'app-' || (p // 5) || '-rs-' || n || '-' || p AS pod,
+            'container-' || c AS container,
+            'node-' || (hash(n, p) % 16) AS node,
+        FROM range({namespaces}) a(n), range({pods_per_namespace}) b(p), range({containers_per_pod}) d(c)
+        """
+    )
+    conn.query(
+        f"""
+        CREATE TABLE scrapes AS
+        SELECT
+            s.*,
+            t,
+            ({start_ts} + t * {scrape_interval}) * 1000 + (random() * 1000)::BIGINT AS timestamp,
+            'namespace=' || namespace || ',pod=' || pod || ',container=' || container {"|| " + extra if extra else ""}
+                AS labels,
+        FROM series s, range({duration // scrape_interval}) r(t)
+        """
+    )
+
+    conn.query(
+        f"""
+        CREATE TABLE job_scrapes AS
+        SELECT
+            'ns-' || n AS namespace,
+            'batch-' || j AS cronjob,
+            'batch-' || j || '-' || n AS job,
+            ({start_ts} + t * {scrape_interval}) * 1000 + (random() * 1000)::BIGINT AS timestamp,
+        FROM range({namespaces}) a(n), range({jobs_per_namespace}) b(j), range({duration // scrape_interval}) r(t)
+        """
+    )
+
+    metrics = {
+        # Memory is a random walk around a per-container baseline
+        "container_memory_working_set_bytes": """
+            SELECT timestamp, greatest(
+                (hash(pod, container) % 512 + 64) * 1048576.0
+                    + sum((random() - 0.5) * 1048576) OVER (PARTITION BY pod, container ORDER BY timestamp),
+                0
+            ) AS value, pod, container, namespace, node, labels,
+            FROM scrapes
+        """,
+        # CPU is a counter, which restarts from 0 whenever the container does
+        "container_cpu_usage_seconds_total": f"""
+            SELECT timestamp, sum(increment) OVER (PARTITION BY pod, container, restarts ORDER BY timestamp) AS value,
+                pod, container, namespace, node, labels,
+            FROM (
+                SELECT *, sum(restarted::INT) OVER (PARTITION BY pod, container ORDER BY timestamp) AS restarts
+                FROM (
+                    SELECT *,
+                        random() * {scrape_interval} * 0.5 AS increment,
+                        random() < {reset_probability} AS restarted,
+                    FROM scrapes
+                )
+            )
+        """,
+        "kube_pod_owner": """
+            SELECT timestamp, 1.0 AS value, pod, '' AS container, namespace, '' AS node,
+                'owner_kind=ReplicaSet,owner_name=' || replicaset || ',pod=' || pod AS labels,
+            FROM scrapes WHERE container = 'container-0'
+            UNION ALL
+            SELECT timestamp, 1.0, job || '-x', '', namespace, '',
+                'owner_kind=Job,owner_name=' || job || ',pod=' || job || '-x',
+            FROM job_scrapes
+        """,
+        "kube_replicaset_owner": """
+            SELECT min(timestamp) AS timestamp, 1.0 AS value, '' AS pod, '' AS container, namespace, '' AS node,
+                'owner_kind=Deployment,owner_name=' || deployment || ',replicaset=' || replicaset AS labels,
+            FROM scrapes
+            GROUP BY t, namespace, deployment, replicaset
+        """,
+        "kube_job_owner": """
+            SELECT timestamp, 1.0 AS value, '' AS pod, '' AS container, namespace, '' AS node,
+                'job=kube-state-metrics,job_name=' || job || ',owner_kind=CronJob,owner_name=' || cronjob AS labels,
+            FROM job_scrapes
+        """,
+    }
+
+    rows = {}
+    for metric_name, query in metrics.items():
+        os.makedirs(os.path.join(path, metric_name), exist_ok=True)
+        conn.query(f"CREATE OR REPLACE TABLE metric AS {query}")
+        rows[metric_name] = conn.table("metric").count("*").fetchone()[0]  # type: ignore
+
+        # One file per hour, named like prom2parquet names them
+        file_ms = FILE_SECS * 1000
+        for (i,) in conn.query(f"SELECT DISTINCT timestamp // {file_ms} FROM metric ORDER BY 1").fetchall():
+            filename = datetime.fromtimestamp(i * FILE_SECS, tz=timezone.utc).strftime("%Y%m%d%H")
+            conn.query(
+                f"""
+                COPY (SELECT * FROM metric WHERE timestamp // {file_ms} = {i} ORDER BY timestamp)
+                TO '{os.path.join(path, metric_name, filename)}.parquet' (FORMAT PARQUET)
+                """
+            )
+
+    return rows
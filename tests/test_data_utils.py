@@ -1,12 +1,20 @@
+import tracemalloc
+
 import arrow
 import duckdb
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import pytest
 from pandas.testing import assert_frame_equal
 
+from datakube.data_utils import LABEL_MAP_EXPR
+from datakube.data_utils import Binning
 from datakube.data_utils import DataKubeRelation
+from datakube.data_utils import FillStrategy
 from datakube.data_utils import counter_diff
+from datakube.data_utils import delta_histogram
+from datakube.data_utils import delta_quantiles
 from tests.conftest import DATA_COLS
 
 TEST_METRIC_NAME = "test_metric"
@@ -20,11 +28,232 @@ def rel(df):
     return DataKubeRelation(rel, conn, None)
 
 
+@pytest.fixture
+def labels_rel():
+    conn = duckdb.connect(":memory:")
+    rel = conn.query("SELECT * FROM (VALUES ('app=foo,tier=web', 1), ('app=foobar,tier=db', 2)) t(labels, value)")
+    return DataKubeRelation(rel, conn, None)
+
+
+@pytest.mark.parametrize("parsed", [True, False])
+def test_with_label_exact_match(labels_rel, parsed):
+    if parsed:
+        labels_rel._rel = labels_rel._rel.select(f"*, {LABEL_MAP_EXPR} AS label_map")
+    assert labels_rel.copy().with_label("app", "foo").df()["value"].tolist() == [1]
+    assert labels_rel.copy().with_label("app", "fo").df()["value"].tolist() == []
+
+
+@pytest.mark.parametrize("parsed", [True, False])
+def test_extract_label(labels_rel, parsed):
+    if parsed:
+        labels_rel._rel = labels_rel._rel.select(f"*, {LABEL_MAP_EXPR} AS label_map")
+    df = labels_rel.extract_label("tier").extract_label("missing").df()
+    assert df["tier"].tolist() == ["web", "db"]
+    assert df["missing"].tolist() == ["", ""]
+
+
+@pytest.fixture
+def sparse_rel():
+    # One sample every 10s for pod a (with a missing scrape), and a single sample for pod b
+    conn = duckdb.connect(":memory:")
+    rel = conn.query(
+        """
+        SELECT to_timestamp(ts) AS timestamp, pod, value, 'pod=' || pod AS labels
+        FROM (VALUES (0.5, 'a', 1.0), (10.5, 'a', 2.0), (30.5, 'a', 4.0), (5.2, 'b', 7.0)) t(ts, pod, value)
+        """
+    )
+    return DataKubeRelation(rel, conn, "pod")
+
+
+def test_fill_missing_data_locf(sparse_rel):
+    df = sparse_rel.fill_missing_data(resolution=5, max_staleness=10).df().sort_values(["pod", "timestamp"])
+    assert df["pod"].tolist() == ["a"] * 7 + ["b"]
+    assert df["value"].fillna(-1).tolist() == [1, 1, 2, 2, 2, -1, 4, 7]
+    assert df["labels"].fillna("").tolist()[5:] == ["", "pod=a", "pod=b"]
+
+
+def test_fill_missing_data_linear(sparse_rel):
+    df = (
+        sparse_rel.fill_missing_data(resolution=5, strategy=FillStrategy.LINEAR, max_staleness=20)
+        .df()
+        .sort_values(["pod", "timestamp"])
+    )
+    assert df["value"].tolist()[:7] == [1, 1.5, 2, 2.5, 3, 3.5, 4]
+
+
+@pytest.fixture
+def counter_rel():
+    # Pod a has a counter reset at t=30; pod b is a steady counter, and shouldn't affect pod a at all
+    conn = duckdb.connect(":memory:")
+    rel = conn.query(
+        """
+        SELECT to_timestamp(ts) AS timestamp, pod, value
+        FROM (VALUES (0, 0.0), (10, 10.0), (20, 20.0), (30, 5.0), (40, 15.0), (50, 25.0), (60, 35.0)) a(ts, value),
+            (VALUES ('a')) p(pod)
+        UNION ALL
+        SELECT to_timestamp(ts), 'b', ts * 100.0 FROM range(0, 61, 15) t(ts)
+        """
+    )
+    return DataKubeRelation(rel, conn, "pod")
+
+
+def test_increase(counter_rel):
+    df = counter_rel.increase(30).df().sort_values(["pod", "timestamp"])
+    a = df[df["pod"] == "a"]
+    assert a["increase"].fillna(-1).tolist() == pytest.approx([-1, 10, 20, 25, 25, 25, 30])
+    assert df[df["pod"] == "b"]["increase"].tolist()[2:] == pytest.approx([3000, 3000, 3000])
+
+
+def test_increase_extrapolates_to_window_start(counter_rel):
+    # The window at t=60 is [20, 60], but the first sample is at t=30, so we extrapolate back 10s
+    df = counter_rel.increase(40).df().sort_values(["pod", "timestamp"])
+    assert df[df["pod"] == "b"]["increase"].tolist()[-1] == pytest.approx(4000)
+
+
+def test_rate(counter_rel):
+    df = counter_rel.rate(30).df().sort_values(["pod", "timestamp"])
+    assert df[df["pod"] == "a"]["rate"].tolist()[-1] == pytest.approx(1)
+    assert df[df["pod"] == "b"]["rate"].tolist()[-1] == pytest.approx(100)
+
+
+def test_irate(counter_rel):
+    df = counter_rel.irate(10).df().sort_values(["pod", "timestamp"])
+    assert df[df["pod"] == "a"]["irate"].fillna(-1).tolist() == [-1, 1, 1, 0.5, 1, 1, 1]
+    assert df[df["pod"] == "b"]["irate"].isna().all()
+
+
 def test_counter_diff(df):
     expected = pd.DataFrame({"values1": [np.nan] + [1] * 9, "values2": [np.nan, 25, 0, 1, 1, 3, 0, 1, 2, 2]})
     assert_frame_equal(counter_diff(df[DATA_COLS]), expected)
 
 
+@pytest.fixture
+def long_df(df):
+    return df.melt(id_vars="timestamp", value_vars=DATA_COLS, var_name="sim", value_name="value")
+
+
+@pytest.mark.parametrize("binning", [Binning.LINEAR, Binning.LOG])
+def test_delta_histogram(df, long_df, binning):
+    counts, bins = delta_histogram(df[DATA_COLS], nbins=4, binning=binning)
+    assert counts.sum() == 16
+    assert bins[-1] == 25
+
+    conn = duckdb.connect(":memory:")
+    rel_counts, rel_bins = DataKubeRelation(conn.from_df(long_df), conn, None).delta_histogram(nbins=4, binning=binning)
+    np.testing.assert_array_equal(rel_counts, counts)
+    np.testing.assert_allclose(rel_bins, bins)
+
+
+def test_delta_histogram_empty(df):
+    with pytest.raises(ValueError):
+        delta_histogram(df[DATA_COLS], baseline=100)
+
+
+def test_delta_quantiles(df, long_df):
+    expected = delta_quantiles(df[DATA_COLS], [0, 0.5, 1])
+    assert expected.tolist() == [1, 1, 25]
+
+    conn = duckdb.connect(":memory:")
+    res = DataKubeRelation(conn.from_df(long_df), conn, None).delta_quantiles([0, 0.5, 1])
+    pd.testing.assert_series_equal(res, expected)
+
+
+def test_partition_and_normalize_gaps(rel):
+    split1 = (arrow.get(11), arrow.get(13))
+    split2 = (arrow.get(15), arrow.get(18))
+    df = rel.partition_and_normalize([split1, split2]).df().set_index("values1").sort_index()
+
+    # Anything before the first split or after the last one is dropped; anything in between that isn't in one of the
+    # splits is unassigned
+    assert df.index.tolist() == list(range(2, 10))
+    assert df.loc[[5], ["sim", "start", "normalized_ts"]].isna().all().all()
+    assert df.loc[6, "sim"] == "sim.1"
+    assert df.loc[9, "normalized_ts"] == pd.Timedelta(seconds=3)
+
+
+def test_partition_and_normalize_interval_df(rel):
+    splits = [(arrow.get(11), arrow.get(13)), (arrow.get(15), arrow.get(18))]
+    intervals = pd.DataFrame({"start": [s.datetime for (s, _) in splits], "end": [e.datetime for (_, e) in splits]})
+    expected = rel.copy().partition_and_normalize(splits).df()
+    assert_frame_equal(rel.partition_and_normalize(intervals).df(), expected)
+
+
+def test_split_materialized(rel):
+    split1 = (arrow.get(11), arrow.get(13))
+    split2 = (arrow.get(15), arrow.get(18))
+    lazy = rel.copy().partition_and_normalize([split1, split2]).split()
+    materialized = rel.partition_and_normalize([split1, split2]).split(materialize=True)
+
+    assert list(lazy) == list(materialized)
+    for sim in lazy:
+        assert_frame_equal(lazy[sim].df(), materialized[sim].df())
+    assert rel._conn.query("SELECT count(*) FROM duckdb_tables WHERE temporary").fetchone() == (1,)
+
+    # Re-splitting the same pipeline shares the table, which sticks around until the last relation using it is gone
+    again = rel.split(materialize=True)["sim.0"].copy()
+    del materialized
+    assert_frame_equal(again.df(), lazy["sim.0"].df())
+    del again
+    assert rel._conn.query("SELECT count(*) FROM duckdb_tables WHERE temporary").fetchone() == (0,)
+
+
+def test_to_pivot_table(rel):
+    split1 = (arrow.get(11), arrow.get(13))
+    split2 = (arrow.get(15), arrow.get(18))
+    df = rel.partition_and_normalize([split1, split2]).to_pivot_table(value_column="values1")
+
+    expected = pd.DataFrame(
+        {"sim.0": [2.0, 3.0, 4.0], "sim.1": [6.0, 7.0, 8.0]},
+        index=pd.Index([0.0, 1.0, 2.0], name="normalized_ts"),
+    )
+    assert_frame_equal(df, expected, check_dtype=False)
+
+
+def test_to_pivot_table_empty(rel):
+    with pytest.raises(ValueError):
+        rel.partition_and_normalize([(arrow.get(100), arrow.get(110))]).to_pivot_table(value_column="values1")
+
+
+def test_to_pivot_table_resolution(rel):
+    split1 = (arrow.get(11), arrow.get(13))
+    split2 = (arrow.get(15), arrow.get(18))
+    df = rel.partition_and_normalize([split1, split2]).to_pivot_table(value_column="values1", resolution=2)
+
+    # Each bucket gets the last value in it
+    expected = pd.DataFrame(
+        {"sim.0": [3.0, 4.0], "sim.1": [7.0, 9.0]},
+        index=pd.Index([0.0, 2.0], name="normalized_ts"),
+    )
+    assert_frame_equal(df, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("resolution", [1, 2])
+def test_to_summary_table(rel, resolution):
+    splits = [(arrow.get(10), arrow.get(12)), (arrow.get(13), arrow.get(15)), (arrow.get(16), arrow.get(19))]
+    rel = rel.partition_and_normalize(splits)
+    pivot = rel.copy().to_pivot_table(value_column="values2", resolution=resolution).astype(float)
+    summary = rel.to_summary_table(value_column="values2", quantiles=[0.5, 0.9], resolution=resolution)
+
+    expected = pd.DataFrame({
+        "mean": pivot.mean(axis=1),
+        "stddev": pivot.std(axis=1),
+        "p50": pivot.quantile(0.5, axis=1),
+        "p90": pivot.quantile(0.9, axis=1),
+    })
+    assert_frame_equal(summary, expected)
+
+
+def test_independent_pipelines(rel):
+    # Both of these go through raw SQL on the same connection, and mustn't interfere with each other
+    r0 = rel.copy().partition_and_normalize([(arrow.get(11), arrow.get(13))])
+    r1 = rel.copy().partition_and_normalize([(arrow.get(15), arrow.get(18))])
+    p0 = r0.to_pivot_table(value_column="values1")
+    p1 = r1.to_pivot_table(value_column="values1")
+
+    assert p0["sim.0"].tolist() == [2, 3]
+    assert p1["sim.0"].tolist() == [6, 7, 8]
+
+
 def test_normalized_df_timestamp_range(rel):
     split1 = (arrow.get(11), arrow.get(13))
     split2 = (arrow.get(15), arrow.get(18))
@@ -47,3 +276,46 @@ def test_normalized_df_timestamp_range(rel):
         check_index=False,
         check_names=False,
     )
+
+
+def test_streaming_exports(rel, tmp_path):
+    expected = rel.df()
+    assert [b.num_rows for b in rel.iter_batches(batch_size=4)] == [4, 4, 2]
+    assert_frame_equal(pd.concat(rel.iter_dfs(chunk_size=4), ignore_index=True), expected)
+    assert rel.to_arrow().num_rows == len(expected)
+
+    rel.to_parquet(str(tmp_path / "out.parquet"))
+    assert_frame_equal(pq.read_table(tmp_path / "out.parquet").to_pandas(), expected, check_dtype=False)
+    rel.to_parquet(str(tmp_path / "parts"), partition_by=["values2"])
+    assert len(list((tmp_path / "parts").iterdir())) == expected["values2"].nunique()
+
+    # The relation is still usable afterwards
+    assert_frame_equal(rel.df(), expected)
+
+    # Exports get profiled like any other terminal operation
+    profiled = rel.copy().profile()
+    profiled.to_parquet(str(tmp_path / "profiled.parquet"))
+    assert [(s.name, s.rows_out) for s in profiled.last_profile.stages][-1] == ("to_parquet", len(expected))
+
+
+def test_iter_dfs_memory():
+    conn = duckdb.connect(":memory:")
+    rel = DataKubeRelation(
+        conn.sql("SELECT range AS x, 'pod-' || (range % 1000) AS pod, range * 1.5 AS value FROM range(1000000)"),
+        conn,
+        "pod",
+    )
+    next(rel.iter_dfs(chunk_size=10))  # (get the imports out of the way)
+
+    tracemalloc.start()
+    try:
+        rows = sum(len(chunk) for chunk in rel.iter_dfs(chunk_size=20000))
+        (_, streamed_peak) = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        full = rel.df()
+        (_, full_peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert rows == len(full) == 1000000
+    assert streamed_peak < full_peak / 10
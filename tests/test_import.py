@@ -0,0 +1,35 @@
+import subprocess
+import sys
+
+import pytest
+
+# Importing the package shouldn't pull in anything that only some users need
+HEAVY_MODULES = ["arrow", "bokeh", "colorcet", "duckdb", "kubernetes"]
+
+# Almost all of the cold import time is pandas (~0.3s); this is loose enough not to be flaky, but tight enough to
+# catch something like bokeh or the kubernetes client sneaking back in (each of which adds about a second)
+IMPORT_TIME_BUDGET_SECS = 1.0
+
+
+def run_python(code: str) -> str:
+    return subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+
+
+def test_import_is_lazy():
+    loaded = run_python(f"import sys, datakube; print(*[m for m in {HEAVY_MODULES} if m in sys.modules])")
+    assert loaded.split() == []
+
+
+def test_lazy_attributes():
+    loaded = run_python("import sys, datakube; datakube.PromReader; print(*sorted(sys.modules))")
+    assert "duckdb" in loaded.split()
+    assert "bokeh" not in loaded.split()
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run_python("import datakube; datakube.not_a_thing")
+
+
+def test_import_time():
+    code = "import time; start = time.perf_counter(); import datakube; print(time.perf_counter() - start)"
+    best = min(float(run_python(code)) for _ in range(3))
+    assert best < IMPORT_TIME_BUDGET_SECS
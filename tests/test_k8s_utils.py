@@ -1,9 +1,14 @@
+import arrow
 import pandas as pd
 import pytest
 from kubernetes.client import V1PodList
+from pandas.testing import assert_frame_equal
 
+from datakube.k8s_utils import concurrency_timeline
 from datakube.k8s_utils import fetch_pod_intervals
 from datakube.k8s_utils import read_obj_from_json
+from datakube.k8s_utils import read_pod_intervals
+from datakube.k8s_utils import window_overlaps
 
 
 @pytest.fixture
@@ -26,3 +31,52 @@ def test_fetch_pod_intervals(pod_list):
     ]
     expected_intervals = [(pd.Timestamp(s), pd.Timestamp(e)) for s, e in expected_time_strs]
     assert fetch_pod_intervals(pod_list) == expected_intervals
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 20])
+def test_read_pod_intervals(pod_list, chunk_size):
+    df = read_pod_intervals("./tests/data/jobs.json", chunk_size=chunk_size)
+    assert list(df.columns) == ["pod", "start", "end"]
+    assert list(zip(df["start"], df["end"])) == fetch_pod_intervals(pod_list)
+    assert df["pod"].str.startswith("sk-dsb-sn-static-driver-").all()
+
+
+def test_read_pod_intervals_per_container(pod_list):
+    df = read_pod_intervals("./tests/data/jobs.json", per_container=True)
+    ncontainers = sum(len(pod.status.container_statuses) for pod in pod_list.items)
+    assert len(df) == ncontainers
+    assert list(df.columns) == ["pod", "container", "start", "end"]
+
+
+@pytest.fixture
+def intervals():
+    return [(arrow.get(start), arrow.get(end)) for (start, end) in [(0, 10), (1, 2), (5, 15), (10, 12), (20, 21)]]
+
+
+def test_concurrency_timeline(intervals, pod_list):
+    expected = pd.DataFrame(
+        {"running": [1, 2, 2, 0, 1], "peak": [2, 2, 2, 0, 1]},
+        index=pd.Index([0.0, 5.0, 10.0, 15.0, 20.0], name="normalized_ts"),
+    )
+    assert_frame_equal(concurrency_timeline(intervals, resolution=5), expected)
+
+    # The pods in the test data ran one after another
+    timeline = concurrency_timeline(read_pod_intervals("./tests/data/jobs.json"), resolution=60)
+    assert timeline["peak"].max() == 1
+    assert_frame_equal(concurrency_timeline(fetch_pod_intervals(pod_list), resolution=60), timeline)
+
+
+def test_window_overlaps(intervals):
+    windows = [(arrow.get(0), arrow.get(10)), (arrow.get(10), arrow.get(30))]
+    overlaps = window_overlaps(intervals, windows)
+    assert list(overlaps.index) == ["sim.0", "sim.1"]
+    assert overlaps["overlapping"].tolist() == [3, 3]
+    assert overlaps["running_secs"].tolist() == [16.0, 8.0]
+    assert overlaps["mean_running"].tolist() == [1.6, 0.4]
+    assert overlaps["peak_running"].tolist() == [2, 2]
+
+    # With nothing running, every window is still there, just empty
+    empty = window_overlaps([], windows)
+    assert list(empty.index) == ["sim.0", "sim.1"]
+    for col in ["overlapping", "running_secs", "mean_running", "peak_running"]:
+        assert empty[col].tolist() == [0, 0]
@@ -1,6 +1,11 @@
+import numpy as np
+import pandas as pd
 import pytest
+from bokeh.models import VArea
 
+from datakube import plot_utils
 from datakube.plot_utils import _compute_extents
+from datakube.plot_utils import downsample
 from tests.conftest import DATA_COLS
 
 
@@ -11,3 +16,65 @@ def test_compute_extents(df, stack):
     assert xmax == 9
     assert ymin == -11
     assert ymax == 30 if stack else 20
+
+
+@pytest.fixture
+def summary_df():
+    return pd.DataFrame(
+        {"mean": [1.0, 2.0, 3.0], "stddev": [0.5, 2.5, 1.0], "p50": [1.0, 2.0, 2.5], "p90": [2.0, 3.0, 4.5]},
+        index=pd.Index([0.0, 1.0, 2.0], name="normalized_ts"),
+    )
+
+
+def test_compute_extents_band(summary_df):
+    assert _compute_extents(summary_df, band=True) == (0, 2, -0.5, 4.5)
+
+
+def test_plot_multiseries_band(summary_df, monkeypatch):
+    shown = []
+    monkeypatch.setattr(plot_utils, "_show", shown.append)
+    plot_utils.plot_multiseries({"cpu": summary_df}, band=True)
+
+    (fig,) = [child for (child, _, _) in shown[0].children]
+    glyphs = [r.glyph for r in fig.renderers]
+    assert sum(isinstance(g, VArea) for g in glyphs) == 1
+    lines = {g.y for g in glyphs if isinstance(getattr(g, "y", None), str)}
+    assert {"mean", "p50", "p90"} <= lines and "stddev" not in lines
+
+
+def test_plot_multiseries_stack_not_downsampled(monkeypatch):
+    df = pd.DataFrame(
+        {"sim0": np.sin(np.arange(1000) / 10), "sim1": np.cos(np.arange(1000) / 10)},
+        index=pd.Index(np.arange(1000, dtype=float), name="normalized_ts"),
+    )
+    sums = df.sum(axis=1)
+    shown = []
+    monkeypatch.setattr(plot_utils, "_show", shown.append)
+    plot_utils.plot_multiseries({"cpu": df}, stack=True, max_points=100)
+
+    # Each row's stack adds up to the same thing as in the original data
+    (fig,) = [child for (child, _, _) in shown[0].children]
+    data = fig.renderers[0].data_source.data
+    np.testing.assert_allclose(np.asarray(data["sim0"]) + np.asarray(data["sim1"]), sums)
+
+
+def test_downsample_keeps_peaks():
+    df = pd.DataFrame(
+        {"sim0": np.sin(np.arange(10000) / 100), "sim1": np.zeros(10000)},
+        index=pd.Index(np.arange(10000), name="normalized_ts"),
+    )
+    df.loc[5003, "sim1"] = 100
+    df.loc[7001, "sim1"] = np.nan
+
+    res = downsample(df, 100)
+    assert len(res) == 100
+    assert res.index.name == "normalized_ts"
+    assert res.index.is_monotonic_increasing
+    assert res["sim0"].max() == df["sim0"].max()
+    assert res["sim0"].min() == df["sim0"].min()
+    assert res["sim1"].max() == 100
+
+
+def test_downsample_short_series():
+    df = pd.DataFrame({"sim0": [1.0, 2.0, 3.0]})
+    assert downsample(df, 100) is df
@@ -0,0 +1,123 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import arrow
+import pytest
+import simplejson as json
+
+from datakube.prom_api_utils import PromAPIClient
+from datakube.prom_utils import MANIFEST_TABLE
+from datakube.prom_utils import PromReader
+
+# Hour-aligned, so the shards line up with it
+STUB_START_TS = 1713394800
+
+# The stub server has samples up to here (like a Prometheus that's still scraping)
+STUB_END_TS = STUB_START_TS + 1200
+
+SERIES = [
+    {"__name__": "cpu", "pod": "web-1", "namespace": "default", "job": "kubelet", "instance": "node-1"},
+    {"__name__": "cpu", "pod": "db-1", "namespace": "default", "job": "kubelet", "instance": "node-2"},
+]
+
+
+class StubPrometheus(BaseHTTPRequestHandler):
+    # Answers query_range requests with a value equal to the evaluation time, for each of the SERIES; keeps track of
+    # the connections it's seen (by client port) so we can check that they get reused
+    protocol_version = "HTTP/1.1"
+    ports: set = set()
+
+    def do_GET(self):
+        StubPrometheus.ports.add(self.client_address[1])
+        url = urlparse(self.path)
+        params = {k: v[0] for (k, v) in parse_qs(url.query).items()}
+        if url.path != "/api/v1/query_range" or params["query"] == "bad":
+            self._reply(400, {"status": "error", "errorType": "bad_data", "error": "parse error"})
+            return
+        if params["query"] == "unavailable":
+            self._reply(503, b"<html>Service Unavailable</html>", "text/html")
+            return
+
+        (start, end, step) = (int(params["start"]), int(params["end"]), int(params["step"]))
+        times = range(start, min(end, STUB_END_TS) + 1, step)
+        result = [{"metric": series, "values": [[t, str(float(t))] for t in times]} for series in SERIES]
+        self._reply(200, {"status": "success", "data": {"resultType": "matrix", "result": result}})
+
+    def _reply(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def prom_url():
+    StubPrometheus.ports = set()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPrometheus)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_query_range(prom_url):
+    client = PromAPIClient(prom_url, step=15, shard_secs=120, parallelism=2)
+    shards = sorted(client.query_range("cpu", arrow.get(STUB_START_TS + 10), arrow.get(STUB_START_TS + 700)))
+
+    # The shards are aligned to multiples of the shard size, and don't overlap
+    assert [s.start_ms // 1000 - STUB_START_TS for s in shards] == [0, 120, 240, 360, 480, 600]
+    assert all(len(s.df) == 2 * 120 // 15 for s in shards)
+
+    df = shards[0].df
+    assert list(df.columns) == ["timestamp", "value", "pod", "container", "namespace", "node", "labels", "filename"]
+    assert df["timestamp"].iloc[1] == (STUB_START_TS + 15) * 1000
+    assert df["value"].iloc[1] == STUB_START_TS + 15
+    assert set(df["pod"]) == {"web-1", "db-1"}
+    assert set(df["labels"]) == {"instance=node-1,job=kubelet", "instance=node-2,job=kubelet"}
+
+    # Six requests, but never more than two connections
+    assert client.requests == 6
+    assert len(StubPrometheus.ports) <= 2
+
+
+def test_query_range_error(prom_url):
+    client = PromAPIClient(prom_url)
+    with pytest.raises(RuntimeError, match="parse error"):
+        list(client.query_range("bad", arrow.get(STUB_START_TS), arrow.get(STUB_START_TS + 60)))
+
+    # Error pages that aren't JSON (e.g., from a proxy in front of Prometheus) still get reported with their status,
+    # once the retries run out
+    client = PromAPIClient(prom_url, retries=1)
+    with pytest.raises(RuntimeError, match=r"\(503\).*Service Unavailable"):
+        list(client.query_range("unavailable", arrow.get(STUB_START_TS), arrow.get(STUB_START_TS + 60)))
+
+    with pytest.raises(ValueError):
+        PromAPIClient(prom_url, step=7, shard_secs=60)
+
+
+def test_load_from_prometheus(prom_url, tmp_path):
+    reader = PromReader(str(tmp_path))
+    client = PromAPIClient(prom_url, step=15, shard_secs=300)
+    assert reader.load_from_prometheus(client, "cpu", arrow.get(STUB_START_TS), arrow.get(STUB_START_TS + 599)) == 2
+
+    df = reader.query_metric("cpu", "pod").df()
+    assert len(df) == 2 * 600 // 15
+    assert df["label_map"][0]["job"] == "kubelet"
+    assert (df["value"] == df["timestamp"].map(lambda ts: ts.timestamp())).all()
+
+    # Loading an overlapping range replaces the shards we already had instead of doubling them up; the last shard only
+    # has the samples that the server had
+    assert reader.load_from_prometheus(client, "cpu", arrow.get(STUB_START_TS + 300), arrow.get(STUB_END_TS)) == 4
+    df = reader.query_metric("cpu", "pod").df()
+    assert len(df) == 2 * (1200 // 15 + 1)
+    assert not df.duplicated(["pod", "timestamp"]).any()
+    assert reader._conn.query(f"SELECT count(*) FROM {MANIFEST_TABLE}").fetchone() == (5,)
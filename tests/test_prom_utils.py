@@ -1,3 +1,518 @@
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import arrow
+import duckdb
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from datakube import prom_utils
+from datakube.cache_utils import RESULT_TABLE_PREFIX
+from datakube.cache_utils import _result_key
+from datakube.data_utils import Comparison
+from datakube.prom_utils import MANIFEST_TABLE
+from datakube.prom_utils import WINDOWS_TABLE
+from datakube.prom_utils import PromReader
+from datakube.synth_utils import generate_dataset
+
+TEST_METRIC_NAME = "kube_job_owner"
+TEST_PARQUET_FILE = f"./tests/data/{TEST_METRIC_NAME}/2024041723.parquet"
+
+# The test data has one sample per second starting here
+TEST_START_TS = 1713394966
+
+
+def write_parquet_slice(path, start: int, end: int, row_group_size: int = 122880):
+    duckdb.sql(
+        f"""
+        COPY (SELECT * FROM read_parquet('{TEST_PARQUET_FILE}') ORDER BY timestamp LIMIT {end - start} OFFSET {start})
+        TO '{path}' (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size})
+        """
+    )
+
+
+def window(start: int, end: int):
+    return (arrow.get(TEST_START_TS + start), arrow.get(TEST_START_TS + end))
+
+
+def write_owner_metric(path, rows):
+    # rows are (pod, namespace, labels)
+    path.parent.mkdir(exist_ok=True)
+    df = pd.DataFrame(
+        [(TEST_START_TS * 1000 + i, 1.0, pod, "", ns, "", labels) for i, (pod, ns, labels) in enumerate(rows)],
+        columns=["timestamp", "value", "pod", "container", "namespace", "node", "labels"],
+    )
+    duckdb.from_df(df).write_parquet(str(path))
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    (tmp_path / TEST_METRIC_NAME).mkdir()
+    write_parquet_slice(tmp_path / TEST_METRIC_NAME / "00.parquet", 0, 1000)
+    write_parquet_slice(tmp_path / TEST_METRIC_NAME / "01.parquet", 1000, 2000)
+    return tmp_path
+
+
+def test_query_metric_local(data_path):
+    reader = PromReader(str(data_path))
+    df = reader.query_metric(TEST_METRIC_NAME, "job").df()
+    assert len(df) == 2000
+    assert "source_file" not in df.columns
+    assert df["label_map"][0]["owner_kind"] == "Simulation"
+    assert reader._conn.query(f"SELECT count(*) FROM {MANIFEST_TABLE}").fetchone() == (2,)
+
+
+def test_refresh_appends_new_files(data_path):
+    reader = PromReader(str(data_path))
+    reader.query_metric(TEST_METRIC_NAME)
+    assert reader.refresh() == {TEST_METRIC_NAME: 0}
+
+    write_parquet_slice(data_path / TEST_METRIC_NAME / "02.parquet", 2000, 3480)
+    assert reader.refresh(TEST_METRIC_NAME) == {TEST_METRIC_NAME: 1}
+    assert len(reader.query_metric(TEST_METRIC_NAME).df()) == 3480
+
+
+def test_refresh_replaces_changed_files(data_path):
+    reader = PromReader(str(data_path), auto_refresh=True)
+    reader.query_metric(TEST_METRIC_NAME)
+
+    write_parquet_slice(data_path / TEST_METRIC_NAME / "01.parquet", 1000, 1500)
+    assert len(reader.query_metric(TEST_METRIC_NAME).df()) == 1500
+    assert reader._conn.query(f"SELECT count(*) FROM {MANIFEST_TABLE}").fetchone() == (2,)
+
+
+def test_cached_layout(data_path):
+    reader = PromReader(str(data_path))
+    expected = reader.query_metric(TEST_METRIC_NAME, lazy=True).df().sort_values("timestamp", ignore_index=True)
+    reader.query_metric(TEST_METRIC_NAME)
+
+    assert reader._table_columns(TEST_METRIC_NAME)["timestamp"] == "TIMESTAMP WITH TIME ZONE"
+    order = "time_bucket(INTERVAL '1h', timestamp), namespace, pod, container, labels, timestamp"
+    table = reader._conn.table(TEST_METRIC_NAME)
+    assert table.fetchall() == table.order(order).fetchall()
+
+    # Reading from the cached table gives the same answer as reading the parquet files
+    end = arrow.get(TEST_START_TS + 1500)
+    expected = expected[expected["timestamp"] <= end.datetime]
+    df = reader.query_metric(TEST_METRIC_NAME, lazy=True).with_time_range(end=end).df()
+    assert_frame_equal(df.sort_values("timestamp", ignore_index=True), expected)
+
+
+def test_prefetch(data_path):
+    metrics = [f"{TEST_METRIC_NAME}_{i}" for i in range(6)]
+    for metric in metrics:
+        shutil.copytree(data_path / TEST_METRIC_NAME, data_path / metric)
+
+    reader = PromReader(str(data_path))
+    progress = []
+    loaded = reader.prefetch(metrics + metrics[:2], parallelism=3, progress=lambda *args: progress.append(args))
+    assert loaded == {metric: 2 for metric in metrics}
+    assert sorted(m for (m, _, _) in progress) == metrics
+    assert [(i, n) for (_, i, n) in progress] == [(i, 6) for i in range(1, 7)]
+    query = f"SELECT count(*) FROM {MANIFEST_TABLE} WHERE NOT contains(filename, '/' || metric || '/')"
+    assert reader._conn.query(query).fetchone() == (0,)
+
+    assert reader.prefetch(metrics) == {metric: 0 for metric in metrics}
+    assert len(reader.query_metric(metrics[-1]).df()) == 2000
+
+
+def test_prefetch_same_metric_concurrently(data_path):
+    reader = PromReader(str(data_path))
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: reader.prefetch([TEST_METRIC_NAME]), range(4)))
+
+    assert sorted(r[TEST_METRIC_NAME] for r in results) == [0, 0, 0, 2]
+    assert reader._conn.query(f"SELECT count(*) FROM {TEST_METRIC_NAME}").fetchone() == (2000,)
+    assert reader._conn.query(f"SELECT count(*) FROM {MANIFEST_TABLE}").fetchone() == (2,)
+
+
+@pytest.fixture
+def shared_cache(tmp_path, monkeypatch):
+    location = str(tmp_path / "cache.duckdb")
+    monkeypatch.setattr(prom_utils, "_cache_db_location", lambda *_: location)
+    return location
+
+
+def start_reader_process(data_path, shared_cache):
+    # Opens the cache read-only in another process, and holds onto it until its stdin is closed
+    script = f"""
+import sys
+from datakube import prom_utils
+prom_utils._cache_db_location = lambda *_: {shared_cache!r}
+reader = prom_utils.PromReader({str(data_path)!r}, read_only=True, lock_timeout=5)
+print(len(reader.query_metric({TEST_METRIC_NAME!r}).df()), flush=True)
+sys.stdin.read()
+"""
+    return subprocess.Popen(
+        [sys.executable, "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+
+
+def test_read_only(data_path, shared_cache):
+    writer = PromReader(str(data_path))
+    writer.query_metric(TEST_METRIC_NAME)
+    writer.close()
+
+    proc = start_reader_process(data_path, shared_cache)
+    try:
+        assert proc.stdout.readline() == "2000\n"
+
+        # Other readers can use the cache at the same time; metrics that aren't in it get loaded locally
+        shutil.copytree(data_path / TEST_METRIC_NAME, data_path / "other_metric")
+        reader = PromReader(str(data_path), read_only=True)
+        assert len(reader.query_metric(TEST_METRIC_NAME).df()) == 2000
+        assert len(reader.query_metric("other_metric").df()) == 2000
+        assert reader._tables == {"other_metric"}
+        assert reader._shared_tables == {TEST_METRIC_NAME}
+
+        # ...but nobody can write to it
+        with pytest.raises(duckdb.IOException):
+            PromReader(str(data_path), lock_timeout=0.2)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+    reader.detach()
+    write_parquet_slice(data_path / TEST_METRIC_NAME / "02.parquet", 2000, 3480)
+    writer = PromReader(str(data_path), lock_timeout=5)
+    writer.refresh()
+    writer.close()
+
+    reader.reattach()
+    assert len(reader.query_metric(TEST_METRIC_NAME).df()) == 3480
+
+
+def test_query_metric_lazy(data_path):
+    reader = PromReader(str(data_path), lazy=True)
+    rel = reader.query_metric(TEST_METRIC_NAME, "job").with_namespace("simkube")
+    assert len(rel.df()) == 2000
+    assert TEST_METRIC_NAME not in reader._tables
+
+    assert reader.materialize(TEST_METRIC_NAME) == 2
+    assert TEST_METRIC_NAME in reader._tables
+
+
+def test_query_metric_lazy_time_pushdown(data_path):
+    reader = PromReader(str(data_path), lazy=True)
+    split = (arrow.get(1713394966), arrow.get(1713394975))
+    rel = reader.query_metric(TEST_METRIC_NAME, "job").with_namespace("simkube").partition_and_normalize([split])
+
+    assert "timestamp>=1713394966000" in rel._rel.explain()
+    assert len(rel.df()) == 9
+
+    # Same rows without the pushdown (once the source is gone)
+    rel = reader.query_metric(TEST_METRIC_NAME, "job").with_namespace("simkube")
+    rel._drop_source()
+    assert len(rel.partition_and_normalize([split]).df()) == 9
+
+
+def test_query_metric_windows(data_path):
+    reader = PromReader(str(data_path), windows=[window(10, 20)])
+    assert len(reader.query_metric(TEST_METRIC_NAME).df()) == 10
+    assert reader._conn.query(f"SELECT count(*) FROM {TEST_METRIC_NAME}").fetchone() == (10,)
+
+    # Already covered, so nothing should be reloaded
+    assert len(reader.query_metric(TEST_METRIC_NAME, windows=[window(12, 15)]).df()) == 3
+    assert reader._conn.query(f"SELECT count(*) FROM {TEST_METRIC_NAME}").fetchone() == (10,)
+
+    # Not covered, so the cache gets re-scoped to include both
+    assert len(reader.query_metric(TEST_METRIC_NAME, windows=[window(1500, 1510)]).df()) == 10
+    assert reader._conn.query(f"SELECT count(*) FROM {TEST_METRIC_NAME}").fetchone() == (20,)
+    assert reader._conn.query(f"SELECT count(*) FROM {WINDOWS_TABLE}").fetchone() == (2,)
+
+
+def test_query_metric_windows_lazy(data_path):
+    reader = PromReader(str(data_path), lazy=True)
+    rel = reader.query_metric(TEST_METRIC_NAME, windows=[window(10, 20), window(1500, 1510)])
+    assert len(rel.df()) == 20
+
+
+def test_plan_window_scans(tmp_path):
+    # DuckDB rounds row groups up to a multiple of 2048 rows, so this gets us two row groups
+    write_parquet_slice(tmp_path / "data.parquet", 0, 3480, row_group_size=2048)
+    reader = PromReader(str(tmp_path))
+    base = TEST_START_TS * 1000 + 846
+    scans = reader._plan_window_scans(
+        [str(tmp_path / "data.parquet")],
+        [(base + 10_000, base + 20_000), (base + 3_000_000, base + 3_010_000)],
+    )
+    assert [(lo, hi) for (_, lo, hi) in scans] == [
+        (base + 10_000, base + 20_000),
+        (base + 3_000_000, base + 3_010_000),
+    ]
+
+    # Both windows are in the same row group, so this should collapse into a single scan
+    scans = reader._plan_window_scans(
+        [str(tmp_path / "data.parquet")],
+        [(base + 10_000, base + 20_000), (base + 1_500_000, base + 1_510_000)],
+    )
+    assert [(lo, hi) for (_, lo, hi) in scans] == [(base + 10_000, base + 1_510_000)]
+
+
+@pytest.fixture
+def owners_path(tmp_path):
+    write_owner_metric(
+        tmp_path / "kube_pod_owner" / "00.parquet",
+        [
+            ("web-abc-1", "default", "owner_kind=ReplicaSet,owner_name=web-abc"),
+            ("web-abc-2", "default", "owner_kind=ReplicaSet,owner_name=web-abc"),
+            ("batch-123-x", "default", "owner_kind=Job,owner_name=batch-123"),
+            ("db-0", "default", "owner_kind=StatefulSet,owner_name=db"),
+            ("web-abc-1", "other", "owner_kind=ReplicaSet,owner_name=web-abc"),
+        ],
+    )
+    write_owner_metric(
+        tmp_path / "kube_replicaset_owner" / "00.parquet",
+        [
+            ("", "default", "owner_kind=Deployment,owner_name=web,replicaset=web-abc"),
+            ("", "other", "owner_kind=Deployment,owner_name=other-web,replicaset=web-abc"),
+        ],
+    )
+    write_owner_metric(
+        tmp_path / "kube_job_owner" / "00.parquet",
+        [("", "default", "job=kube-state-metrics,job_name=batch-123,owner_kind=CronJob,owner_name=batch")],
+    )
+    return tmp_path
+
+
+def test_pod_owners(owners_path):
+    reader = PromReader(str(owners_path))
+    df = reader.pod_owners("default").df().sort_values("pod", ignore_index=True)
+    assert df["pod"].tolist() == ["batch-123-x", "db-0", "web-abc-1", "web-abc-2"]
+    assert df["root_owner"].tolist() == ["batch", "db", "web", "web"]
+    assert df["root_owner_kind"].tolist() == ["CronJob", "StatefulSet", "Deployment", "Deployment"]
+    other = reader.compute_pod_owners_map("other")
+    assert other.to_dict("records") == [{"pod": "web-abc-1", "root_owner": "other-web"}]
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_pod_owners_invalidated_on_refresh(owners_path, lazy):
+    reader = PromReader(str(owners_path), lazy=lazy)
+    assert len(reader.pod_owners("default").df()) == 4
+
+    write_owner_metric(
+        owners_path / "kube_pod_owner" / "01.parquet",
+        [("web-abc-3", "default", "owner_kind=ReplicaSet,owner_name=web-abc")],
+    )
+    reader.refresh()
+    assert len(reader.pod_owners("default").df()) == 5
+
+
+def test_pod_owners_cached(owners_path, monkeypatch):
+    reader = PromReader(str(owners_path))
+    resolved = []
+    resolve = reader._resolve_pod_owners
+    monkeypatch.setattr(reader, "_resolve_pod_owners", lambda *args: resolved.append(args[0]) or resolve(*args))
+
+    # Namespaces without any pods are remembered too
+    assert len(reader.pod_owners("empty").df()) == 0
+    assert len(reader.pod_owners("empty").df()) == 0
+    assert len(reader.pod_owners("default").df()) == 4
+    assert resolved == ["empty", "default"]
+
+    # Different windows means different owners (the owner metrics have a sample every millisecond)
+    reader.windows = [(arrow.get(TEST_START_TS), arrow.get(TEST_START_TS + 0.001))]
+    assert len(reader.pod_owners("default").df()) == 2
+    assert resolved == ["empty", "default", "default"]
+
+
+def test_prefetch_owner_metrics(owners_path):
+    reader = PromReader(str(owners_path), auto_refresh=True)
+    assert len(reader.pod_owners("default").df()) == 4
+    assert len(reader.pod_owners("other").df()) == 1
+
+    # Loading new data for all the owner metrics at once doesn't trip over the cached owners
+    metrics = ["kube_pod_owner", "kube_replicaset_owner", "kube_job_owner"]
+    for metric in metrics:
+        shutil.copy(owners_path / metric / "00.parquet", owners_path / metric / "01.parquet")
+    assert reader.prefetch(metrics, parallelism=3) == {metric: 1 for metric in metrics}
+    assert len(reader.pod_owners("default").df()) == 4
+    assert len(reader.pod_owners("other").df()) == 1
+
+
+def test_join_owners(owners_path):
+    reader = PromReader(str(owners_path))
+    owners = reader.pod_owners("default")
+    rel = reader.query_metric("kube_pod_owner", "pod").with_namespace("default").join_owners(owners)
+    counts = rel._rel.aggregate("root_owner, count(*) AS n").order("root_owner").fetchall()
+    assert counts == [("batch", 1), ("db", 1), ("web", 2)]
+
+
+def test_profile_pipeline(tmp_path):
+    generate_dataset(str(tmp_path), pods_per_namespace=5, containers_per_pod=1, duration=1800)
+    reader = PromReader(str(tmp_path))
+
+    def pipeline(rel):
+        return rel.extract_label("container").with_namespace("ns-0").fill_missing_data(resolution=15).rate(60)
+
+    expected = pipeline(reader.query_metric("container_cpu_usage_seconds_total", "pod")).df()
+    rel = pipeline(reader.query_metric("container_cpu_usage_seconds_total", "pod").profile())
+    assert_frame_equal(rel.df(), expected)
+
+    profile = rel.last_profile
+    assert [s.name for s in profile.stages] == [
+        "scan+extract_label+with_namespace",
+        "fill_missing_data(resolution=15)",
+        "rate(60)",
+        "df",
+    ]
+    assert [s.rows_out for s in profile.stages] == [600, 600, 600, 600]
+    assert [s.rows_in for s in profile.stages] == [None, 600, 600, 600]
+    assert "TABLE_SCAN" in profile.stages[0].explain
+    assert list(profile.to_df().columns) == ["name", "rows_in", "rows_out", "seconds"]
+    assert repr(profile).splitlines()[-1].startswith("total")
+
+
+def test_profile_pipeline_source(tmp_path):
+    generate_dataset(str(tmp_path), pods_per_namespace=5, containers_per_pod=1, duration=1800)
+    reader = PromReader(str(tmp_path), rollups=[60])
+    metric = "container_cpu_usage_seconds_total"
+    splits = [window(600, 700), window(900, 1000)]
+
+    # Profiling doesn't change what the stages that use the source (to narrow the scan, or to read from a rollup) do
+    expected = reader.query_metric(metric, "pod").partition_and_normalize(splits).df()
+    rel = reader.query_metric(metric, "pod").profile().partition_and_normalize(splits)
+    assert_frame_equal(rel.df(), expected)
+    assert rel.last_profile.stages[0].rows_out == len(expected)
+
+    expected = reader.query_metric(metric, "pod").fill_missing_data(resolution=60).df()
+    rel = reader.query_metric(metric, "pod").profile().fill_missing_data(resolution=60)
+    assert_frame_equal(rel.df(), expected)
+    assert "_datakube_rollup_60_" in rel.last_profile.stages[0].explain
+
+
+def result_pipeline(reader, windows=None):
+    rel = reader.query_metric(TEST_METRIC_NAME, "pod", windows=windows)
+    return rel.with_time_range(end=arrow.get(TEST_START_TS + 3000)).fill_missing_data(resolution=10)
+
+
+def test_result_cache(data_path):
+    reader = PromReader(str(data_path), result_cache_bytes=1 << 30)
+    expected = result_pipeline(PromReader(str(data_path))).df()
+
+    assert_frame_equal(result_pipeline(reader).df(), expected)
+    assert reader._results.stats()[0] == 1
+    assert_frame_equal(result_pipeline(reader).df(), expected)
+    assert reader._conn.query("SELECT hits FROM _datakube_results").fetchall() == [(1,)]
+
+    # New data means a new result, and the old one gets thrown away
+    write_parquet_slice(data_path / TEST_METRIC_NAME / "02.parquet", 2000, 3480)
+    reader.refresh()
+    assert len(result_pipeline(reader).df()) > len(expected)
+    assert reader._conn.query("SELECT hits FROM _datakube_results").fetchall() == [(0,)]
+
+    assert reader.invalidate_results() == 1
+    assert reader._results.stats() == (0, 0)
+    assert reader._conn.query(
+        f"SELECT count(*) FROM duckdb_tables WHERE starts_with(table_name, '{RESULT_TABLE_PREFIX}')"
+    ).fetchone() == (0,)
+
+
+def test_result_cache_across_processes(data_path, shared_cache):
+    def run():
+        reader = PromReader(str(data_path), result_cache_bytes=1 << 30)
+        # (with_value chains onto a SQL relation, which gets a random alias from DuckDB)
+        df = result_pipeline(reader).with_value(0, Comparison.GE).df()
+        hits = reader._conn.query("SELECT hits FROM _datakube_results").fetchall()
+        reader.close()
+        return df, hits
+
+    (expected, hits) = run()
+    assert hits == [(0,)]
+    (df, hits) = run()
+    assert hits == [(1,)]
+    assert_frame_equal(df, expected)
+
+    # Without result_cache_bytes, nothing gets memoized
+    assert PromReader(str(data_path))._results is None
+
+
+def test_result_cache_eviction(data_path):
+    reader = PromReader(str(data_path), result_cache_bytes=1 << 30)
+    first = result_pipeline(reader)
+    first.df()
+    (_, size) = reader._results.stats()
+
+    reader._results.max_bytes = size * 3 // 2
+    reader.query_metric(TEST_METRIC_NAME, "pod").fill_missing_data(resolution=10).df()
+    assert reader._results.stats() == (1, size)
+    assert reader.invalidate_results(first) == 0
+
+    # Uncacheable results are passed through as-is
+    assert (
+        PromReader(str(data_path), lazy=True, result_cache_bytes=1 << 30).query_metric(TEST_METRIC_NAME)._cache is None
+    )
+
+
+def test_result_key_stable(data_path):
+    windows = [window(0, 100), window(500, 600)]
+    keys = set()
+    for _ in range(2):
+        reader = PromReader(str(data_path), result_cache_bytes=1 << 30)
+        # (with_value chains onto a SQL relation, which gets a random alias from DuckDB)
+        rel = result_pipeline(reader, windows).rate(60).with_value(0, Comparison.GE)
+        keys.add(_result_key(rel._rel, reader._data_version()))
+    assert len(keys) == 1 and None not in keys
+
+
+def test_rollups(tmp_path):
+    metric = "container_cpu_usage_seconds_total"
+    full_path = tmp_path / "full"
+    generate_dataset(str(full_path), pods_per_namespace=5, duration=3 * 3600)
+    files = sorted((full_path / metric).iterdir())
+
+    # The rolled-up copy starts out with only some of the files, and gets the rest (plus a changed file) appended
+    data_path = tmp_path / "data"
+    (data_path / metric).mkdir(parents=True)
+    shutil.copy(files[0], data_path / metric)
+    duckdb.sql(f"COPY (SELECT * FROM '{files[1]}' LIMIT 100) TO '{data_path / metric / files[1].name}'")
+    reader = PromReader(str(data_path), rollups=[10, 60, 600])
+    reader.query_metric(metric)
+    for f in files[1:]:
+        shutil.copy(f, data_path / metric)
+    assert reader.refresh() == {metric: len(files) - 1}
+    assert reader._rollup_tiers(metric) == [10, 60, 600]
+
+    def pipeline(reader, resolution, start=None, end=None):
+        rel = reader.query_metric(metric, "pod").extract_label("container").with_namespace("ns-1")
+        return rel.with_time_range(start, end).fill_missing_data(resolution=resolution)
+
+    raw_reader = PromReader(str(full_path))
+    bounds = (arrow.get(TEST_START_TS + 1234.5), arrow.get(TEST_START_TS + 7777.7))
+    for resolution, tier in [(30, 10), (120, 60), (1200, 600), (7, None)]:
+        for start, end in [(None, None), bounds]:
+            rel = pipeline(reader, resolution, start, end)
+            assert (f"_datakube_rollup_{tier}_" in rel._rel.explain()) == (tier is not None)
+            assert_frame_equal(rel.df(), pipeline(raw_reader, resolution, start, end).df())
+
+    # A rolled-up sample could pass a filter on the values that the raw samples wouldn't
+    rel = reader.query_metric(metric, "pod").with_value(100, Comparison.LT).fill_missing_data(resolution=60)
+    assert "_datakube_rollup" not in rel._rel.explain()
+
+
+def test_rollups_built_once(data_path, monkeypatch):
+    metric = TEST_METRIC_NAME
+    reader = PromReader(str(data_path), rollups=[60])
+    reader.query_metric(metric)
+    assert reader._rollup_tiers(metric) == [60]
+
+    # Querying again doesn't go looking for missing tiers...
+    calls = []
+    build = reader._build_rollups
+    monkeypatch.setattr(reader, "_build_rollups", lambda m: calls.append(m) or build(m))
+    reader.query_metric(metric)
+    assert calls == []
+
+    # ...until we ask for different ones
+    reader.rollups = [60, 600]
+    reader.query_metric(metric)
+    assert calls == [metric]
+    assert reader._rollup_tiers(metric) == [60, 600]
+
+
 # def test_compute_pod_owners_map() -> None:
 #     reader = PromReader("./tests/data")
 #     df = reader.compute_pod_owners_map()
@@ -0,0 +1,21 @@
+from datakube.prom_utils import PromReader
+from datakube.synth_utils import COUNTER_METRICS
+from datakube.synth_utils import GAUGE_METRICS
+from datakube.synth_utils import OWNER_METRICS
+from datakube.synth_utils import generate_dataset
+
+
+def test_generate_dataset(tmp_path):
+    rows = generate_dataset(str(tmp_path), pods_per_namespace=5, duration=7200, reset_probability=0.05)
+    assert set(rows) == set(GAUGE_METRICS + COUNTER_METRICS + OWNER_METRICS)
+    assert rows["container_cpu_usage_seconds_total"] == 2 * 5 * 2 * 480
+    assert len(list((tmp_path / "kube_pod_owner").iterdir())) == 3
+
+    reader = PromReader(str(tmp_path))
+    cpu = reader.query_metric("container_cpu_usage_seconds_total", "pod").df().sort_values("timestamp")
+    assert len(cpu) == rows["container_cpu_usage_seconds_total"]
+    assert len(cpu["labels"][0].split(",")) == 6
+    assert (cpu.groupby(["pod", "container"])["value"].diff() < 0).any()
+
+    owners = reader.pod_owners("ns-0").df()
+    assert sorted(owners["root_owner"].unique()) == ["app-0", "batch-0", "batch-1"]